@@ -18,6 +18,8 @@
 #include <errno.h>
 #include <fcntl.h>
 #include <netinet/in.h>
+#include <netinet/tcp.h>
+#include <poll.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -47,24 +49,45 @@
 // uint64_t shiftedData;            // shifted out tdo during data
 // uint32_t shiftedInstruction;     // shifted out tdo during instruction
 //
+// The test program may send many requests without waiting for responses
+// (pipelining). They are processed in order and each gets its own response,
+// so the responses arrive in the same order as the requests.
 //
 
 namespace
 {
 const int REQUEST_LENGTH = 14;
+const int RESPONSE_LENGTH = 12;
+
+// Holds pipelined requests, so a batch can be read with one system call
+// instead of one per request.
+const int REQUEST_BUFFER_SIZE = REQUEST_LENGTH * 256;
 
 int listenSocket = -1;
 int controlSocket = -1;
-unsigned char requestBuffer[REQUEST_LENGTH];
-int currentLength;
+unsigned char requestBuffer[REQUEST_BUFFER_SIZE];
+int requestOffset;  // Start of the next unprocessed request
+int bufferLength;   // Number of valid bytes in requestBuffer
+
+void close_control_socket()
+{
+    close(controlSocket);
+    controlSocket = -1;
+    requestOffset = 0;
+    bufferLength = 0;
+}
 }
 
 //
-// Open a socket that will listen for connections from a test harness
+// Open a socket that will listen for connections from a test harness. If
+// port is 0, the OS picks a free port. If readyFile is not empty, write the
+// port number to it once the socket is listening, so the test harness knows
+// when it can connect (and which port to use).
 //
-extern int open_jtag_socket(int port)
+extern int open_jtag_socket(int port, const char *readyFile)
 {
     struct sockaddr_in address;
+    socklen_t addressLength;
     int optval;
 
     listenSocket = socket(PF_INET, SOCK_STREAM, 0);
@@ -103,6 +126,26 @@ extern int open_jtag_socket(int port)
         return 0;
     }
 
+    addressLength = sizeof(address);
+    if (getsockname(listenSocket, (struct sockaddr*) &address, &addressLength) < 0)
+    {
+        perror("init_jtag_socket: error setting up debug socket (getsockname)");
+        return 0;
+    }
+
+    if (readyFile[0] != '\0')
+    {
+        FILE *file = fopen(readyFile, "w");
+        if (file == NULL)
+        {
+            perror("init_jtag_socket: error opening ready file");
+            return 0;
+        }
+
+        fprintf(file, "%d\n", ntohs(address.sin_port));
+        fclose(file);
+    }
+
     return 1;
 }
 
@@ -116,6 +159,7 @@ extern int poll_jtag_request(svBitVecVal *instructionLength, svBitVecVal *instru
     svBitVecVal *dataLength, svBitVecVal *data)
 {
     int got;
+    const unsigned char *request;
 
     if (controlSocket < 0)
     {
@@ -137,33 +181,60 @@ extern int poll_jtag_request(svBitVecVal *instructionLength, svBitVecVal *instru
             perror("poll_jtag_request: error setting up control socket (fcntl)");
             return 0;
         }
+
+        // Responses are small, send them right away (Nagle's algorithm
+        // would otherwise delay them while the test program waits).
+        int optval = 1;
+        if (setsockopt(controlSocket, IPPROTO_TCP, TCP_NODELAY, &optval,
+                       sizeof(optval)) < 0)
+        {
+            perror("poll_jtag_request: error setting up control socket (setsockopt)");
+            return 0;
+        }
     }
 
-    got = read(controlSocket, requestBuffer + currentLength,
-        sizeof(requestBuffer) - currentLength);
-    if (got <= 0)
+    if (bufferLength - requestOffset < REQUEST_LENGTH)
     {
-        if (errno == EWOULDBLOCK)
-            return 0;   // No data available
+        // Move the partial request to the beginning of the buffer, then
+        // read as many more requests as are available and fit.
+        memmove(requestBuffer, requestBuffer + requestOffset,
+                bufferLength - requestOffset);
+        bufferLength -= requestOffset;
+        requestOffset = 0;
+        got = read(controlSocket, requestBuffer + bufferLength,
+                   sizeof(requestBuffer) - bufferLength);
+        if (got < 0)
+        {
+            if (errno == EWOULDBLOCK)
+                return 0;   // No data available
 
-        // Fatal socket error
-        perror("poll_jtag_request: control socket error");
-        controlSocket = -1;
-        return 0;
-    }
+            // Fatal socket error
+            perror("poll_jtag_request: control socket error");
+            close_control_socket();
+            return 0;
+        }
 
-    currentLength += got;
-    if (currentLength < REQUEST_LENGTH)
-        return 0;
+        if (got == 0)
+        {
+            // Test program closed the connection
+            close_control_socket();
+            return 0;
+        }
+
+        bufferLength += got;
+        if (bufferLength < REQUEST_LENGTH)
+            return 0;
+    }
 
     // Have read a complete request
-    currentLength = 0;
+    request = requestBuffer + requestOffset;
+    requestOffset += REQUEST_LENGTH;
 
     // XXX assumes a little endian machine
-    *instructionLength = requestBuffer[0];
-    memcpy(instruction, requestBuffer + 1, 4);
-    *dataLength = requestBuffer[5];
-    memcpy(data, requestBuffer + 6, 8);
+    *instructionLength = request[0];
+    memcpy(instruction, request + 1, 4);
+    *dataLength = request[5];
+    memcpy(data, request + 6, 8);
 
     return 1;
 }
@@ -172,13 +243,37 @@ extern int poll_jtag_request(svBitVecVal *instructionLength, svBitVecVal *instru
 // this sends the value that was shifted out of the device.
 extern int send_jtag_response(const svBitVecVal *instruction, const svBitVecVal *data)
 {
-    char response[12];
+    char response[RESPONSE_LENGTH];
+    int offset;
+    int sent;
+    struct pollfd pfd;
 
     memcpy(response, instruction, 4);
     memcpy(response + 4, data, 8);
 
-    if (write(controlSocket, response, 12) < 0)
-        perror("send_jtag_response: error sending response (send)");
+    // The socket is non-blocking. If the test program has sent a large batch
+    // of requests and isn't reading responses yet, the socket buffer may be
+    // full, so wait for space instead of dropping the response.
+    offset = 0;
+    while (offset < RESPONSE_LENGTH)
+    {
+        sent = write(controlSocket, response + offset, RESPONSE_LENGTH - offset);
+        if (sent < 0)
+        {
+            if (errno == EWOULDBLOCK)
+            {
+                pfd.fd = controlSocket;
+                pfd.events = POLLOUT;
+                poll(&pfd, 1, -1);
+                continue;
+            }
+
+            perror("send_jtag_response: error sending response (send)");
+            break;
+        }
+
+        offset += sent;
+    }
 
     return 0;
 }
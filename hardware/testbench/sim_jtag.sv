@@ -15,7 +15,7 @@
 //
 
 // Native functions defined in jtag_socket.cpp
-import "DPI-C" function int open_jtag_socket(input int port);
+import "DPI-C" function int open_jtag_socket(input int port, input string ready_file);
 import "DPI-C" function int poll_jtag_request(output bit[31:0] instructionLength,
     output bit[31:0] instruction, output bit[31:0] dataLength, output bit[63:0] data);
 import "DPI-C" function int send_jtag_response(input bit[31:0] instruction, input bit[63:0] data);
@@ -73,8 +73,12 @@ module sim_jtag
     initial
     begin
         int jtag_port;
+        string ready_file;
+        if ($value$plusargs("readyfile=%s", ready_file) == 0)
+            ready_file = "";
+
         if ($value$plusargs("jtag_port=%d", jtag_port) != 0)
-            control_port_open = open_jtag_socket(jtag_port);
+            control_port_open = open_jtag_socket(jtag_port, ready_file);
         else
             control_port_open = 0;
     end
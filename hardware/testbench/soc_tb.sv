@@ -38,6 +38,8 @@ module soc_tb(
     int finish_cycles;
     bit profile_en;
     int profile_fd;
+    bit perf_count_en;
+    int perf_event_count[TOTAL_PERF_EVENTS];
     axi4_interface axi_bus_s[1:0]();
     axi4_interface axi_bus_m[1:0]();
     scalar_t loopback_uart_read_data;
@@ -384,6 +386,40 @@ module soc_tb(
     end
     endtask
 
+    // Load a raw memory image, starting at address 0. Each 32-bit memory
+    // word holds four consecutive bytes from the file, most significant
+    // byte first (the same order as $readmemh and the memory dump below).
+    task load_raw_image;
+        input string filename;
+        int image_fd;
+        int byte0;
+        int byte1;
+        int byte2;
+        int byte3;
+    begin
+        image_fd = $fopen(filename, "rb");
+        if (image_fd == 0)
+        begin
+            $display("Error opening memory image file %s", filename);
+            $finish;
+        end
+
+        for (int i = 0; i < MEM_SIZE; i++)
+        begin
+            byte0 = $fgetc(image_fd);
+            if (byte0 < 0)
+                break;   // End of file
+
+            byte1 = $fgetc(image_fd);
+            byte2 = $fgetc(image_fd);
+            byte3 = $fgetc(image_fd);
+            memory.sdram_data[i] = {byte0[7:0], byte1[7:0], byte2[7:0], byte3[7:0]};
+        end
+
+        $fclose(image_fd);
+    end
+    endtask
+
     // Manually copy lines from the L2 cache back to memory so we can
     // validate it there.
     `define L2_TAG_WAY nyuzi.l2_cache.l2_cache_tag_stage.way_tags_gen
@@ -447,11 +483,26 @@ module soc_tb(
         else
             profile_en = 0;
 
+        // Print how many times each performance counter event occurred when
+        // the simulation finishes, for tests/cosimulation/coverage.py.
+        if ($test$plusargs("perfcounts") != 0)
+            perf_count_en = 1;
+        else
+            perf_count_en = 0;
+
         for (int i = 0; i < MEM_SIZE; i++)
             memory.sdram_data[i] = 0;
 
         if ($value$plusargs("bin=%s", filename) != 0)
-            $readmemh(filename, memory.sdram_data);
+        begin
+            // Files with a .hex extension are in $readmemh format. Anything
+            // else is a raw binary image.
+            if (filename.len() > 4 && filename.substr(filename.len() - 4,
+                filename.len() - 1) == ".hex")
+                $readmemh(filename, memory.sdram_data);
+            else
+                load_raw_image(filename);
+        end
         else
         begin
             $display("No memory image file specified with +bin");
@@ -501,6 +552,12 @@ module soc_tb(
         if (profile_en)
             $fclose(profile_fd);
 
+        if (perf_count_en)
+        begin
+            for (int i = 0; i < TOTAL_PERF_EVENTS; i++)
+                $display("perf event %0d %0d", i, perf_event_count[i]);
+        end
+
         // Do this last so emulator doesn't kill us with SIGPIPE during cosimulation.
         if (processor_halt)
             $display("***HALTED***");
@@ -512,6 +569,8 @@ module soc_tb(
         begin
             finish_cycles <= '0;
             total_cycles <= '0;
+            for (int i = 0; i < TOTAL_PERF_EVENTS; i++)
+                perf_event_count[i] <= 0;
         end
         else
         begin
@@ -529,6 +588,15 @@ module soc_tb(
             else
                 total_cycles <= total_cycles + 1;    // Don't count cycles after halt
 
+            if (perf_count_en && !processor_halt)
+            begin
+                for (int i = 0; i < TOTAL_PERF_EVENTS; i++)
+                begin
+                    if (nyuzi.perf_events[i])
+                        perf_event_count[i] <= perf_event_count[i] + 1;
+                end
+            end
+
             if (state_dump_en)
             begin
                 for (int i = 0; i < `THREADS_PER_CORE; i++)
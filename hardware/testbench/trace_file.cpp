@@ -0,0 +1,177 @@
+//
+// Copyright 2018 Jeff Bush
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+//
+
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include "svdpi.h"
+#include "Vsoc_tb__Dpi.h"
+
+//
+// Writes the events from trace_logger to a file in a binary format, which the
+// emulator reads in cosimulation mode (nyuzi_emulator -m cosim -B). This is
+// much faster than printing and parsing the text format for long programs.
+// The format is described in tools/emulator/cosimulation.c. Each record
+// begins with this header:
+//
+// uint8_t type;
+// uint8_t thread;
+// uint8_t reg;
+// uint8_t reserved;
+// uint32_t pc;
+//
+// trace_logger passes vectors as they are packed in the hardware, with lane 0
+// in the least significant word. The emulator numbers lanes in the opposite
+// order, so these are reversed when written.
+//
+
+namespace
+{
+const uint32_t TRACE_MAGIC = 0x5254594e;
+const uint32_t TRACE_VERSION = 1;
+const int NUM_VECTOR_LANES = 16;
+
+// Record types. The first four are the same as trace_event_type_t in
+// trace_logger.sv.
+const int TRACE_SWRITEBACK = 1;
+const int TRACE_VWRITEBACK = 2;
+const int TRACE_STORE = 3;
+const int TRACE_INTERRUPT = 4;
+const int TRACE_HALT = 5;
+
+// Largest record: header, address, mask, and vector data.
+const int MAX_RECORD_LENGTH = 8 + 4 + 8 + NUM_VECTOR_LANES * 4;
+
+const int WRITE_BUFFER_SIZE = 0x100000;
+
+FILE *traceFile;
+
+uint32_t endian_swap32(uint32_t value)
+{
+    return ((value & 0x000000ff) << 24)
+           | ((value & 0x0000ff00) << 8)
+           | ((value & 0x00ff0000) >> 8)
+           | ((value & 0xff000000) >> 24);
+}
+
+void write_header(unsigned char *record, int type, int thread, int reg, int pc)
+{
+    uint32_t pcValue = pc;
+
+    record[0] = type;
+    record[1] = thread;
+    record[2] = reg;
+    record[3] = 0;
+    memcpy(record + 4, &pcValue, 4);
+}
+
+int write_vector(unsigned char *dest, const svBitVecVal *data, bool swapBytes)
+{
+    uint32_t laneValue;
+
+    for (int lane = 0; lane < NUM_VECTOR_LANES; lane++)
+    {
+        laneValue = data[NUM_VECTOR_LANES - lane - 1];
+        if (swapBytes)
+            laneValue = endian_swap32(laneValue);
+
+        memcpy(dest + lane * 4, &laneValue, 4);
+    }
+
+    return NUM_VECTOR_LANES * 4;
+}
+}
+
+//
+// Returns -1 if the file couldn't be opened, 0 otherwise.
+//
+extern int open_trace_file(const char *filename)
+{
+    const uint32_t fileHeader[2] = { TRACE_MAGIC, TRACE_VERSION };
+
+    traceFile = fopen(filename, "wb");
+    if (traceFile == NULL)
+    {
+        perror("open_trace_file: couldn't open trace file");
+        return -1;
+    }
+
+    // The emulator reads records as they are written, but doesn't need to see
+    // each one immediately, so write them in large blocks.
+    setvbuf(traceFile, NULL, _IOFBF, WRITE_BUFFER_SIZE);
+    fwrite(fileHeader, sizeof(fileHeader), 1, traceFile);
+    return 0;
+}
+
+extern void write_trace_record(int type, int thread, int reg, int pc, int address,
+                               const svBitVecVal *mask, const svBitVecVal *data)
+{
+    unsigned char record[MAX_RECORD_LENGTH];
+    int length = 8;
+    uint32_t value;
+
+    write_header(record, type, thread, reg, pc);
+    switch (type)
+    {
+        case TRACE_SWRITEBACK:
+            value = data[0];
+            memcpy(record + length, &value, 4);
+            length += 4;
+            break;
+
+        case TRACE_VWRITEBACK:
+            value = mask[0] & 0xffff;
+            memcpy(record + length, &value, 4);
+            length += 4;
+            length += write_vector(record + length, data, false);
+            break;
+
+        case TRACE_STORE:
+            value = address;
+            memcpy(record + length, &value, 4);
+            memcpy(record + length + 4, mask, 8);
+            length += 12;
+            length += write_vector(record + length, data, true);
+            break;
+
+        case TRACE_INTERRUPT:
+            break;
+
+        default:
+            fprintf(stderr, "write_trace_record: invalid record type %d\n", type);
+            return;
+    }
+
+    fwrite(record, length, 1, traceFile);
+}
+
+//
+// If halted is set, writes a record to indicate the program finished
+// normally. If the simulation exits any other way, the trace just ends.
+//
+extern void close_trace_file(int halted)
+{
+    unsigned char record[8];
+
+    if (halted)
+    {
+        write_header(record, TRACE_HALT, 0, 0, 0);
+        fwrite(record, sizeof(record), 1, traceFile);
+    }
+
+    fclose(traceFile);
+    traceFile = NULL;
+}
@@ -18,10 +18,18 @@
 
 import defines::*;
 
+import "DPI-C" function int open_trace_file(input string filename);
+import "DPI-C" function void write_trace_record(input int event_type, input int thread_idx,
+    input int writeback_reg, input int pc, input int addr, input bit[63:0] mask,
+    input bit[511:0] data);
+import "DPI-C" function void close_trace_file(input int halted);
+
 //
 // This prints register updates and memory writes to the console. The emulator
 // uses this information to verify the hardware is working correctly in
-// cosimulation.
+// cosimulation. With +tracefile=<file>, it instead writes them to the file in
+// a binary format (see trace_file.cpp), which is much faster to produce and
+// parse. The text format (+trace) is easier to read when debugging.
 //
 // This captures instructions as the pipeline retires them. This is necessary
 // to get the results of arithmetic operations. The problem is that the
@@ -74,7 +82,8 @@ module trace_logger(
     input local_thread_idx_t         dt_thread_idx,
     input scalar_t                   dt_request_virt_addr,
     input                            sq_rollback_en,
-    input                            sq_store_sync_success);
+    input                            sq_store_sync_success,
+    input                            processor_halt);
 
     localparam TRACE_REORDER_QUEUE_LEN = 7;
 
@@ -98,6 +107,8 @@ module trace_logger(
 
     trace_event_t trace_reorder_queue[TRACE_REORDER_QUEUE_LEN];
     bit trace_en;
+    bit trace_file_en;
+    string trace_filename;
     logic writeback_sync_store;
     scalar_t fx5_instruction_pc_latched;
     scalar_t dd_instruction_pc_latched;
@@ -108,6 +119,21 @@ module trace_logger(
     initial
     begin
         trace_en = $test$plusargs("trace") != 0;
+        trace_file_en = 0;
+        if ($value$plusargs("tracefile=%s", trace_filename) != 0)
+        begin
+            if (open_trace_file(trace_filename) < 0)
+                $finish;
+
+            trace_en = 1;
+            trace_file_en = 1;
+        end
+    end
+
+    final
+    begin
+        if (trace_file_en)
+            close_trace_file(int'(processor_halt));
     end
 
     assign writeback_sync_store = dd_instruction_valid && !dd_instruction_load
@@ -129,45 +155,61 @@ module trace_logger(
             ix_instruction_valid_latched <= ix_instruction_valid;
             dd_instruction_valid_latched <= dd_instruction_valid;
 
-            case (trace_reorder_queue[0].event_type)
-                EVENT_VWRITEBACK:
+            if (trace_file_en)
+            begin
+                if (trace_reorder_queue[0].event_type != EVENT_INVALID)
                 begin
-                    $display("vwriteback %x %x %x %x %x",
+                    write_trace_record(int'(trace_reorder_queue[0].event_type),
+                        int'(trace_reorder_queue[0].thread_idx),
+                        int'(trace_reorder_queue[0].writeback_reg),
                         trace_reorder_queue[0].pc,
-                        trace_reorder_queue[0].thread_idx,
-                        trace_reorder_queue[0].writeback_reg,
+                        trace_reorder_queue[0].addr,
                         trace_reorder_queue[0].mask,
                         trace_reorder_queue[0].data);
                 end
+            end
+            else
+            begin
+                case (trace_reorder_queue[0].event_type)
+                    EVENT_VWRITEBACK:
+                    begin
+                        $display("vwriteback %x %x %x %x %x",
+                            trace_reorder_queue[0].pc,
+                            trace_reorder_queue[0].thread_idx,
+                            trace_reorder_queue[0].writeback_reg,
+                            trace_reorder_queue[0].mask,
+                            trace_reorder_queue[0].data);
+                    end
 
-                EVENT_SWRITEBACK:
-                begin
-                    $display("swriteback %x %x %x %x",
-                        trace_reorder_queue[0].pc,
-                        trace_reorder_queue[0].thread_idx,
-                        trace_reorder_queue[0].writeback_reg,
-                        trace_reorder_queue[0].data[0]);
-                end
+                    EVENT_SWRITEBACK:
+                    begin
+                        $display("swriteback %x %x %x %x",
+                            trace_reorder_queue[0].pc,
+                            trace_reorder_queue[0].thread_idx,
+                            trace_reorder_queue[0].writeback_reg,
+                            trace_reorder_queue[0].data[0]);
+                    end
 
-                EVENT_STORE:
-                begin
-                    $display("store %x %x %x %x %x",
-                        trace_reorder_queue[0].pc,
-                        trace_reorder_queue[0].thread_idx,
-                        trace_reorder_queue[0].addr,
-                        trace_reorder_queue[0].mask,
-                        trace_reorder_queue[0].data);
-                end
+                    EVENT_STORE:
+                    begin
+                        $display("store %x %x %x %x %x",
+                            trace_reorder_queue[0].pc,
+                            trace_reorder_queue[0].thread_idx,
+                            trace_reorder_queue[0].addr,
+                            trace_reorder_queue[0].mask,
+                            trace_reorder_queue[0].data);
+                    end
 
-                EVENT_INTERRUPT:
-                begin
-                    $display("interrupt %d %x", trace_reorder_queue[0].thread_idx,
-                        trace_reorder_queue[0].pc);
-                end
+                    EVENT_INTERRUPT:
+                    begin
+                        $display("interrupt %d %x", trace_reorder_queue[0].thread_idx,
+                            trace_reorder_queue[0].pc);
+                    end
 
-                default:
-                    ; // Do nothing
-            endcase
+                    default:
+                        ; // Do nothing
+                endcase
+            end
 
             for (int i = 0; i < TRACE_REORDER_QUEUE_LEN - 1; i++)
                 trace_reorder_queue[i] <= trace_reorder_queue[i + 1];
@@ -63,28 +63,26 @@ def run_io_interrupt(_, target):
 # separate host process (useful for co-emulation)
 # XXX A number of error cases do not clean up resources
 
-RECV_PIPE_NAME = test_harness.WORK_DIR + '/nyuzi_emulator_recvint'
-SEND_PIPE_NAME = test_harness.WORK_DIR + '/nyuzi_emulator_sendint'
-
 
 @test_harness.test(['emulator'])
 def recv_host_interrupt(*unused):
+    recv_pipe_name = test_harness.WORK_DIR + '/nyuzi_emulator_recvint'
     try:
-        os.remove(RECV_PIPE_NAME)
+        os.remove(recv_pipe_name)
     except OSError:
         pass    # Ignore if pipe doesn't exist
 
     test_harness.build_program(['recv_host_interrupt.S'])
 
-    os.mknod(RECV_PIPE_NAME, stat.S_IFIFO | 0o666)
+    os.mknod(recv_pipe_name, stat.S_IFIFO | 0o666)
 
     args = [test_harness.EMULATOR_PATH,
-            '-i', RECV_PIPE_NAME, test_harness.HEX_FILE]
+            '-i', recv_pipe_name, test_harness.BIN_FILE]
     emulator_process = subprocess.Popen(args, stdout=subprocess.PIPE,
                                         stderr=subprocess.STDOUT)
 
     try:
-        interrupt_pipe = os.open(RECV_PIPE_NAME, os.O_WRONLY)
+        interrupt_pipe = os.open(recv_pipe_name, os.O_WRONLY)
 
         # Send periodic interrupts to process'
         try:
@@ -103,27 +101,28 @@ def recv_host_interrupt(*unused):
             raise test_harness.TestException('Test failed ' + strresult)
     finally:
         os.close(interrupt_pipe)
-        os.unlink(RECV_PIPE_NAME)
+        os.unlink(recv_pipe_name)
 
 
 @test_harness.test(['emulator'])
 def send_host_interrupt(*unused):
+    send_pipe_name = test_harness.WORK_DIR + '/nyuzi_emulator_sendint'
     try:
-        os.remove(SEND_PIPE_NAME)
+        os.remove(send_pipe_name)
     except OSError:
         pass    # Ignore if pipe doesn't exist
 
     test_harness.build_program(['send_host_interrupt.S'])
 
-    os.mknod(SEND_PIPE_NAME, stat.S_IFIFO | 0o666)
+    os.mknod(send_pipe_name, stat.S_IFIFO | 0o666)
 
     args = [test_harness.EMULATOR_PATH,
-            '-o', SEND_PIPE_NAME, test_harness.HEX_FILE]
+            '-o', send_pipe_name, test_harness.BIN_FILE]
     emulator_process = subprocess.Popen(args, stdout=subprocess.PIPE,
                                         stderr=subprocess.STDOUT)
 
     try:
-        interrupt_pipe = os.open(SEND_PIPE_NAME, os.O_RDONLY | os.O_NONBLOCK)
+        interrupt_pipe = os.open(send_pipe_name, os.O_RDONLY | os.O_NONBLOCK)
         test_harness.TimedProcessRunner().communicate(emulator_process, 60)
 
         # Interrupts should be in pipe now
@@ -133,7 +132,7 @@ def send_host_interrupt(*unused):
                 'Did not receive proper host interrupts')
     finally:
         os.close(interrupt_pipe)
-        os.unlink(SEND_PIPE_NAME)
+        os.unlink(send_pipe_name)
 
 test_harness.register_generic_assembly_tests([
     'setcr_non_super.S',
@@ -0,0 +1,289 @@
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Runs a program in the verilator model and the emulator in lock step (see
+README.md in this directory). This is used by runtest.py, farm.py, and
+minimize.py, which add the tests directory to the module search path before
+importing it.
+"""
+
+import os
+import re
+import subprocess
+
+import test_harness
+
+# Private data segments of the random programs (see generate_random.py),
+# which are compared after the program finishes.
+MEMORY_DUMP_BASE = 0x800000
+MEMORY_DUMP_LENGTH = 0x400000
+
+# How long to wait for verilator to write its memory dump and exit after
+# the emulator has finished.
+VERILATOR_EXIT_TIMEOUT = 60
+
+# The emulator prints a checkpoint after this many events (register
+# writebacks and stores). When a run fails, the verbose replay starts at the
+# last checkpoint before the event that diverged, so this is roughly the
+# maximum length of the replay.
+CHECKPOINT_INTERVAL = 10000
+
+CHECKPOINT_RE = re.compile(r'checkpoint (\d+) ([0-9a-f]+) ([0-9a-f]+)')
+DIVERGED_RE = re.compile(r'Diverged at event (\d+)')
+
+# The floating point unit doesn't round exactly the same way as the host the
+# emulator runs on (https://github.com/jbush001/NyuziProcessor/issues/87), so
+# the emulator allows floating point results to differ by this many units in
+# the last place (see -u in tools/emulator/README.md).
+FP_ULP_TOLERANCE = 1
+
+FP_STATS_RE = re.compile(
+    r'fp results exact (\d+) rounded (\d+) nan (\d+) undefined (\d+) max ulps (\d+)')
+FP_ULPS_RE = re.compile(r'fp ulps (\d+)\+? (\d+)')
+
+
+def run_cosimulation(image_file, randseed=None, text_trace=None, replay=True,
+                     measure_coverage=False, fp_ulp_tolerance=FP_ULP_TOLERANCE):
+    """
+    Run a program in verilator, with the emulator checking each side effect,
+    then compare the final memory contents. Files are written to WORK_DIR.
+
+    Args:
+        image_file: Program to run, from build_program.
+        randseed: Seed for verilator's randomization of uninitialized
+            signals. If None, uses the --randseed option, if set.
+        text_trace: If True, verilator sends side effects to the emulator as
+            text (+trace), otherwise in the binary format (+tracefile),
+            which is faster. If None, this uses text with --debug, so the
+            output shows each event as verilator printed it.
+        replay: If the emulator detects a mismatch with the binary trace,
+            run it again on the saved trace to print the events before the
+            mismatch (see replay_divergence).
+        measure_coverage: If True, verilator prints the number of times
+            each performance counter event occurred (+perfcounts), and the
+            binary trace (WORK_DIR/trace.bin) is kept even if the test
+            passes, for coverage.collect_coverage. The caller must remove it.
+        fp_ulp_tolerance: Number of units in the last place that floating
+            point results can differ by. If None, they must match exactly.
+
+    Returns:
+        Statistics of the differences between floating point results (see
+        parse_fp_stats), or None if fp_ulp_tolerance is None or with
+        --debug.
+
+    Raises:
+        TestException if the emulator detects a mismatch or memory contents
+        differ at the end.
+    """
+
+    if text_trace is None:
+        text_trace = test_harness.DEBUG
+
+    verilator_mem_dump = test_harness.WORK_DIR + '/vmem.bin'
+    emulator_mem_dump = test_harness.WORK_DIR + '/mmem.bin'
+    verilator_args = [
+        test_harness.VSIM_PATH,
+        '+memdumpfile=' + verilator_mem_dump,
+        '+memdumpbase=' + hex(MEMORY_DUMP_BASE)[2:],
+        '+memdumplen=' + hex(MEMORY_DUMP_LENGTH)[2:],
+        '+autoflushl2'
+    ]
+
+    verilator_args += test_harness.verilator_seed_args(randseed)
+    if measure_coverage:
+        verilator_args += ['+perfcounts']
+
+    emulator_args = [
+        test_harness.EMULATOR_PATH,
+        '-m',
+        'cosim',
+        '-d',
+        emulator_mem_dump + ',' + hex(MEMORY_DUMP_BASE) + ',' + hex(MEMORY_DUMP_LENGTH)
+    ]
+
+    if test_harness.DEBUG:
+        emulator_args += ['-v']
+
+    # Options that affect how the emulator checks events, which a replay
+    # also needs.
+    check_args = []
+    if fp_ulp_tolerance is not None:
+        check_args += ['-u', str(fp_ulp_tolerance)]
+
+    emulator_args += check_args
+
+    trace_file = test_harness.WORK_DIR + '/trace.bin'
+    if text_trace:
+        p1 = subprocess.Popen(
+            verilator_args + ['+trace', '+bin=' + image_file], stdout=subprocess.PIPE)
+        p2 = subprocess.Popen(
+            emulator_args + [image_file], stdin=p1.stdout, stdout=subprocess.PIPE)
+
+        # Only the emulator should hold the read end of the pipe, so verilator
+        # gets an error (rather than blocking) if the emulator exits early.
+        p1.stdout.close()
+        verilator_log = None
+    else:
+        # Verilator writes the binary trace to its own pipe (passed by file
+        # descriptor), so other messages it prints don't get mixed in with
+        # it. Those go to a log file, which is included in the error if the
+        # test fails.
+        trace_read_fd, trace_write_fd = os.pipe()
+        verilator_log_file = test_harness.WORK_DIR + '/vsim.log'
+        verilator_log = open(verilator_log_file, 'w')
+        p1 = subprocess.Popen(
+            verilator_args + ['+tracefile=/dev/fd/' + str(trace_write_fd),
+                              '+bin=' + image_file],
+            stdout=verilator_log, stderr=subprocess.STDOUT, pass_fds=(trace_write_fd,))
+        os.close(trace_write_fd)
+        p2 = subprocess.Popen(
+            emulator_args + ['-B', '-k', str(CHECKPOINT_INTERVAL), '-T', trace_file,
+                             image_file],
+            stdin=trace_read_fd, stdout=subprocess.PIPE)
+        os.close(trace_read_fd)
+
+    output = ''
+    while True:
+        got = p2.stdout.read(0x1000)
+        if not got:
+            break
+
+        if test_harness.DEBUG:
+            print(got.decode())
+        else:
+            output += got.decode()
+
+    p2.wait()
+
+    # Verilator writes its memory dump as it exits.
+    try:
+        p1.wait(timeout=VERILATOR_EXIT_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        test_harness.kill_gently(p1)
+
+    if verilator_log:
+        verilator_log.close()
+
+    if p2.returncode:
+        if verilator_log:
+            with open(verilator_log_file) as infile:
+                output += '\nVerilator output:\n' + infile.read()
+
+            if replay:
+                output += replay_divergence(image_file, trace_file, output,
+                                            check_args)
+
+        raise test_harness.TestException(
+            'FAIL: cosimulation mismatch\n' + output)
+
+    test_harness.assert_files_equal(verilator_mem_dump, emulator_mem_dump,
+                                    'final memory contents to not match',
+                                    report_all=True)
+
+    # The trace is only needed to debug failures.
+    if not text_trace and not measure_coverage:
+        os.remove(trace_file)
+
+    return parse_fp_stats(output)
+
+
+def parse_fp_stats(output):
+    """
+    Read the statistics of floating point results that the emulator prints
+    at the end of a run.
+
+    Returns:
+        Dictionary with the number of results that were 'exact', 'rounded'
+        (within the tolerance), different NaN values ('nan'), and undefined
+        ftoi conversions ('undefined'), the largest difference ('max_ulps'),
+        and a list of [ulps, count] for the rounded results ('ulps'). The
+        last entry of ulps includes all larger differences. None if output
+        doesn't have statistics.
+    """
+
+    match = FP_STATS_RE.search(output)
+    if match is None:
+        return None
+
+    stats = dict(zip(['exact', 'rounded', 'nan', 'undefined', 'max_ulps'],
+                     [int(value) for value in match.groups()]))
+    stats['ulps'] = [[int(ulps), int(count)] for ulps, count in FP_ULPS_RE.findall(output)]
+    return stats
+
+
+def find_replay_start(output):
+    """
+    Find where to start printing the verbose trace of a failed run: the last
+    checkpoint at or before the event the emulator reported as diverging.
+    Checkpoints are only printed while events match, so they don't show
+    where the run diverged themselves. If the emulator didn't report an
+    event (for example, if the trace ended early), this uses the last
+    checkpoint.
+
+    Args:
+        output: Output of the emulator from the failed run.
+
+    Returns:
+        Number of the first event to print.
+    """
+
+    events = [int(match.group(1)) for match in CHECKPOINT_RE.finditer(output)]
+    diverged = DIVERGED_RE.search(output)
+    if diverged:
+        events = [event for event in events if event <= int(diverged.group(1))]
+
+    return events[-1] if events else 0
+
+
+def replay_divergence(image_file, trace_file, output, check_args):
+    """
+    Run the emulator again on the saved trace of a failed run, printing the
+    verbose trace only from the last good checkpoint. This doesn't need to run
+    verilator again. check_args has the options that affect how the
+    emulator checks events (like -u), which must be the same as in the
+    original run.
+
+    Returns:
+        Message that says where the verbose output was written, to append
+        to the error.
+    """
+
+    start_event = find_replay_start(output)
+    replay_file = test_harness.WORK_DIR + '/replay.txt'
+    with open(trace_file, 'rb') as infile, open(replay_file, 'w') as outfile:
+        subprocess.call([test_harness.EMULATOR_PATH, '-m', 'cosim', '-B', '-v',
+                         '-k', str(CHECKPOINT_INTERVAL), '-w', str(start_event)]
+                        + check_args + [image_file], stdin=infile, stdout=outfile,
+                        stderr=subprocess.STDOUT)
+
+    message = '\nVerbose trace starting at event {} is in {}\n'.format(start_event,
+                                                                       replay_file)
+
+    # If the checkpoint hashes don't match the original run, the
+    # replay isn't running the same program.
+    with open(replay_file) as infile:
+        replay_checkpoints = CHECKPOINT_RE.findall(infile.read())
+
+    if replay_checkpoints != CHECKPOINT_RE.findall(output)[:len(replay_checkpoints)]:
+        message += 'Warning: replay checkpoints do not match the original run\n'
+
+    return message
+
+
+def run_cosimulation_test(source_file, *unused):
+    image_file = test_harness.build_program([source_file])
+    run_cosimulation(image_file)
@@ -0,0 +1,383 @@
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measures which instruction forms (templates in generate_random.py) random
+programs exercise, and adjusts the probability of each one toward the forms
+that haven't been covered. farm.py --tune uses this.
+
+Coverage comes from two places:
+- The binary trace of a cosimulation run (see cosim.py). Each event (register
+  writeback or store) is mapped back to the template its instruction was
+  generated from by its PC. Besides counting the events of each form, this
+  counts vector writebacks where only some lanes are enabled, and stores to
+  the last 64 bytes of a 4k page.
+- The number of times each performance counter event occurred in the
+  hardware (verilator +perfcounts), like cache misses and branches.
+
+Instructions that don't have side effects the trace shows, like branches
+that don't write a register, cache control instructions, and stores to
+devices, can't be measured this way, so their probabilities are only
+adjusted for performance counter events. All other forms that haven't been
+hit yet (which aren't in Coverage.forms) count as having zero hits.
+"""
+
+import re
+import struct
+import subprocess
+
+import generate_random
+import test_harness
+
+# Binary trace format (see tools/emulator/cosimulation.c)
+TRACE_FILE_HEADER = struct.Struct('<II')
+TRACE_RECORD_HEADER = struct.Struct('<BBBxI')
+TRACE_SWRITEBACK = 1
+TRACE_VWRITEBACK = 2
+TRACE_STORE = 3
+TRACE_INTERRUPT = 4
+TRACE_HALT = 5
+TRACE_PAYLOAD_LENGTH = {
+    TRACE_SWRITEBACK: 4,
+    TRACE_VWRITEBACK: 4 + 16 * 4,
+    TRACE_STORE: 4 + 8 + 16 * 4,
+    TRACE_INTERRUPT: 0,
+    TRACE_HALT: 0
+}
+
+PAGE_SIZE = 0x1000
+PAGE_EDGE_BYTES = 64
+
+# Names of the bits of perf_events in hardware/core/nyuzi.sv, for core 0 (the
+# order of the signals in the assignments to l2_perf_events in l2_cache.sv and
+# core_perf_events in core.sv, reversed).
+PERF_EVENT_NAMES = [
+    'l2_writeback',
+    'l2_miss',
+    'l2_hit',
+    'interrupt',
+    'store_rollback',
+    'store',
+    'instruction_retire',
+    'instruction_issue',
+    'icache_miss',
+    'icache_hit',
+    'itlb_miss',
+    'dcache_miss',
+    'dcache_hit',
+    'dtlb_miss',
+    'uncond_branch',
+    'cond_branch_taken',
+    'cond_branch_not_taken'
+]
+
+# Pipeline events that the instruction mix affects, and the type of
+# instruction (in GENERATE_FUNCS) that causes them. Others, like TLB misses
+# and interrupts, depend on how the program is set up.
+PERF_EVENT_FORMS = {
+    'l2_writeback': 'memory_access_forms',
+    'l2_miss': 'memory_access_forms',
+    'store_rollback': 'memory_access_forms',
+    'dcache_miss': 'memory_access_forms',
+    'icache_miss': 'cache_control_forms',
+    'uncond_branch': 'branch_forms',
+    'cond_branch_taken': 'branch_forms',
+    'cond_branch_not_taken': 'branch_forms'
+}
+
+PERF_EVENT_RE = re.compile(r'perf event (\d+) (\d+)')
+THREAD_SYMBOL_RE = re.compile(r'^([0-9a-fA-F]+)\s.*\sstart_thread(\d+)$', re.MULTILINE)
+
+# A form is covered once it has been hit this many times (summed over all
+# programs). Forms that have been hit less often have their probability
+# multiplied by up to MAX_FORM_BOOST. Types of instructions that cause a
+# pipeline event that never occurred get PERF_EVENT_BOOST.
+FORM_HIT_TARGET = 100
+MAX_FORM_BOOST = 8.0
+PERF_EVENT_BOOST = 2.0
+
+
+class Coverage(object):
+    """
+    Coverage of one or more programs. This can be converted to and from a
+    dictionary, so it can be saved as JSON.
+    """
+
+    def __init__(self, values=None):
+        if values is None:
+            values = {}
+
+        self.programs = values.get('programs', 0)
+
+        # Map of template to dictionary of counts ('events',
+        # 'partial_mask', 'page_edge')
+        self.forms = values.get('forms', {})
+
+        # Map of event name (PERF_EVENT_NAMES) to count
+        self.perf_events = values.get('perf_events', {})
+
+    def form_counts(self, template):
+        """Return the counts for a template, adding them if needed"""
+
+        if template not in self.forms:
+            self.forms[template] = {'events': 0, 'partial_mask': 0, 'page_edge': 0}
+
+        return self.forms[template]
+
+    def total(self, count_name):
+        """Return the sum of one of the form counts over all forms"""
+
+        return sum(counts[count_name] for counts in self.forms.values())
+
+    def merge(self, other):
+        """Add the counts from another Coverage object to this one"""
+
+        self.programs += other.programs
+        for template, counts in other.forms.items():
+            form_counts = self.form_counts(template)
+            for name, count in counts.items():
+                form_counts[name] += count
+
+        for name, count in other.perf_events.items():
+            self.perf_events[name] = self.perf_events.get(name, 0) + count
+
+    def to_dict(self):
+        return {
+            'programs': self.programs,
+            'forms': self.forms,
+            'perf_events': self.perf_events
+        }
+
+
+def read_trace(filename):
+    """
+    Read a binary trace file written by verilator (+tracefile).
+
+    Returns:
+        Generator that yields (record type, pc, mask, address) for each
+        record. mask is only valid for vector writebacks and address for
+        stores.
+    """
+
+    with open(filename, 'rb') as infile:
+        data = infile.read()
+
+    offset = TRACE_FILE_HEADER.size
+    while offset + TRACE_RECORD_HEADER.size <= len(data):
+        record_type, _, _, pc = TRACE_RECORD_HEADER.unpack_from(data, offset)
+        offset += TRACE_RECORD_HEADER.size
+        if record_type not in TRACE_PAYLOAD_LENGTH:
+            raise test_harness.TestException(
+                'bad record type {} in {}'.format(record_type, filename))
+
+        mask = 0
+        address = 0
+        if record_type == TRACE_VWRITEBACK:
+            mask, = struct.unpack_from('<I', data, offset)
+        elif record_type == TRACE_STORE:
+            address, = struct.unpack_from('<I', data, offset)
+
+        offset += TRACE_PAYLOAD_LENGTH[record_type]
+        yield record_type, pc, mask, address
+
+
+def find_thread_starts(elf_file):
+    """
+    Return a list of the addresses of the instruction stream of each thread
+    in a generated program, from the start_thread<n> symbols.
+    """
+
+    symbols = subprocess.check_output([test_harness.COMPILER_DIR + 'llvm-objdump',
+                                       '-t', elf_file]).decode()
+    starts = {int(thread): int(address, 16)
+              for address, thread in THREAD_SYMBOL_RE.findall(symbols)}
+    return [starts[thread] for thread in range(len(starts))]
+
+
+def map_form_addresses(thread_starts, templates, forms):
+    """
+    Return a dictionary that maps the address of each generated instruction
+    to its template.
+
+    Args:
+        thread_starts: From find_thread_starts
+        templates: Templates from build_instruction_table
+        forms: List of template indices for each thread, from the forms
+            argument of generate_test.
+    """
+
+    # Some templates have more than one instruction (for example, a membar
+    # before a load_sync). These map all of their addresses to the template.
+    lengths = [template.count('\n') + 1 for template in templates]
+    form_addresses = {}
+    for address, thread_forms in zip(thread_starts, forms):
+        for index in thread_forms:
+            for _ in range(lengths[index]):
+                form_addresses[address] = templates[index]
+                address += 4
+
+    return form_addresses
+
+
+def collect_coverage(trace_file, verilator_log, elf_file, templates, forms):
+    """
+    Measure the coverage of one cosimulation run of a generated program.
+
+    Args:
+        trace_file: Binary trace saved by cosim.run_cosimulation
+        verilator_log: Output of verilator, which includes the performance
+            counter events if it was run with +perfcounts.
+        elf_file: Program that ran
+        templates: Templates from build_instruction_table
+        forms: From the forms argument of generate_test
+
+    Returns:
+        Coverage object
+    """
+
+    form_addresses = map_form_addresses(find_thread_starts(elf_file), templates, forms)
+    coverage = Coverage()
+    coverage.programs = 1
+    for record_type, pc, mask, address in read_trace(trace_file):
+        if record_type not in (TRACE_SWRITEBACK, TRACE_VWRITEBACK, TRACE_STORE):
+            continue
+
+        template = form_addresses.get(pc)
+        if template is None:
+            continue    # Setup code or interrupt handler
+
+        counts = coverage.form_counts(template)
+        counts['events'] += 1
+        if record_type == TRACE_VWRITEBACK and mask not in (0, 0xffff):
+            counts['partial_mask'] += 1
+        elif record_type == TRACE_STORE and address % PAGE_SIZE >= PAGE_SIZE - PAGE_EDGE_BYTES:
+            counts['page_edge'] += 1
+
+    with open(verilator_log) as infile:
+        for index, count in PERF_EVENT_RE.findall(infile.read()):
+            if int(index) < len(PERF_EVENT_NAMES):
+                coverage.perf_events[PERF_EVENT_NAMES[int(index)]] = int(count)
+
+    return coverage
+
+
+def measured_templates(generate_funcs=None):
+    """
+    Return the templates in the instruction mix that have a non-zero
+    probability and whose instructions have side effects the trace shows
+    (see form_hits).
+    """
+
+    untraced = set(template for _, template, _ in generate_random.cache_control_forms())
+    untraced.update(template for _, template, _ in generate_random.branch_forms()
+                    if not template.startswith('call'))   # call writes the link register
+    untraced.update(template for _, template, _ in generate_random.device_io_forms()
+                    if template.startswith('store'))
+
+    templates, _, cum_weights = generate_random.build_instruction_table(generate_funcs)
+    measured = []
+    last_weight = 0.0
+    for template, cum_weight in zip(templates, cum_weights):
+        if cum_weight > last_weight and template not in untraced and template not in measured:
+            measured.append(template)
+
+        last_weight = cum_weight
+
+    return measured
+
+
+def form_hits(template, coverage):
+    """
+    Return how many times a form has been exercised in the way that is
+    interesting for it:
+    - Page edge pointer forms: accesses near the end of a page (by any
+      instruction)
+    - Masked forms that write a vector register: writebacks where only some
+      lanes are enabled
+    - All others: events
+    """
+
+    if template in generate_random.PAGE_EDGE_POINTER_FORMS:
+        return coverage.total('page_edge')
+
+    counts = coverage.forms.get(template, {'events': 0, 'partial_mask': 0, 'page_edge': 0})
+    instruction = template.split('\n')[-1]
+    if '_mask' in instruction.split()[0] and not instruction.startswith('store'):
+        return counts['partial_mask']
+
+    return counts['events']
+
+
+def tune_weights(coverage, generate_funcs=None):
+    """
+    Compute adjustments to the probability of each template that favor the
+    ones that have been covered the least.
+
+    Args:
+        coverage: Coverage of the programs run so far
+        generate_funcs: Instruction mix the programs were generated with
+            (GENERATE_FUNCS if this is None)
+
+    Returns:
+        Dictionary of template to factor, for the form_weights argument of
+        generate_random.generate_test. Templates that aren't adjusted are
+        not included.
+    """
+
+    if generate_funcs is None:
+        generate_funcs = generate_random.GENERATE_FUNCS
+
+    weights = {}
+    for template in measured_templates(generate_funcs):
+        hits = form_hits(template, coverage)
+        if hits < FORM_HIT_TARGET:
+            weights[template] = 1.0 + (MAX_FORM_BOOST - 1.0) * (1.0 - hits / FORM_HIT_TARGET)
+
+    # Performance counter events are only available if verilator was run
+    # with +perfcounts.
+    if coverage.perf_events:
+        missing_types = set(func_name for event, func_name in PERF_EVENT_FORMS.items()
+                            if coverage.perf_events.get(event, 0) == 0)
+        for _, func in generate_funcs:
+            if func.__name__ in missing_types:
+                for _, template, _ in func():
+                    weights[template] = min(weights.get(template, 1.0) * PERF_EVENT_BOOST,
+                                            MAX_FORM_BOOST)
+
+    return {template: round(weight, 3) for template, weight in weights.items()}
+
+
+def summarize(coverage, num_forms=10, generate_funcs=None):
+    """
+    Return a list of lines that describe the least covered forms, including
+    those that were never hit.
+    """
+
+    templates = measured_templates(generate_funcs)
+    hits = sorted((form_hits(template, coverage), template) for template in templates)
+    lines = ['{} programs, {}/{} forms exercised'.format(
+        coverage.programs, sum(1 for count, _ in hits if count > 0), len(templates))]
+    if hits:
+        lines.append('least covered forms:')
+        lines += ['{:>10}  {}'.format(count, template.replace('\n\t\t', '; '))
+                  for count, template in hits[:num_forms]]
+
+    missing_events = [name for name in PERF_EVENT_NAMES
+                      if name in coverage.perf_events and coverage.perf_events[name] == 0]
+    if missing_events:
+        lines.append('performance events that never occurred: ' + ', '.join(missing_events))
+
+    return lines
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Runs many cosimulations concurrently, one per seed. With no program
+arguments, this generates a new random program for each seed (see
+generate_random.py), seeding the generator with it. With programs, it runs
+each of them once per seed. In both cases, the seed is also passed to
+verilator with +randseed.
+
+    ./farm.py -j 16 --seeds 1-1000
+    ./farm.py -j 16 --seeds 1-50,75 cache_stress.s
+
+This prints a table of the runs that diverged. The files for each failing
+run (memory dumps, and the emulator's output in failure.txt) are kept in
+tests/work/farm/<seed>-<program>/. Generated programs are large, so instead
+of keeping them, this records how to generate them again in manifest.json in
+the same directory (unless --keep is specified). To reproduce a failure with a
+generated program, run this in this directory:
+
+    ./generate_random.py --manifest ../work/farm/<seed>-random.s/manifest.json \
+        --regenerate random.s
+    ./runtest.py --randseed <seed> random.s
+
+With --tune, this measures the coverage of each generated program (see
+coverage.py) and runs the seeds in rounds. After each round, it adjusts the
+probability of each instruction form toward the forms that haven't been
+covered yet, and generates the programs of the next round with those
+weights. The coverage and the final weights are written to
+tests/work/farm/coverage.json, which generate_random.py --weights can use.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import traceback
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                    help='number of cosimulations to run at the same time')
+parser.add_argument('--seeds', default='1-8',
+                    help='seeds to run, as a comma separated list of numbers '
+                    'and inclusive ranges (for example, 1-100,250)')
+parser.add_argument('-n', type=int, default=60000,
+                    help='number of instructions per thread in generated programs')
+parser.add_argument('-t', type=int, default=4,
+                    help='number of threads in generated programs')
+parser.add_argument('-i', action='store_true',
+                    help='enable interrupts in generated programs')
+parser.add_argument('--keep', action='store_true',
+                    help='keep the files of runs that passed, and the '
+                    'generated programs of runs that failed')
+parser.add_argument('--tune', action='store_true',
+                    help='measure coverage, and adjust the instruction mix of '
+                    'generated programs toward forms that were not covered '
+                    'after each round')
+parser.add_argument('--round-size', type=int,
+                    help='number of seeds in each round with --tune (default '
+                    'is the number of jobs)')
+parser.add_argument('--fp-ulps', type=int,
+                    help='number of units in the last place floating point '
+                    'results can differ by (default is FP_ULP_TOLERANCE in '
+                    'cosim.py)')
+parser.add_argument('programs', nargs='*',
+                    help='programs to run with each seed, instead of '
+                    'generating them')
+args = parser.parse_args()
+
+# test_harness parses the command line when it is imported, and these
+# options aren't valid for it.
+del sys.argv[1:]
+
+sys.path.insert(0, '..')
+import cosim
+import coverage
+import generate_random
+import test_harness
+
+FARM_DIR = test_harness.WORK_DIR + 'farm/'
+COSIM_DIR = os.path.dirname(os.path.abspath(__file__))
+GENERATED_PROGRAM = 'random.s'
+COVERAGE_FILE = FARM_DIR + 'coverage.json'
+
+
+def parse_seeds(seed_list):
+    """Convert a string like '1-5,9' to a list of integers"""
+
+    seeds = []
+    for field in seed_list.split(','):
+        if '-' in field:
+            first, last = field.split('-')
+            seeds += range(int(first), int(last) + 1)
+        else:
+            seeds.append(int(field))
+
+    return seeds
+
+
+def summarize_failure(error):
+    """Pick the line of the failure message that describes the divergence"""
+
+    lines = error.strip().split('\n')
+    if lines[0].startswith('Test threw exception'):
+        return lines[-1]
+
+    for index, line in enumerate(lines):
+        if line.startswith('COSIM MISMATCH') and index + 1 < len(lines):
+            # The next line shows the expected side effect of the instruction
+            # (including its PC).
+            return line + ': ' + lines[index + 1]
+
+    for line in lines:
+        if line and not line.startswith('FAIL'):
+            return line
+
+    return error
+
+
+def run_job(job):
+    """
+    Entry point for pool processes. job is (seed, program, form_weights),
+    where program is None to generate one, and form_weights adjusts the
+    instruction mix of generated programs (see coverage.tune_weights).
+
+    Returns:
+        (seed, program name, error, duration, coverage, fp_stats). error is
+        None if the run passed. coverage is a coverage.Coverage object with
+        --tune, otherwise None. fp_stats is from cosim.run_cosimulation, or
+        None if the run failed.
+    """
+
+    seed, program, form_weights = job
+    program_name = os.path.basename(program) if program else GENERATED_PROGRAM
+    work_dir = FARM_DIR + '{}-{}/'.format(seed, program_name)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    test_harness.set_work_dir(work_dir)
+
+    start_time = time.monotonic()
+    generated = program is None
+    forms = []
+    trace_file = work_dir + 'trace.bin'
+    job_coverage = None
+    fp_stats = None
+    fp_ulp_tolerance = args.fp_ulps
+    if fp_ulp_tolerance is None:
+        fp_ulp_tolerance = cosim.FP_ULP_TOLERANCE
+
+    try:
+        if generated:
+            program = work_dir + GENERATED_PROGRAM
+            entry = generate_random.generate_test(program, args.n, args.t, args.i, seed,
+                                                  form_weights=form_weights, forms=forms)
+            generate_random.write_manifest(work_dir + 'manifest.json',
+                                           {GENERATED_PROGRAM: entry})
+
+        image_file = test_harness.build_program([program])
+        try:
+            fp_stats = cosim.run_cosimulation(image_file, randseed=seed,
+                                              measure_coverage=args.tune,
+                                              fp_ulp_tolerance=fp_ulp_tolerance)
+        finally:
+            # A failed run still covers the instructions before it diverged.
+            # With --debug, there is no binary trace. The trace is removed
+            # with the rest of the files if the run passed.
+            if args.tune and os.path.exists(trace_file):
+                templates = generate_random.build_instruction_table()[0]
+                job_coverage = coverage.collect_coverage(
+                    trace_file, work_dir + 'vsim.log', test_harness.ELF_FILE,
+                    templates, forms)
+
+        error = None
+    except test_harness.TestException as exc:
+        error = exc.args[0]
+    except Exception:  # pylint: disable=W0703
+        error = 'Test threw exception:\n' + traceback.format_exc()
+
+    if error is None and not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    elif error is not None:
+        with open(work_dir + 'failure.txt', 'w') as outfile:
+            outfile.write(error)
+
+        if generated and not args.keep and os.path.exists(program):
+            os.remove(program)
+
+    return (seed, program_name, error, time.monotonic() - start_time, job_coverage,
+            fp_stats)
+
+
+def add_fp_stats(total, stats):
+    """Add the floating point statistics of one run to the total"""
+
+    for name in ['exact', 'rounded', 'nan', 'undefined']:
+        total[name] = total.get(name, 0) + stats[name]
+
+    total['max_ulps'] = max(total.get('max_ulps', 0), stats['max_ulps'])
+
+
+def write_coverage(total_coverage, form_weights):
+    """Save the coverage and weights, so generate_random.py can use them"""
+
+    values = total_coverage.to_dict()
+    values['form_weights'] = form_weights
+    with open(COVERAGE_FILE, 'w') as outfile:
+        json.dump(values, outfile, indent=1, sort_keys=True)
+        outfile.write('\n')
+
+
+def main():
+    programs = [os.path.abspath(program) for program in args.programs]
+    if args.tune and programs:
+        print('--tune only works with generated programs')
+        sys.exit(1)
+
+    # Generated programs include files relative to this directory.
+    os.chdir(COSIM_DIR)
+    if not programs:
+        programs = [None]
+
+        # Each generated program is only built once, so caching it would
+        # just evict useful entries.
+        test_harness.args.no_build_cache = True
+
+    jobs = [(seed, program) for seed in parse_seeds(args.seeds)
+            for program in programs]
+
+    # Without --tune, all jobs run in a single round.
+    round_size = len(jobs)
+    if args.tune:
+        round_size = args.round_size or args.jobs
+
+    failures = []
+    total_coverage = coverage.Coverage()
+    total_fp_stats = {}
+    form_weights = {}
+    count = 0
+    start_time = time.monotonic()
+    pool = multiprocessing.get_context('fork').Pool(args.jobs)
+    try:
+        for round_start in range(0, len(jobs), round_size):
+            round_jobs = [(seed, program, form_weights) for seed, program
+                          in jobs[round_start:round_start + round_size]]
+            for (seed, program_name, error, duration, job_coverage,
+                 fp_stats) in pool.imap_unordered(run_job, round_jobs):
+                count += 1
+                status = 'PASS' if error is None else 'FAIL'
+                print('[{}/{}] seed {} {} {} ({:.1f}s)'.format(count, len(jobs), seed,
+                                                              program_name, status,
+                                                              duration))
+                sys.stdout.flush()
+                if error is not None:
+                    failures.append((seed, program_name, summarize_failure(error)))
+
+                if job_coverage is not None:
+                    total_coverage.merge(job_coverage)
+
+                if fp_stats is not None:
+                    add_fp_stats(total_fp_stats, fp_stats)
+
+            if args.tune:
+                form_weights = coverage.tune_weights(total_coverage)
+                print('adjusted the probability of {} instruction forms'.format(
+                    len(form_weights)))
+                write_coverage(total_coverage, form_weights)
+
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.exit(1)
+
+    pool.join()
+
+    if failures:
+        print('\n{:>10}  {:<20}  {}'.format('seed', 'program', 'divergence'))
+        for seed, program_name, summary in sorted(failures):
+            print('{:>10}  {:<20}  {}'.format(seed, program_name, summary))
+
+        print('\nFiles for failing runs are in ' + FARM_DIR)
+
+    if total_fp_stats:
+        print('floating point results: {exact} exact, {rounded} rounded differently '
+              '(up to {max_ulps} ULPs), {nan} different NaNs, {undefined} undefined '
+              'conversions'.format(**total_fp_stats))
+
+    if args.tune:
+        print('\n' + '\n'.join(coverage.summarize(total_coverage)))
+        print('Coverage and instruction form weights are in ' + COVERAGE_FILE)
+
+    print('{}/{} runs failed ({:.0f}s)'.format(len(failures), len(jobs),
+                                             time.monotonic() - start_time))
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -35,14 +35,20 @@
 
 
 import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
 import random
 import sys
 
+# Registers used as operands and destinations of arithmetic instructions
+ARITH_REGS = [str(reg) for reg in range(3, 9)]
 
-def generate_arith_reg():
-    """Return a random register number for an arithmetic operation"""
-
-    return random.randint(3, 8)
+# Instructions are generated from templates, which are formatted with four
+# random arithmetic registers ({0}-{3}, where {3} is used for masks) and an
+# immediate value ({4}).
 
 FP_FORMS = [
     ('s', 's', 's', ''),
@@ -76,50 +82,50 @@ BINARY_OPS = [
     'mulh_i',
     'mulh_u',
     'shuffle',
-    'getlane'
-
-    # Disable for now because there are still some rounding bugs that cause
-    # mismatches
-    #    'add_f',
-    #    'sub_f',
-    #   'mul_f'
+    'getlane',
+
+    # The hardware doesn't always round these the same way as the emulator,
+    # so cosimulation allows the results to differ slightly (see
+    # FP_ULP_TOLERANCE in cosim.py).
+    'add_f',
+    'sub_f',
+    'mul_f'
 ]
 
 
-def generate_binary_arith(outfile):
-    """Write a single binary arithmetic instruction to a file"""
-
-    mnemonic = random.choice(BINARY_OPS)
-    if mnemonic == 'shuffle':
-        typed = 'v'
-        typea = 'v'
-        typeb = 'v'
-        suffix = '' if random.randint(0, 1) == 0 else '_mask'
-    elif mnemonic == 'getlane':
-        typed = 's'
-        typea = 'v'
-        typeb = 's' if random.randint(0, 1) == 0 else 'i'
-        suffix = ''
-    elif mnemonic.endswith('_f'):
-        typed, typea, typeb, suffix = random.choice(FP_FORMS)
-    else:
-        typed, typea, typeb, suffix = random.choice(INT_FORMS)
-
-    dest = generate_arith_reg()
-    rega = generate_arith_reg()
-    regb = generate_arith_reg()
-    maskreg = generate_arith_reg()
-    opstr = '\t\t{}{} {}{}, '.format(mnemonic, suffix, typed, dest)
-    if suffix != '':
-        opstr += 's{}, '.format(maskreg)  # Add mask register
-
-    opstr += '{}{}, '.format(typea, rega)
-    if typeb == 'i':
-        opstr += str(random.randint(-0x7f, 0x7f))  # Immediate value
-    else:
-        opstr += '{}{}'.format(typeb, regb)
+def binary_arith_forms():
+    """
+    Return templates for binary arithmetic instructions, as a list of
+    (probability, template, immediate values or None)
+    """
+
+    forms = []
+    for mnemonic in BINARY_OPS:
+        if mnemonic == 'shuffle':
+            op_forms = [('v', 'v', 'v', ''), ('v', 'v', 'v', '_mask')]
+        elif mnemonic == 'getlane':
+            op_forms = [('s', 'v', 's', ''), ('s', 'v', 'i', '')]
+        elif mnemonic.endswith('_f'):
+            op_forms = FP_FORMS
+        else:
+            op_forms = INT_FORMS
+
+        for typed, typea, typeb, suffix in op_forms:
+            template = '{}{} {}{{0}}, '.format(mnemonic, suffix, typed)
+            if suffix != '':
+                template += 's{3}, '  # Add mask register
+
+            template += typea + '{1}, '
+            if typeb == 'i':
+                template += '{4}'
+                immediates = range(-0x7f, 0x80)
+            else:
+                template += typeb + '{2}'
+                immediates = None
 
-    outfile.write(opstr + '\n')
+            forms.append((1 / (len(BINARY_OPS) * len(op_forms)), template, immediates))
+
+    return forms
 
 UNARY_OPS = [
     'clz',
@@ -129,43 +135,38 @@ UNARY_OPS = [
     'sext_8',
     'sext_16',
     # See note above about floating point
-    #    'itof',
-    #    'ftoi'
+    'itof',
+    'ftoi'
 ]
 
 
-def generate_unary_arith(outfile):
-    """Write a single unary arithmetic instruction to a file"""
+def unary_arith_forms():
+    """Return templates for unary arithmetic instructions"""
 
-    mnemonic = random.choice(UNARY_OPS)
-    dest = generate_arith_reg()
-    rega = generate_arith_reg()
-    if mnemonic == 'movehi':
-        outfile.write('\t\tmovehi s{}, {}\n'.format(
-            dest, random.randint(0, 0x7ffff)))
-    else:
-        fmt = random.randint(0, 3)
-        if mnemonic == 'move' and random.randint(0, 1) == 0:
-            # Move with immediate value
-            if fmt == 0:
-                maskreg = generate_arith_reg()
-                outfile.write('\t\t{}_mask  v{}, s{}, {}\n'.format
-                              (mnemonic, dest, maskreg, random.randint(-0xff, 0xff)))
-            elif fmt == 1:
-                outfile.write('\t\t{} v{}, {}\n'.format(mnemonic, dest,
-                                                        random.randint(-0xff, 0xff)))
-            else:
-                outfile.write('\t\t{} s{}, {}\n'.format(mnemonic, dest,
-                                                        random.randint(-0x1fff, 0x1fff)))
-        else:
-            if fmt == 0:
-                maskreg = generate_arith_reg()
-                outfile.write('\t\t{}_mask  v{}, s{}, v{}\n'.format
-                              (mnemonic, dest, maskreg, rega))
-            elif fmt == 1:
-                outfile.write('\t\t{} v{}, v{}\n'.format(mnemonic, dest, rega))
-            else:
-                outfile.write('\t\t{} s{}, s{}\n'.format(mnemonic, dest, rega))
+    op_prob = 1 / len(UNARY_OPS)
+    forms = []
+    for mnemonic in UNARY_OPS:
+        if mnemonic == 'movehi':
+            forms.append((op_prob, 'movehi s{0}, {4}', range(0, 0x80000)))
+            continue
+
+        # The register forms are used for all instructions except move, which
+        # also has immediate forms.
+        reg_prob = op_prob / 2 if mnemonic == 'move' else op_prob
+        forms += [
+            (reg_prob / 4, mnemonic + '_mask  v{0}, s{3}, v{1}', None),
+            (reg_prob / 4, mnemonic + ' v{0}, v{1}', None),
+            (reg_prob / 2, mnemonic + ' s{0}, s{1}', None)
+        ]
+
+        if mnemonic == 'move':
+            forms += [
+                (op_prob / 8, 'move_mask  v{0}, s{3}, {4}', range(-0xff, 0x100)),
+                (op_prob / 8, 'move v{0}, {4}', range(-0xff, 0x100)),
+                (op_prob / 4, 'move s{0}, {4}', range(-0x1fff, 0x2000))
+            ]
+
+    return forms
 
 COMPARE_FORMS = [
     ('v', 'v'),
@@ -184,32 +185,36 @@ COMPARE_OPS = [
     'ge_u',
     'lt_u',
     'le_u',
-    # Floating point comparisons don't handle specials correctly in all situations
-    #    'gt_f',
-    #    'ge_f',
-    #    'lt_f',
-    #    'le_f'
+    # These must match exactly. Random register values include NaNs and
+    # infinities, so this also checks how the hardware compares those.
+    'gt_f',
+    'ge_f',
+    'lt_f',
+    'le_f'
 ]
 
 
-def generate_compare(outfile):
-    """Write a single comparison instruction to a file"""
+def compare_forms():
+    """Return templates for comparison instructions"""
 
-    typea, typeb = random.choice(COMPARE_FORMS)
-    dest = generate_arith_reg()
-    rega = generate_arith_reg()
-    regb = generate_arith_reg()
-    opsuffix = random.choice(COMPARE_OPS)
-    opstr = '\t\tcmp{} s{}, {}{}, '.format(opsuffix, dest, typea, rega)
-    if random.randint(0, 1) == 0 and not opsuffix.endswith('_f'):
-        opstr += str(random.randint(-0x1ff, 0x1ff))  # Immediate value
-    else:
-        opstr += '{}{}'.format(typeb, regb)
+    prob = 1 / (len(COMPARE_FORMS) * len(COMPARE_OPS))
+    forms = []
+    for typea, typeb in COMPARE_FORMS:
+        for opsuffix in COMPARE_OPS:
+            template = 'cmp{} s{{0}}, {}{{1}}, '.format(opsuffix, typea)
+            if opsuffix.endswith('_f'):
+                forms.append((prob, template + typeb + '{2}', None))
+            else:
+                forms += [
+                    (prob / 2, template + '{4}', range(-0x1ff, 0x200)),  # Immediate value
+                    (prob / 2, template + typeb + '{2}', None)
+                ]
 
-    outfile.write(opstr + '\n')
+    return forms
 
 LOAD_OPS = [
     ('_32', 4),
+    ('_sync', 4),
     ('_s16', 2),
     ('_u16', 2),
     ('_s8', 1),
@@ -223,69 +228,52 @@ STORE_OPS = [
 ]
 
 
-def generate_memory_access(outfile):
-    """ Write a random single memory load or store instruction to the file"""
+def memory_access_forms():
+    """Return templates for memory loads and stores"""
+
+    forms = []
 
     # v0/s0 represent the shared segment, which is read only
     # v1/s1 represent the private segment, which is read/write
-    ptr_reg = random.randint(0, 1)
-
-    opstr = 'load' if ptr_reg == 0 or random.randint(0, 1) else 'store'
-
-    op_type = random.randint(0, 2)
-    if op_type == 0:
-        # Block vector
-        offset = random.randint(0, 16) * 64
-        opstr += '_v v{}, {}(s{})'.format(generate_arith_reg(),
-                                          offset, ptr_reg)
-    elif op_type == 1:
-        # Scatter/gather
-        offset = random.randint(0, 16) * 4
-        if opstr == 'load':
-            opstr += '_gath'
-        else:
-            opstr += '_scat'
-
-        mask_type = random.randint(0, 1)
-        if mask_type == 1:
-            opstr += '_mask'
+    for ptr_reg, opstr, prob in [(0, 'load', 0.5), (1, 'load', 0.25), (1, 'store', 0.25)]:
+        # Each of these types is equally likely: block vector,
+        # scatter/gather, and scalar.
+        prob /= 3
+        forms.append((prob, '{}_v v{{0}}, {{4}}(s{})'.format(opstr, ptr_reg),
+                      range(0, 17 * 64, 64)))
 
-        opstr += ' v{}'.format(generate_arith_reg())
-        if mask_type:
-            opstr += ', s{}'.format(generate_arith_reg())
+        gather_op = opstr + ('_gath' if opstr == 'load' else '_scat')
+        forms += [
+            (prob / 2, '{} v{{0}}, {{4}}(v{})'.format(gather_op, ptr_reg), range(0, 17 * 4, 4)),
+            (prob / 2, '{}_mask v{{0}}, s{{3}}, {{4}}(v{})'.format(gather_op, ptr_reg),
+             range(0, 17 * 4, 4))
+        ]
 
-        opstr += ', {}(v{})'.format(offset, ptr_reg)
-    else:
-        # Scalar
-        if opstr == 'load':
-            suffix, align = random.choice(LOAD_OPS)
-        else:
-            suffix, align = random.choice(STORE_OPS)
+        scalar_ops = LOAD_OPS if opstr == 'load' else STORE_OPS
+        for suffix, align in scalar_ops:
+            template = '{}{} s{{0}}, {{4}}(s{})'.format(opstr, suffix, ptr_reg)
 
-        # Because we don't model the store queue in the emulator,
-        # a store can invalidate a synchronized load that is issued subsequently.
-        # A membar guarantees order.
-        if opstr == 'load' and suffix == '_sync':
-            opstr = 'membar\n\t\t' + opstr
+            # Because we don't model the store queue in the emulator,
+            # a store can invalidate a synchronized load that is issued subsequently.
+            # A membar guarantees order.
+            if opstr == 'load' and suffix == '_sync':
+                template = 'membar\n\t\t' + template
 
-        offset = random.randint(0, 16) * align
-        opstr += '{} s{}, {}(s{})'.format(suffix, generate_arith_reg(),
-                                          offset, ptr_reg)
+            forms.append((prob / len(scalar_ops), template, range(0, 17 * align, align)))
 
-    outfile.write('\t\t' + opstr + '\n')
+    return forms
 
 
-def generate_device_io(outfile):
+def device_io_forms():
     """
-    Write a random single memory load or store instruction that accesses
-    device space (0xffff0000-0xffffffff) to the file.
+    Return templates for loads and stores that access device space
+    (0xffff0000-0xffffffff).
     """
 
-    if random.randint(0, 1):
-        outfile.write('\t\tload_32 s{}, {}(s9)\n'.format(
-            generate_arith_reg(), random.randint(0, 1) * 4))
-    else:
-        outfile.write('\t\tstore_32 s{}, (s9)\n'.format(generate_arith_reg()))
+    return [
+        (0.5, 'load_32 s{0}, {4}(s9)', (0, 4)),
+        (0.5, 'store_32 s{0}, (s9)', None)
+    ]
 
 BRANCH_TYPES = [
     ('bz', True),
@@ -295,33 +283,46 @@ BRANCH_TYPES = [
 ]
 
 
-def generate_branch(outfile):
+def branch_forms():
     """
-    Write a single branch instruction to outfile. This will use a relative
-    forward branch to an anonymous label 1-6 instructions away.
+    Return templates for branch instructions. These use a relative forward
+    branch to an anonymous label 1-6 instructions away.
     """
 
-    branch_type, is_cond = random.choice(BRANCH_TYPES)
-    if is_cond:
-        outfile.write('\t\t{} s{}, {}f\n'.format(
-            branch_type, generate_arith_reg(), random.randint(1, 6)))
-    else:
-        outfile.write('\t\t{} {}f\n'.format(branch_type, random.randint(1, 6)))
+    forms = []
+    for branch_type, is_cond in BRANCH_TYPES:
+        if is_cond:
+            template = branch_type + ' s{0}, {4}f'
+        else:
+            template = branch_type + ' {4}f'
+
+        forms.append((1 / len(BRANCH_TYPES), template, range(1, 7)))
 
+    return forms
 
-def generate_computed_pointer(outfile):
+
+# Pointer forms that point near the end of the first 4k page of the private
+# segment, so accesses (especially gathers and scatters, which add an offset
+# to each lane) cross into the next page. These use sub_i with negative
+# offsets so the templates are distinct from the other pointer forms, which
+# coverage.py relies on.
+PAGE_EDGE_POINTER_FORMS = [
+    'sub_i s1, s2, {4}',
+    'sub_i v1, v2, {4}'
+]
+
+
+def computed_pointer_forms():
     """
-    Generate an arithmetic instruction that writes to one of the special
-    'computed pointer' registers. These are guaranteed to be valid memory
-    locations
+    Return templates for arithmetic instructions that write to one of the
+    special 'computed pointer' registers. These are guaranteed to be valid
+    memory locations.
     """
 
-    if random.randint(0, 1) == 0:
-        outfile.write('\t\tadd_i s1, s2, {}\n'.format(
-            random.randint(0, 16) * 64))
-    else:
-        outfile.write('\t\tadd_i v1, v2, {}\n'.format(
-            random.randint(0, 16) * 64))
+    return [
+        (0.4, 'add_i s1, s2, {4}', range(0, 17 * 64, 64)),
+        (0.4, 'add_i v1, v2, {4}', range(0, 17 * 64, 64))
+    ] + [(0.1, template, range(-0xfc0, -0xeff, 64)) for template in PAGE_EDGE_POINTER_FORMS]
 
 CACHE_CONTROL_INSTRS = [
     'dflush s1',
@@ -330,28 +331,164 @@ CACHE_CONTROL_INSTRS = [
 ]
 
 
-def generate_cache_control(outfile):
-    """Generate a single cache control instruction"""
+def cache_control_forms():
+    """Return templates for cache control instructions"""
 
-    outfile.write('\t\t{}\n'.format(random.choice(CACHE_CONTROL_INSTRS)))
+    return [(1 / len(CACHE_CONTROL_INSTRS), instr, None)
+            for instr in CACHE_CONTROL_INSTRS]
 
+# Probability of each type of instruction. These are checked in order, and
+# the last entry gets whatever probability remains.
 GENERATE_FUNCS = [
-    (0.1, generate_computed_pointer),
-    (0.5, generate_binary_arith),
-    (0.05, generate_unary_arith),
-    (0.1, generate_compare),
-    (0.2, generate_memory_access),
-    (0.01, generate_device_io),
-    (0.03, generate_cache_control),
-    (1.0, generate_branch),
+    (0.1, computed_pointer_forms),
+    (0.5, binary_arith_forms),
+    (0.05, unary_arith_forms),
+    (0.1, compare_forms),
+    (0.2, memory_access_forms),
+    (0.01, device_io_forms),
+    (0.03, cache_control_forms),
+    (1.0, branch_forms),
 ]
 
+# Labels of branch targets, in the order instructions are labeled
+LABEL_PREFIXES = ['{}:\t\t'.format(label) for label in [2, 3, 4, 5, 6, 1]]
+
+
+def build_instruction_table(generate_funcs=None, form_weights=None):
+    """
+    Combine the templates of all instruction types into one table, so the
+    templates for a whole instruction stream can be chosen at once.
+
+    Args:
+        generate_funcs: List of (probability, function) like GENERATE_FUNCS,
+            which is used if this is None.
+        form_weights: Dictionary of template to a factor to multiply its
+            probability by (see coverage.tune_weights). Templates that are
+            not in it are unchanged.
+
+    Returns:
+        (templates, immediate values, cumulative probabilities). Each is a
+        list with an entry per template.
+    """
+
+    if generate_funcs is None:
+        generate_funcs = GENERATE_FUNCS
+
+    if form_weights is None:
+        form_weights = {}
+
+    templates = []
+    immediates = []
+    cum_weights = []
+    total_prob = 0.0
+    cumul_weight = 0.0
+    for prob, func in generate_funcs:
+        # Clamp so the total probability is 1 (before form_weights, which
+        # random.choices doesn't require to add up to anything in particular)
+        prob = min(prob, 1.0 - total_prob)
+        total_prob += prob
+        for form_prob, template, form_immediates in func():
+            cumul_weight += prob * form_prob * form_weights.get(template, 1.0)
+            templates.append(template)
+            immediates.append(form_immediates)
+            cum_weights.append(cumul_weight)
 
-def generate_test(filename):
-    """Write a complete assembly file with a pseudorandom instruction stream"""
+    return templates, immediates, cum_weights
 
+
+def generate_instructions(rng, num_instructions, table, forms=None):
+    """
+    Return a random instruction stream as a string, with each instruction
+    on a line labeled for branches (see branch_forms).
+
+    Args:
+        rng: random.Random instance to draw from
+        num_instructions: Number of instructions to generate
+        table: from build_instruction_table
+        forms: If this is not None, the index in the table of the template
+            of each instruction is appended to it.
+    """
+
+    templates, immediates, cum_weights = table
+
+    # Draw the template indices and register operands for the whole stream at
+    # once, which is much faster than drawing each one separately.
+    indices = rng.choices(range(len(templates)), cum_weights=cum_weights,
+                          k=num_instructions)
+    if forms is not None:
+        forms.extend(indices)
+
+    regs = rng.choices(ARITH_REGS, k=num_instructions * 4)
+    rand = rng.random
+    lines = []
+    append = lines.append
+    for reg_idx, index, prefix in zip(range(0, num_instructions * 4, 4), indices,
+                                      itertools.cycle(LABEL_PREFIXES)):
+        values = immediates[index]
+        immediate = values[int(rand() * len(values))] if values else None
+        append(prefix + templates[index].format(regs[reg_idx], regs[reg_idx + 1],
+                                                regs[reg_idx + 2], regs[reg_idx + 3],
+                                                immediate))
+
+    return '\n'.join(lines)
+
+
+def table_hash(table):
+    """
+    Return a hash of an instruction table. If this changes, the same seed
+    generates a different program.
+    """
+
+    return hashlib.sha256(repr(table).encode()).hexdigest()[:16]
+
+
+def derive_seed(seed, index):
+    """Return the seed for the file with this index, when generating several"""
+
+    digest = hashlib.sha256('{}:{}'.format(seed, index).encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def generate_test(filename, num_instructions=60000, num_threads=4,
+                  enable_interrupts=False, seed=None, generate_funcs=None,
+                  form_weights=None, forms=None):
+    """
+    Write a complete assembly file with a pseudorandom instruction stream.
+
+    Args:
+        filename: Path of the assembly file to create
+        num_instructions: Number of instructions to generate for each thread
+        num_threads: Number of threads that run the program (each gets its
+            own instruction stream)
+        enable_interrupts: If True, the program installs an interrupt handler
+            and enables interrupts
+        seed: The same seed (and other arguments) always generates the same
+            program. If None, this draws a seed from the random module, so
+            seeding that first also makes the program reproducible.
+        generate_funcs: Instruction mix, in the same form as GENERATE_FUNCS,
+            which is used if this is None.
+        form_weights: Adjustments to the probability of individual
+            templates (see build_instruction_table).
+        forms: If this is not None, a list with the table index of the
+            template of each instruction is appended to it for each thread
+            (see coverage.py).
+
+    Returns:
+        Manifest entry for the file, which has everything needed to generate
+        it again (see write_manifest and regenerate_test).
+    """
+
+    if seed is None:
+        seed = random.getrandbits(64)
+
+    if generate_funcs is None:
+        generate_funcs = GENERATE_FUNCS
+
+    rng = random.Random(seed)
+    table = build_instruction_table(generate_funcs, form_weights)
     with open(filename, 'w') as outfile:
-        outfile.write('# This file auto-generated by ' + sys.argv[0] + '''
+        outfile.write('# This file auto-generated by generate_random.py with seed '
+                      + str(seed) + '''
 
                 .include "../asm_macros.inc"
 
@@ -457,17 +594,11 @@ branch_addrs:   .long ''')
 
         for thread in range(num_threads):
             outfile.write('\nstart_thread{}:\n'.format(thread))
-            label_idx = 1
-            for i in range(num_instructions):
-                outfile.write('{}:'.format(label_idx + 1))
-                label_idx = (label_idx + 1) % 6
-                inst_type = random.random()
-                cumul_prob = 0.0
-                for prob, func in GENERATE_FUNCS:
-                    cumul_prob += prob
-                    if inst_type < cumul_prob:
-                        func(outfile)
-                        break
+            thread_forms = [] if forms is not None else None
+            outfile.write(generate_instructions(rng, num_instructions, table,
+                                                thread_forms))
+            if forms is not None:
+                forms.append(thread_forms)
 
             outfile.write('''
         1: nop
@@ -481,30 +612,152 @@ branch_addrs:   .long ''')
         halt_current_thread
         ''')
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-o', help='File to write result into',
-                    type=str, default='random.s')
-parser.add_argument('-m', help='Write multiple test files', type=int)
-parser.add_argument(
-    '-n',
-    help='number of instructions to generate per thread',
-    type=int,
-    default=60000)
-parser.add_argument('-i', help='Enable interrupts', action='store_true')
-parser.add_argument('-t', help='Number of threads', type=int, default=4)
-args = vars(parser.parse_args())
-num_instructions = args['n']
-enable_interrupts = args['i']
-num_threads = args['t']
-
-if (num_instructions + 120) * num_threads * 4 > 0x800000:
-    print('Instruction space exceeds available memory.')
-
-if args['m']:
-    for fileno in range(args['m']):
-        output_file = 'random{:04d}.s'.format(fileno)
-        print('generating ' + output_file)
-        generate_test(output_file)
-else:
-    print('generating ' + args['o'])
-    generate_test(args['o'])
+    return {
+        'seed': seed,
+        'num_instructions': num_instructions,
+        'num_threads': num_threads,
+        'enable_interrupts': enable_interrupts,
+        'instruction_mix': [[prob, func.__name__] for prob, func in generate_funcs],
+        'form_weights': form_weights or {},
+        'table_hash': table_hash(table)
+    }
+
+
+def read_manifest(filename):
+    """
+    Read a manifest written by write_manifest. Returns a dictionary
+    that maps program file names (without directory) to manifest entries.
+    """
+
+    with open(filename) as infile:
+        return json.load(infile)
+
+
+def write_manifest(filename, entries):
+    """
+    Add entries (a dictionary of file name to manifest entry, as returned by
+    generate_test) to a manifest file, creating it if it doesn't exist.
+    Entries for other files that are already in the manifest are kept.
+    """
+
+    manifest = read_manifest(filename) if os.path.exists(filename) else {}
+    manifest.update(entries)
+    with open(filename, 'w') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+        outfile.write('\n')
+
+
+def regenerate_test(entry, filename):
+    """
+    Generate a program again from its manifest entry.
+
+    Raises:
+        ValueError if the entry uses an instruction type that no longer
+        exists.
+    """
+
+    generate_funcs = []
+    for prob, func_name in entry['instruction_mix']:
+        func = globals().get(func_name)
+        if not callable(func):
+            raise ValueError('unknown instruction type ' + func_name)
+
+        generate_funcs.append((prob, func))
+
+    form_weights = entry.get('form_weights')
+    if table_hash(build_instruction_table(generate_funcs, form_weights)) != entry['table_hash']:
+        print('Warning: instruction templates have changed since {} was generated, '
+              'so it will be different'.format(filename))
+
+    return generate_test(filename, entry['num_instructions'], entry['num_threads'],
+                         entry['enable_interrupts'], entry['seed'], generate_funcs,
+                         form_weights)
+
+
+def _generate_file(job):
+    """Entry point for pool processes. job is the arguments to generate_test"""
+
+    return job[0], generate_test(*job)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', help='File to write result into',
+                        type=str, default='random.s')
+    parser.add_argument('-m', help='Write multiple test files', type=int)
+    parser.add_argument(
+        '-n',
+        help='number of instructions to generate per thread',
+        type=int,
+        default=60000)
+    parser.add_argument('-i', help='Enable interrupts', action='store_true')
+    parser.add_argument('-t', help='Number of threads', type=int, default=4)
+    parser.add_argument('-j', help='Number of files to generate at the same time (with -m)',
+                        type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int,
+                        help='Seed for the random generator. With -m, each file '
+                        'uses a different seed derived from this one. If this '
+                        'is not specified, a random seed is used')
+    parser.add_argument('--manifest', default='manifest.json',
+                        help='File to record how each program was generated in')
+    parser.add_argument('--regenerate', nargs='+', metavar='FILE',
+                        help='Generate these files again from the manifest, '
+                        'instead of generating new ones')
+    parser.add_argument('--weights', metavar='FILE',
+                        help='Adjust the probability of instruction templates '
+                        'using the form_weights in this file (the coverage.json '
+                        'written by farm.py --tune)')
+    args = vars(parser.parse_args())
+    num_instructions = args['n']
+    enable_interrupts = args['i']
+    num_threads = args['t']
+
+    if args['regenerate']:
+        manifest = read_manifest(args['manifest'])
+        for output_file in args['regenerate']:
+            name = os.path.basename(output_file)
+            if name not in manifest:
+                print('{} is not in {}'.format(name, args['manifest']))
+                sys.exit(1)
+
+            print('regenerating ' + output_file)
+            regenerate_test(manifest[name], output_file)
+
+        return
+
+    if (num_instructions + 120) * num_threads * 4 > 0x800000:
+        print('Instruction space exceeds available memory.')
+
+    seed = args['seed']
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(32)
+
+    form_weights = None
+    if args['weights']:
+        with open(args['weights']) as infile:
+            form_weights = json.load(infile)['form_weights']
+
+    print('seed {}'.format(seed))
+    if args['m']:
+        # Each file's seed depends only on its index, so the contents don't
+        # depend on the order the files are generated in.
+        jobs = [('random{:04d}.s'.format(fileno), num_instructions, num_threads,
+                 enable_interrupts, derive_seed(seed, fileno), None, form_weights)
+                for fileno in range(args['m'])]
+        entries = {}
+        with multiprocessing.Pool(args['j']) as pool:
+            for output_file, entry in pool.imap(_generate_file, jobs):
+                print('generated ' + output_file)
+                entries[output_file] = entry
+    else:
+        print('generating ' + args['o'])
+        entries = {
+            os.path.basename(args['o']): generate_test(args['o'], num_instructions,
+                                                       num_threads, enable_interrupts, seed,
+                                                       form_weights=form_weights)
+        }
+
+    write_manifest(args['manifest'], entries)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Reduces a random program (from generate_random.py) that fails in
+cosimulation to a smaller one that fails the same way, using delta
+debugging. It first removes whole threads, then ranges of instructions,
+running the candidates for each step concurrently:
+
+    ./minimize.py random0042.s
+    ./minimize.py -j 16 --randseed 1234 -o small.s random.s
+
+The setup code at the beginning of the program is kept. Removing
+instructions can't break branches, because they only branch forward to
+numeric labels, and the end of each thread has all of them.
+
+A candidate fails the same way if cosimulation detects a mismatch, if the
+hardware model doesn't finish, or if the final memory contents differ, as
+with the original program (--any-failure accepts any of these). This
+doesn't check that it is the same mismatch, so look at the result to make
+sure it is the same bug.
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                    help='number of cosimulations to run at the same time')
+parser.add_argument('-o', '--output',
+                    help='file to write the reduced program to (default is '
+                    '<program>.min.s)')
+parser.add_argument('--randseed', type=int,
+                    help='verilator random seed to run each candidate with')
+parser.add_argument('--any-failure', action='store_true',
+                    help='keep candidates that fail in any way, not just in the '
+                    'same way as the original program')
+parser.add_argument('program', help='failing program to reduce')
+args = parser.parse_args()
+
+# test_harness parses the command line when it is imported, and these
+# options aren't valid for it.
+del sys.argv[1:]
+
+sys.path.insert(0, '..')
+import cosim
+import test_harness
+
+MINIMIZE_DIR = test_harness.WORK_DIR + 'minimize/'
+COSIM_DIR = os.path.dirname(os.path.abspath(__file__))
+THREAD_START_RE = re.compile(r'start_thread(\d+):$')
+INSTRUCTION_RE = re.compile(r'[1-6]:\t')
+
+# Program being reduced (a RandomProgram). This is global so pool processes
+# inherit it instead of receiving it with each candidate.
+program = None
+
+
+class RandomProgram(object):
+    """
+    A generated program, split into the setup code at the beginning, and
+    the instructions and ending code (nops and halt) of each thread.
+    """
+
+    def __init__(self, filename):
+        self.header = []
+        self.threads = []
+        with open(filename) as infile:
+            for line in infile:
+                if THREAD_START_RE.match(line):
+                    self.threads.append(([], []))
+                elif not self.threads:
+                    self.header.append(line)
+                elif INSTRUCTION_RE.match(line) and not self.threads[-1][1]:
+                    self.threads[-1][0].append(line)
+                elif line.startswith('\t\t') and self.threads[-1][0] and not self.threads[-1][1]:
+                    # Some instructions are generated with another one
+                    # before them (for example, membar), which is on its own
+                    # line without a label. Keep them together.
+                    self.threads[-1][0][-1] += line
+                else:
+                    self.threads[-1][1].append(line)
+
+        if not self.threads:
+            raise test_harness.TestException(
+                filename + ' does not look like a program from generate_random.py')
+
+    def instructions(self):
+        """Return all instructions, as a list of (thread, index)"""
+
+        return [(thread, index) for thread, (instructions, _) in enumerate(self.threads)
+                for index in range(len(instructions))]
+
+    def write(self, filename, keep):
+        """Write the program, with only the instructions in keep (a set)"""
+
+        with open(filename, 'w') as outfile:
+            outfile.write(''.join(self.header))
+            for thread, (instructions, ending) in enumerate(self.threads):
+                outfile.write('start_thread{}:\n'.format(thread))
+                outfile.write(''.join(line for index, line in enumerate(instructions)
+                                      if (thread, index) in keep))
+                outfile.write(''.join(ending))
+
+
+def failure_kind(error):
+    """Classify the message of a failed cosimulation"""
+
+    if error.startswith('Compilation failed'):
+        return None     # Not a hardware problem
+    elif 'COSIM MISMATCH' in error:
+        return 'mismatch'
+    elif 'program did not finish normally' in error:
+        return 'did not finish'
+    elif error.startswith('FAIL: cosimulation mismatch'):
+        return 'emulator error'
+    elif 'final memory contents' in error:
+        return 'memory'
+
+    return 'other'
+
+
+def run_candidate(job):
+    """
+    Entry point for pool processes. job is (candidate number, instructions
+    to keep).
+
+    Returns:
+        Kind of failure (see failure_kind), or None if the candidate passed.
+    """
+
+    number, keep = job
+    work_dir = MINIMIZE_DIR + '{}/'.format(number)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    test_harness.set_work_dir(work_dir)
+    source_file = work_dir + 'candidate.s'
+    program.write(source_file, set(keep))
+    try:
+        image_file = test_harness.build_program([source_file])
+        cosim.run_cosimulation(image_file, randseed=args.randseed, replay=False)
+        kind = None
+    except test_harness.TestException as exc:
+        kind = failure_kind(exc.args[0])
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return kind
+
+
+class Minimizer(object):
+    """Tracks the smallest failing set of instructions found so far"""
+
+    def __init__(self, pool, expected_kind):
+        self.pool = pool
+        self.expected_kind = expected_kind
+        self.candidate_count = 0
+
+    def first_failing(self, candidates):
+        """
+        Run candidates (lists of instructions to keep) concurrently.
+
+        Returns:
+            The first candidate in the list that fails the same way as the
+            original program, or None if none of them do.
+        """
+
+        jobs = [(self.candidate_count + index, candidate)
+                for index, candidate in enumerate(candidates)]
+        self.candidate_count += len(candidates)
+        for candidate, kind in zip(candidates, self.pool.map(run_candidate, jobs)):
+            if kind is not None and (args.any_failure or kind == self.expected_kind):
+                return candidate
+
+        return None
+
+    def remove_threads(self, keep):
+        """Remove whole threads, as long as one is removable"""
+
+        while True:
+            threads = sorted(set(thread for thread, _ in keep))
+            if len(threads) < 2:
+                return keep
+
+            candidates = [[inst for inst in keep if inst[0] != thread]
+                          for thread in threads]
+            result = self.first_failing(candidates)
+            if result is None:
+                return keep
+
+            keep = result
+            print('removed a thread, {} instructions left'.format(len(keep)))
+
+    def remove_ranges(self, keep):
+        """
+        Delta debugging (ddmin): split the instructions into chunks, and
+        try keeping only one chunk, or everything but one chunk. If none of
+        those fail, split into smaller chunks. This ends when no single
+        instruction can be removed.
+        """
+
+        granularity = 2
+        while len(keep) >= 2:
+            chunk_size = (len(keep) + granularity - 1) // granularity
+            chunks = [keep[start:start + chunk_size]
+                      for start in range(0, len(keep), chunk_size)]
+            complements = [keep[:start] + keep[start + chunk_size:]
+                           for start in range(0, len(keep), chunk_size)]
+
+            # Prefer subsets, which reduce the program the most.
+            candidates = chunks + complements if len(chunks) > 2 else complements
+            result = self.first_failing(candidates)
+            if result is not None:
+                if len(chunks) > 2 and len(result) <= chunk_size:
+                    granularity = 2
+                else:
+                    granularity = max(granularity - 1, 2)
+
+                keep = result
+                print('{} instructions left'.format(len(keep)))
+            elif granularity >= len(keep):
+                break
+            else:
+                granularity = min(granularity * 2, len(keep))
+
+        return keep
+
+
+def main():
+    global program
+
+    output_file = args.output
+    if output_file is None:
+        output_file = os.path.splitext(args.program)[0] + '.min.s'
+
+    output_file = os.path.abspath(output_file)
+    program = RandomProgram(args.program)
+
+    # Generated programs include files relative to this directory.
+    os.chdir(COSIM_DIR)
+
+    # Each candidate is only built once, so caching it would just evict
+    # useful entries.
+    test_harness.args.no_build_cache = True
+
+    start_time = time.monotonic()
+    keep = program.instructions()
+    pool = multiprocessing.get_context('fork').Pool(args.jobs)
+    try:
+        expected_kind = pool.apply(run_candidate, ((-1, keep),))
+        if expected_kind is None:
+            print('program does not fail')
+            pool.terminate()
+            sys.exit(1)
+
+        print('original program: {} instructions, failure is {}'.format(len(keep),
+                                                                         expected_kind))
+        minimizer = Minimizer(pool, expected_kind)
+        keep = minimizer.remove_threads(keep)
+        keep = minimizer.remove_ranges(keep)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.exit(1)
+
+    pool.join()
+    program.write(output_file, set(keep))
+    print('reduced to {} instructions in {} threads after {} runs ({:.0f}s)'.format(
+        len(keep), len(set(thread for thread, _ in keep)), minimizer.candidate_count,
+        time.monotonic() - start_time))
+    print('wrote ' + output_file)
+
+if __name__ == '__main__':
+    main()
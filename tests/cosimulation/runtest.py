@@ -15,71 +15,13 @@
 # limitations under the License.
 #
 
-import os
-import subprocess
 import sys
-import time
 
 sys.path.insert(0, '..')
+import cosim
 import test_harness
 
-
-VERILATOR_MEM_DUMP = test_harness.WORK_DIR + '/vmem.bin'
-EMULATOR_MEM_DUMP = test_harness.WORK_DIR + '/mmem.bin'
-
-
-def run_cosimulation_test(source_file, *unused):
-    verilator_args = [
-        test_harness.VSIM_PATH,
-        '+trace',
-        '+memdumpfile=' + VERILATOR_MEM_DUMP,
-        '+memdumpbase=800000',
-        '+memdumplen=400000',
-        '+autoflushl2'
-    ]
-
-    # XXX this should probably be a command line option in test_harness.py
-    if 'RANDSEED' in os.environ:
-        verilator_args += ['+randseed=' + os.environ['RANDSEED']]
-
-    emulator_args = [
-        test_harness.EMULATOR_PATH,
-        '-m',
-        'cosim',
-        '-d',
-        EMULATOR_MEM_DUMP + ',0x800000,0x400000'
-    ]
-
-    if test_harness.DEBUG:
-        emulator_args += ['-v']
-
-    hexfile = test_harness.build_program([source_file])
-    p1 = subprocess.Popen(
-        verilator_args + ['+bin=' + hexfile], stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(
-        emulator_args + [hexfile], stdin=p1.stdout, stdout=subprocess.PIPE)
-    output = ''
-    while True:
-        got = p2.stdout.read(0x1000)
-        if not got:
-            break
-
-        if test_harness.DEBUG:
-            print(got.decode())
-        else:
-            output += got.decode()
-
-    p2.wait()
-    time.sleep(1)  # Give verilator a chance to clean up
-    test_harness.kill_gently(p2) # Make sure verilator has exited
-    if p2.returncode:
-        raise test_harness.TestException(
-            'FAIL: cosimulation mismatch\n' + output)
-
-    test_harness.assert_files_equal(VERILATOR_MEM_DUMP, EMULATOR_MEM_DUMP,
-                                    'final memory contents to not match')
-
-test_harness.register_tests(run_cosimulation_test,
+test_harness.register_tests(cosim.run_cosimulation_test,
                             test_harness.find_files(('.s', '.S')), ['verilator'])
 
 test_harness.execute_tests()
@@ -24,40 +24,42 @@ sys.path.insert(0, '../..')
 import test_harness
 
 FILE_SIZE = 8192
-SOURCE_BLOCK_DEV = test_harness.WORK_DIR + '/bdevimage.bin'
-MEMDUMP = test_harness.WORK_DIR + '/memory.bin'
 
 
 @test_harness.test
 def sdmmc_read(_, target):
+    source_block_dev = test_harness.WORK_DIR + '/bdevimage.bin'
+    memdump = test_harness.WORK_DIR + '/memory.bin'
+
     # Create random file
-    with open(SOURCE_BLOCK_DEV, 'wb') as fsimage:
+    with open(source_block_dev, 'wb') as fsimage:
         fsimage.write(os.urandom(FILE_SIZE))
 
     test_harness.build_program(['sdmmc_read.c'])
     test_harness.run_program(
         target=target,
-        block_device=SOURCE_BLOCK_DEV,
-        dump_file=MEMDUMP,
+        block_device=source_block_dev,
+        dump_file=memdump,
         dump_base=0x200000,
         dump_length=FILE_SIZE,
         flush_l2=True)
 
-    test_harness.assert_files_equal(SOURCE_BLOCK_DEV, MEMDUMP, 'file mismatch')
+    test_harness.assert_files_equal(source_block_dev, memdump, 'file mismatch')
 
 @test_harness.test
 def sdmmc_write(_, target):
-    with open(SOURCE_BLOCK_DEV, 'wb') as fsimage:
+    source_block_dev = test_harness.WORK_DIR + '/bdevimage.bin'
+    with open(source_block_dev, 'wb') as fsimage:
         fsimage.write(b'\xcc' * 1536)
 
     test_harness.build_program(['sdmmc_write.c'])
     result = test_harness.run_program(
         target=target,
-        block_device=SOURCE_BLOCK_DEV)
+        block_device=source_block_dev)
     if 'FAIL' in result:
         raise test_harness.TestException('Test failed ' + result)
 
-    with open(SOURCE_BLOCK_DEV, 'rb') as fsimage:
+    with open(source_block_dev, 'rb') as fsimage:
         end_contents = fsimage.read()
 
     # Check contents. First block is not modified
@@ -15,7 +15,6 @@
 # limitations under the License.
 #
 
-import subprocess
 import sys
 
 sys.path.insert(0, '../..')
@@ -44,10 +43,8 @@ def uart_echo_test(*unused):
     ]
 
     in_str = 'THE QUICK brOwn FOX jumPED Over THE LAZY DOG\n'
-    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    out_str, _ = test_harness.TimedProcessRunner().communicate(process=process,
-        timeout=10, input=in_str.encode('ascii'))
-    out_str = out_str.decode()
+    out_str = test_harness.run_test_with_timeout(args, timeout=10,
+                                                 input=in_str.encode('ascii'))
     if 'the quick brown fox jumped over the lazy dog' not in out_str:
         raise test_harness.TestException('Subprocess returned incorrect result \"'
             + out_str + '"')
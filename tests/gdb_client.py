@@ -0,0 +1,342 @@
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Client for the GDB remote serial protocol, which the emulator supports in
+gdb mode (-m gdb). This is used by the remote-gdb tests, but doesn't depend
+on the test harness, so other scripts can use it to control the emulator:
+
+    with gdb_client.GDBClient.connect('localhost', 8000) as client:
+        client.start_no_ack_mode()
+        client.write_memory(0x1000, data)
+        client.request('c')
+        print(client.read_memory(0x1000, 16))
+
+The protocol is described here:
+https://sourceware.org/gdb/onlinedocs/gdb/Remote-Protocol.html
+"""
+
+import collections
+import re
+import socket
+
+# Largest packet to send to a target that doesn't report PacketSize in its
+# qSupported response.
+DEFAULT_PACKET_SIZE = 256
+
+# Characters that must be escaped in binary data
+_ESCAPED_CHARS_RE = re.compile(rb'[#$}*]')
+
+
+class GDBClientError(Exception):
+    """Raised for protocol errors and errors reported by the target"""
+    pass
+
+
+def checksum(body):
+    """Checksum of a packet body (bytes), as two hex digits (bytes)"""
+    return b'%02x' % (sum(body) & 0xff)
+
+
+def escape_binary(data):
+    """Escape binary data (bytes) for inclusion in a packet, like X"""
+
+    return _ESCAPED_CHARS_RE.sub(lambda match: bytes((ord('}'), match.group()[0] ^ 0x20)),
+                                 data)
+
+
+def _decode_body(body):
+    """Expand run length encoding in a received packet body"""
+
+    if b'*' not in body:
+        return body
+
+    result = bytearray()
+    index = 0
+    while index < len(body):
+        if body[index] == ord('*') and result:
+            # The next character is the repeat count plus 29
+            result += result[-1:] * (body[index + 1] - 29)
+            index += 2
+        else:
+            result.append(body[index])
+            index += 1
+
+    return bytes(result)
+
+
+class GDBClient(object):
+
+    """
+    Connection to a GDB remote protocol target. This supports __enter__
+    and __exit__ methods so it can be used in the 'with' construct to
+    close the socket automatically.
+
+    Reads from the socket are buffered, so receiving a packet usually takes
+    a single system call. Until start_no_ack_mode is called, each packet sent
+    must be acknowledged by the target, and this retransmits packets that the
+    target rejects. Requests can be pipelined with send_packet and
+    receive_packet: responses are received in the same order as requests.
+    """
+
+    def __init__(self, sock, debug=False):
+        self.sock = sock
+        self.debug = debug
+        self.ack_mode = True
+        self.packet_size = DEFAULT_PACKET_SIZE
+        self._buffer = bytearray()
+
+        # Packets that have been sent but not acknowledged yet (ack mode
+        # only), oldest first.
+        self._unacked = collections.deque()
+
+    @classmethod
+    def connect(cls, host, port, timeout=5, debug=False):
+        """Open a connection to a target listening on host:port"""
+
+        sock = socket.create_connection((host, port))
+        sock.settimeout(timeout)
+
+        # Each request is small and waits for a response, so don't delay
+        # sending it (Nagle's algorithm).
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(sock, debug)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def send_packet(self, body):
+        """
+        Send a packet containing body (str or bytes) to the target without
+        waiting for a response.
+        """
+
+        if isinstance(body, str):
+            body = body.encode()
+
+        if self.debug:
+            print('SEND: ' + body.decode(errors='replace'))
+
+        packet = b'$' + body + b'#' + checksum(body)
+        if self.ack_mode:
+            self._unacked.append(packet)
+
+        self.sock.sendall(packet)
+
+    def receive_packet(self):
+        """
+        Wait for the next packet from the target.
+
+        Returns:
+                The body of the packet, as bytes.
+
+        Raises:
+                GDBClientError if the packet is corrupted or the connection
+                is closed.
+        """
+
+        # Skip acknowledgements to find the start of the packet
+        while True:
+            char = self._read(1)
+            if char == b'$':
+                break
+            elif char == b'+':
+                if self._unacked:
+                    self._unacked.popleft()
+            elif char == b'-':
+                # Target didn't receive packet correctly, resend
+                if self._unacked:
+                    self.sock.sendall(self._unacked[0])
+            else:
+                raise GDBClientError('unexpected character ' + str(char))
+
+        body = self._read_until(b'#')
+        received_checksum = self._read(2)
+        if received_checksum.lower() != checksum(body):
+            if self.ack_mode:
+                self.sock.sendall(b'-')
+                return self.receive_packet()
+
+            raise GDBClientError('bad checksum on packet ' + str(body))
+
+        if self.ack_mode:
+            self.sock.sendall(b'+')
+
+        body = _decode_body(body)
+        if self.debug:
+            print('RECV: ' + body.decode(errors='replace'))
+
+        return body
+
+    def request(self, body):
+        """Send a packet and wait for the response, which is returned (bytes)"""
+
+        self.send_packet(body)
+        return self.receive_packet()
+
+    def request_all(self, bodies):
+        """
+        Send several packets at once, then wait for all of the responses.
+        This avoids waiting a round trip for each request.
+
+        Returns:
+                List of response bodies, in the same order as the requests.
+        """
+
+        for body in bodies:
+            self.send_packet(body)
+
+        return [self.receive_packet() for _ in bodies]
+
+    def start_no_ack_mode(self):
+        """
+        Ask the target to stop acknowledging packets (QStartNoAckMode), which
+        reduces the number of messages on the connection. Returns True if the
+        target supports this.
+        """
+
+        self.query_supported()
+        if self.request('QStartNoAckMode') != b'OK':
+            return False
+
+        self.ack_mode = False
+        self._unacked.clear()
+        return True
+
+    def query_supported(self):
+        """
+        Send qSupported, and set packet_size if the target reports it.
+
+        Returns:
+                Dictionary of the features the target reports. The value
+                is the string after '=', or True/False for features that end
+                with '+' or '-'.
+        """
+
+        features = {}
+        for feature in self.request('qSupported').decode().split(';'):
+            if '=' in feature:
+                name, value = feature.split('=', 1)
+                features[name] = value
+            elif feature.endswith('+') or feature.endswith('-'):
+                features[feature[:-1]] = feature.endswith('+')
+
+        if 'PacketSize' in features:
+            self.packet_size = int(features['PacketSize'], 16)
+
+        return features
+
+    def read_memory(self, address, length):
+        """
+        Read target memory with 'm' requests, which are split to fit in the
+        target's packet size and sent together.
+
+        Returns:
+                Contents of memory, as bytes.
+        """
+
+        # The response encodes each byte as two hex digits
+        chunk_size = self.packet_size // 2
+        requests = ['m{:x},{:x}'.format(chunk_address,
+                                        min(chunk_size, address + length - chunk_address))
+                    for chunk_address in range(address, address + length, chunk_size)]
+        data = bytearray()
+        for response in self.request_all(requests):
+            self._check_error(response)
+            data += bytes.fromhex(response.decode())
+
+        return bytes(data)
+
+    def write_memory(self, address, data):
+        """
+        Write data (bytes) to target memory with binary 'X' requests, which
+        are split to fit in the target's packet size and sent together.
+        """
+
+        # Leave room for the address and length, and assume the worst case
+        # where every byte needs to be escaped.
+        chunk_size = max((self.packet_size - 32) // 2, 1)
+        requests = []
+        for offset in range(0, len(data), chunk_size):
+            chunk = data[offset:offset + chunk_size]
+            requests.append('X{:x},{:x}:'.format(address + offset, len(chunk)).encode()
+                            + escape_binary(chunk))
+
+        for response in self.request_all(requests):
+            self._check_error(response)
+
+    def read_register(self, index):
+        """Read a register with 'p'. Returns its value as an integer"""
+
+        response = self.request('p{:x}'.format(index))
+        self._check_error(response)
+        return int.from_bytes(bytes.fromhex(response.decode()), 'little')
+
+    def write_register(self, index, value, size=4):
+        """Write a register with 'P'. size is the register width in bytes"""
+
+        response = self.request('P{:x}={}'.format(
+            index, value.to_bytes(size, 'little').hex()))
+        self._check_error(response)
+
+    @staticmethod
+    def _check_error(response):
+        if response == b'':
+            raise GDBClientError('request not supported by target')
+
+        if len(response) == 3 and response.startswith(b'E'):
+            raise GDBClientError('target returned error ' + response.decode())
+
+    def _fill_buffer(self):
+        try:
+            data = self.sock.recv(0x10000)
+        except socket.timeout:
+            raise GDBClientError('timed out waiting for response')
+
+        if not data:
+            raise GDBClientError('unexpected socket close')
+
+        self._buffer += data
+
+    def _read(self, length):
+        while len(self._buffer) < length:
+            self._fill_buffer()
+
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def _read_until(self, terminator):
+        """Read up to terminator, which is consumed but not returned"""
+
+        search_start = 0
+        while True:
+            index = self._buffer.find(terminator, search_start)
+            if index != -1:
+                break
+
+            search_start = len(self._buffer)
+            self._fill_buffer()
+
+        data = bytes(self._buffer[:index])
+        del self._buffer[:index + len(terminator)]
+        return data
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measures how fast the JTAG debugger library (tests/jtag_debugger.py) can
+access the verilator model: JTAG transfers per second, sent one at a time
+and batched, register access latency, and memory throughput. This prints the
+results and appends them to tests/cache/jtag_benchmark.jsonl, so they can be
+compared over time:
+
+    ./benchmark.py
+    ./benchmark.py --transfer-size 0x4000 --iterations 200
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--transfer-size', type=lambda value: int(value, 0),
+                    default=0x1000,
+                    help='number of bytes of memory to write and read')
+parser.add_argument('--iterations', type=int, default=100,
+                    help='number of requests for each latency measurement')
+args = parser.parse_args()
+
+# test_harness parses the command line when it is imported, and these
+# options aren't valid for it.
+del sys.argv[1:]
+
+sys.path.insert(0, '..')
+import jtag_debugger
+from jtag_fixture import JTAGTestFixture
+import jtag_protocol
+import test_harness
+
+BENCHMARK_HISTORY_FILE = test_harness.CACHE_DIR + 'jtag_benchmark.jsonl'
+MEMORY_BASE = 0x100000
+
+
+class CountingTransport(object):
+    """Passes transfers to the fixture, counting them"""
+
+    def __init__(self, fixture):
+        self.fixture = fixture
+        self.transfer_count = 0
+
+    def jtag_transfer_batch(self, transfers):
+        self.transfer_count += len(transfers)
+        return self.fixture.jtag_transfer_batch(transfers)
+
+
+def measure_transfer_rate(fixture, iterations, batched):
+    """Returns JTAG transfers per second"""
+
+    transfers = [(jtag_protocol.INST_TRANSFER_DATA, 32, index)
+                 for index in range(iterations)]
+    start_time = time.monotonic()
+    if batched:
+        fixture.jtag_transfer_batch(transfers)
+    else:
+        for transfer in transfers:
+            fixture.jtag_transfer(*transfer)
+
+    return iterations / (time.monotonic() - start_time)
+
+
+def measure_latency(func, iterations):
+    """Returns average time to call func, in milliseconds"""
+
+    start_time = time.monotonic()
+    for _ in range(iterations):
+        func()
+
+    return (time.monotonic() - start_time) * 1000 / iterations
+
+
+def main():
+    if not os.path.exists(test_harness.WORK_DIR):
+        os.makedirs(test_harness.WORK_DIR)
+
+    image_file = test_harness.build_program(['test_program.S'])
+    results = {
+        'timestamp': int(time.time()),
+        'transfer_size': args.transfer_size,
+        'transfers_per_sec': {},
+        'latency_ms': {},
+        'memory': {}
+    }
+
+    with JTAGTestFixture(image_file) as fixture:
+        for name, batched in [('single', False), ('batched', True)]:
+            rate = measure_transfer_rate(fixture, args.iterations, batched)
+            results['transfers_per_sec'][name] = rate
+            print('{:<24} {:>10.1f} transfers/s'.format(name + ' transfers', rate))
+
+        transport = CountingTransport(fixture)
+        debugger = jtag_debugger.JTAGDebugger(transport)
+        debugger.halt()
+        print()
+        for name, func in [
+                ('scalar register read', lambda: debugger.read_scalar_register(5)),
+                ('scalar register write', lambda: debugger.write_scalar_register(5, 0)),
+                ('vector register read', lambda: debugger.read_vector_register(5))]:
+            latency = measure_latency(func, args.iterations)
+            results['latency_ms'][name] = latency
+            print('{:<24} {:>10.2f} ms'.format(name, latency))
+
+        print()
+        data = os.urandom(args.transfer_size)
+        for name, func in [
+                ('write', lambda: debugger.write_memory(MEMORY_BASE, data)),
+                ('read', lambda: debugger.read_memory(MEMORY_BASE, len(data)))]:
+            transport.transfer_count = 0
+            start_time = time.monotonic()
+            read_data = func()
+            elapsed = time.monotonic() - start_time
+            if name == 'read' and read_data != data:
+                raise test_harness.TestException('memory mismatch')
+
+            results['memory'][name] = {
+                'bytes_per_sec': len(data) / elapsed,
+                'transfers_per_word': transport.transfer_count * 4 / len(data)
+            }
+            print('memory {:<17} {:>10.1f} bytes/s ({:.1f} transfers/word)'.format(
+                name, len(data) / elapsed, transport.transfer_count * 4 / len(data)))
+
+    if not os.path.exists(test_harness.CACHE_DIR):
+        os.makedirs(test_harness.CACHE_DIR)
+
+    with open(BENCHMARK_HISTORY_FILE, 'a') as outfile:
+        outfile.write(json.dumps(results) + '\n')
+
+if __name__ == '__main__':
+    main()
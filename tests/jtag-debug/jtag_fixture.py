@@ -0,0 +1,227 @@
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Test fixture that runs the verilator model with a JTAG socket (see
+hardware/testbench/jtag_socket.cpp) and sends JTAG transfers to it. This is
+used by runtest.py and benchmark.py in this directory, which add the tests
+directory to the module search path first.
+"""
+
+import socket
+import struct
+import subprocess
+from threading import Thread
+
+from jtag_protocol import INSTRUCTION_LENGTH, INST_SAME
+import test_harness
+
+RESPONSE_LENGTH = 12
+
+# Most transfers jtag_transfer_batch sends before reading responses. The
+# verilator model stops reading requests while its socket buffer for
+# responses is full, so this bounds how much can be queued in both directions.
+MAX_BATCH_SIZE = 256
+
+
+def mask_value(value, num_bits):
+    return value & ((1 << num_bits) - 1)
+
+
+class JTAGTestFixture(object):
+
+    """
+    Spawns the Verilator model and opens a socket to communicate with it
+    Supports __enter__ and __exit__ methods so it can be used in the 'with'
+    construct to automatically clean up after itself.
+    """
+
+    def __init__(self, image_file):
+        self.image_file = image_file
+        self.process = None
+        self.sock = None
+        self.output = ''
+        self.reader_thread = None
+        self.last_response = 0
+        self.port = None
+
+    def __enter__(self):
+        with test_harness.ReadySignal() as ready:
+            verilator_args = [
+                test_harness.VSIM_PATH,
+                '+bin=' + self.image_file,
+                '+jtag_port=0',    # Use any free port, so tests can run in parallel
+                '+readyfile=' + ready.path,
+                self.image_file
+            ]
+
+            self.process = ready.popen(verilator_args, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+
+            # Wait until the model is listening for connections
+            try:
+                self.port = int(ready.wait())
+                self.sock = socket.create_connection(('localhost', self.port))
+                self.sock.settimeout(5)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (test_harness.TestException, socket.error) as exc:
+                test_harness.kill_gently(self.process)
+                raise test_harness.TestException(
+                    'failed to connect to verilator model: ' + str(exc))
+
+        self.reader_thread = Thread(target=self._read_output)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+        return self
+
+    def __exit__(self, *unused):
+        test_harness.kill_gently(self.process)
+        if self.sock:
+            self.sock.close()
+
+    def jtag_transfer(self, instruction, data_length, data):
+        """
+        Shift an instruction and/or data to the target.
+        If instruction is set to INST_SAME, this will not shift an instruction
+        If data_length is zero, it will not shift any data. If both are set to
+        not transfer, it will initiate a reset of the target.
+        """
+
+        self.jtag_transfer_batch([(instruction, data_length, data)])
+
+    def jtag_transfer_batch(self, transfers):
+        """
+        Perform a sequence of transfers, sending all requests to the target
+        before waiting for any responses. This avoids a socket round trip
+        for each transfer, which matters for things like injecting a sequence
+        of instructions.
+
+        Args:
+            transfers: list of (instruction, data_length, data) tuples, with
+                the same meaning as the jtag_transfer parameters.
+
+        Returns:
+            List of the data shifted out for each transfer, in the same order.
+            last_response is also set to the last one, for expect_data.
+
+        Raises:
+            TestException if the target closes the connection.
+        """
+
+        responses = []
+        for start in range(0, len(transfers), MAX_BATCH_SIZE):
+            batch = transfers[start:start + MAX_BATCH_SIZE]
+            self.sock.sendall(b''.join(self._pack_request(*transfer)
+                                       for transfer in batch))
+            for (_, data_length, _), response_data in zip(
+                    batch, self._receive_responses(len(batch))):
+                _, response = struct.unpack('<IQ', response_data)
+                response = mask_value(response, data_length)
+                if test_harness.DEBUG:
+                    print('received JTAG response 0x{:x}'.format(response))
+
+                responses.append(response)
+
+        if responses:
+            self.last_response = responses[-1]
+
+        return responses
+
+    def _pack_request(self, instruction, data_length, data):
+        if test_harness.DEBUG:
+            print('Sending JTAG command 0x{:x} data 0x{:x}'.format(
+                instruction, data))
+
+        if instruction == INST_SAME:
+            instruction_length = 0
+            instruction = 0
+        else:
+            instruction_length = INSTRUCTION_LENGTH
+
+        return struct.pack('<BIBQ', instruction_length, instruction,
+                           data_length, data)
+
+    def _receive_responses(self, count):
+        """Read count responses, returning a list of 12 byte strings"""
+
+        expected_length = count * RESPONSE_LENGTH
+        response_data = b''
+        while len(response_data) < expected_length:
+            got = self.sock.recv(expected_length - len(response_data))
+            if not got:
+                raise test_harness.TestException(
+                    'error reading response:\n' + self.get_program_output())
+
+            response_data += got
+
+        return [response_data[offset:offset + RESPONSE_LENGTH]
+                for offset in range(0, expected_length, RESPONSE_LENGTH)]
+
+    def test_instruction_shift(self, value):
+        """
+        Shift a value through the instruction register, then capture
+        the bits that are shifted out and check that they match.
+        """
+
+        # Send an instruction that is twice as long as the instruction register.
+        # The first bits shifted in should come right back out in the high
+        # bits of the result.
+        self.sock.sendall(struct.pack('<BIBQ', INSTRUCTION_LENGTH * 2, value,
+                                      0, 0))
+        instr_response, _ = struct.unpack('<IQ', self._receive_responses(1)[0])
+        if instr_response != value << INSTRUCTION_LENGTH:
+            raise test_harness.TestException('invalid response: wanted {}, got {}'.format(
+                value, instr_response))
+
+    def get_program_output(self):
+        """
+        Return everything verilator printed to stdout before exiting.
+        This won't read anything if the program was killed (which is the
+        common case if the program didn't die with an assertion), but
+        we usually call in the case that it has exited with an error.
+        """
+        # Give the reader thread time to finish reading responses.
+        if self.reader_thread:
+            self.reader_thread.join(0.5)
+
+        return self.output
+
+    def expect_data(self, expected_data):
+        """
+        Throw an exception if the bits shifted out of TDO during the last data
+        transfer do not match the passed value
+        """
+        if self.last_response != expected_data:
+            raise test_harness.TestException('unexpected JTAG data response. Wanted {} got {}:\n{}'
+                                             .format(expected_data, self.last_response,
+                                                     self.get_program_output()))
+
+    def _read_output(self):
+        """
+        Read text that is printed by the verilator process to standard out.
+        This needs to happen on a separate thread to avoid blocking the
+        main thread. This seems to be the only way to do it portably in
+        python.
+        """
+        while True:
+            got = self.process.stdout.read(0x100)
+            if not got:
+                break
+
+            if test_harness.DEBUG:
+                print(got)
+
+            self.output += got.decode()
@@ -21,197 +21,29 @@ stub module that simulates a JTAG host. This test communicates with it over
 a socket, which allows sending and receiving data and instructions.
 """
 
-import socket
-import struct
-import subprocess
+import os
 import sys
-import time
-from threading import Thread
 
 sys.path.insert(0, '..')
+import jtag_debugger
+from jtag_fixture import JTAGTestFixture, MAX_BATCH_SIZE, mask_value
+from jtag_protocol import (INST_BYPASS, INST_CONTROL, INST_IDCODE, INST_INJECT_INST,
+                           INST_SAME, INST_STATUS, INST_TRANSFER_DATA,
+                           STATUS_READY, STATUS_ROLLED_BACK)
 import test_harness
 
-CONTROL_PORT = 8541
-INSTRUCTION_LENGTH = 4
 EXPECTED_IDCODE = 0x4d20dffb  # Derived from settings in hardware/core/config.sv
 
-# JTAG instructions
-INST_IDCODE = 0
-INST_EXTEST = 1
-INST_INTEST = 2
-INST_CONTROL = 3
-INST_INJECT_INST = 4
-INST_TRANSFER_DATA = 5
-INST_STATUS = 6
-INST_BYPASS = 15
-
-STATUS_READY = 0
-STATUS_ISSUED = 1
-STATUS_ROLLED_BACK = 2
-
-# When passed, does not shift instruction register
-INST_SAME = -1
-
 # XXX does not test TRST signal
 
 
-def mask_value(value, num_bits):
-    return value & ((1 << num_bits) - 1)
-
-
-class JTAGTestFixture(object):
-
-    """
-    Spawns the Verilator model and opens a socket to communicate with it
-    Supports __enter__ and __exit__ methods so it can be used in the 'with'
-    construct to automatically clean up after itself.
-    """
-
-    def __init__(self, hexfile):
-        self.hexfile = hexfile
-        self.process = None
-        self.sock = None
-        self.output = ''
-        self.reader_thread = None
-        self.last_response = 0
-
-    def __enter__(self):
-        verilator_args = [
-            test_harness.VSIM_PATH,
-            '+bin=' + self.hexfile,
-            '+jtag_port=' + str(CONTROL_PORT),
-            self.hexfile
-        ]
-
-        self.process = subprocess.Popen(verilator_args, stdout=subprocess.PIPE,
-                                        stderr=subprocess.STDOUT)
-
-        # The process may take a little time to start listening for incoming
-        # connections so retry a few times if it isn't ready yet.
-        for _ in range(10):
-            try:
-                time.sleep(0.3)
-                self.sock = socket.socket()
-                self.sock.connect(('localhost', CONTROL_PORT))
-                self.sock.settimeout(5)
-                break
-            except socket.error:
-                pass
-        else:
-            test_harness.kill_gently(self.process)
-            raise test_harness.TestException(
-                'failed to connect to verilator model')
-
-        self.reader_thread = Thread(target=self._read_output)
-        self.reader_thread.daemon = True
-        self.reader_thread.start()
-        return self
-
-    def __exit__(self, *unused):
-        test_harness.kill_gently(self.process)
-        if self.sock:
-            self.sock.close()
-
-    def jtag_transfer(self, instruction, data_length, data):
-        """
-        Shift an instruction and/or data to the target.
-        If instruction is set to INST_SAME, this will not shift an instruction
-        If data_length is zero, it will not shift any data. If both are set to
-        not transfer, it will initiate a reset of the target.
-        """
-
-        if test_harness.DEBUG:
-            print('Sending JTAG command 0x{:x} data 0x{:x}'.format(
-                instruction, data))
-
-        if instruction == INST_SAME:
-            instruction_length = 0
-            instruction = 0
-        else:
-            instruction_length = INSTRUCTION_LENGTH
-
-        self.sock.send(struct.pack('<BIBQ', instruction_length, instruction,
-                                   data_length, data))
-
-        response_data = self.sock.recv(12)
-        if not response_data:
-            raise test_harness.TestException(
-                'error reading response:\n' + self.get_program_output())
-
-        _, self.last_response = struct.unpack('<IQ', response_data)
-        self.last_response = mask_value(self.last_response, data_length)
-        if test_harness.DEBUG:
-            print('received JTAG response 0x{:x}'.format(self.last_response))
-
-    def test_instruction_shift(self, value):
-        """
-        Shift a value through the instruction register, then capture
-        the bits that are shifted out and check that they match.
-        """
-
-        # Send an instruction that is twice as long as the instruction register.
-        # The first bits shifted in should come right back out in the high
-        # bits of the result.
-        self.sock.send(struct.pack('<BIBQ', INSTRUCTION_LENGTH * 2, value,
-                                   0, 0))
-        response_data = self.sock.recv(12)
-        if not response_data:
-            raise test_harness.TestException(
-                'error reading response:\n' + self.get_program_output())
-
-        instr_response, _ = struct.unpack('<IQ', response_data)
-        if instr_response != value << INSTRUCTION_LENGTH:
-            raise test_harness.TestException('invalid response: wanted {}, got {}'.format(
-                value, instr_response))
-
-    def get_program_output(self):
-        """
-        Return everything verilator printed to stdout before exiting.
-        This won't read anything if the program was killed (which is the
-        common case if the program didn't die with an assertion), but
-        we usually call in the case that it has exited with an error.
-        """
-        # Give the reader thread time to finish reading responses.
-        if self.reader_thread:
-            self.reader_thread.join(0.5)
-
-        return self.output
-
-    def expect_data(self, expected_data):
-        """
-        Throw an exception if the bits shifted out of TDO during the last data
-        transfer do not match the passed value
-        """
-        if self.last_response != expected_data:
-            raise test_harness.TestException('unexpected JTAG data response. Wanted {} got {}:\n{}'
-                                             .format(expected_data, self.last_response,
-                                                     self.get_program_output()))
-
-    def _read_output(self):
-        """
-        Read text that is printed by the verilator process to standard out.
-        This needs to happen on a separate thread to avoid blocking the
-        main thread. This seems to be the only way to do it portably in
-        python.
-        """
-        while True:
-            got = self.process.stdout.read(0x100)
-            if not got:
-                break
-
-            if test_harness.DEBUG:
-                print(got)
-
-            self.output += got.decode()
-
-
 @test_harness.test(['verilator'])
 def jtag_idcode(*unused):
     """
     Validate response to IDCODE request
     """
-    hexfile = test_harness.build_program(['test_program.S'])
-    with JTAGTestFixture(hexfile) as fixture:
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
         # Ensure the default instruction after reset is IDCODE
         fixture.jtag_transfer(INST_SAME, 32, 0xffffffff)
         fixture.expect_data(EXPECTED_IDCODE)
@@ -227,8 +59,8 @@ def jtag_reset(*unused):
     """
     Test transition to reset state
     """
-    hexfile = test_harness.build_program(['test_program.S'])
-    with JTAGTestFixture(hexfile) as fixture:
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
         # Load a different instruction
         fixture.jtag_transfer(INST_TRANSFER_DATA, 32, 0x3b643e9a)
 
@@ -248,8 +80,8 @@ def jtag_bypass(*unused):
     Validate BYPASS instruction, which is a single bit data register
     We should get what we send, shifted by one bit.
     """
-    hexfile = test_harness.build_program(['test_program.S'])
-    with JTAGTestFixture(hexfile) as fixture:
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
         value = 0x267521cf
         fixture.jtag_transfer(INST_BYPASS, 32, value)
         fixture.expect_data(value << 1)
@@ -261,8 +93,8 @@ def jtag_instruction_shift(*unused):
     Ensure instruction bits shifted into TDI come out TDO. This is necessary
     to properly chain JTAG devices together.
     """
-    hexfile = test_harness.build_program(['test_program.S'])
-    with JTAGTestFixture(hexfile) as fixture:
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
         fixture.test_instruction_shift(0xf)
         fixture.test_instruction_shift(0xa)
         fixture.test_instruction_shift(0x5)
@@ -279,8 +111,8 @@ def jtag_data_transfer(*unused):
     one in, so we should see the previous value come out each time
     we write a new one.
     """
-    hexfile = test_harness.build_program(['test_program.S'])
-    with JTAGTestFixture(hexfile) as fixture:
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
         fixture.jtag_transfer(INST_TRANSFER_DATA, 32, 0x4be49e7c)
         fixture.jtag_transfer(INST_SAME, 32, 0xb282dc16)
         fixture.expect_data(0x4be49e7c)
@@ -288,13 +120,44 @@ def jtag_data_transfer(*unused):
         fixture.expect_data(0xb282dc16)
 
 
+@test_harness.test(['verilator'])
+def jtag_batch_transfer(*unused):
+    """
+    Pipeline a batch of transfers, which is larger than MAX_BATCH_SIZE, and
+    make sure every response comes back in order. Like jtag_data_transfer,
+    each TRANSFER_DATA shift returns the previously written value.
+    """
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
+        values = [(index * 0x9e3779b1) & 0xffffffff
+                  for index in range(MAX_BATCH_SIZE * 2 + 17)]
+        transfers = [(INST_TRANSFER_DATA, 32, values[0])]
+        transfers += [(INST_SAME, 32, value) for value in values[1:]]
+        responses = fixture.jtag_transfer_batch(transfers)
+        if responses[1:] != values[:-1]:
+            raise test_harness.TestException(
+                'batched responses out of order:\n' + fixture.get_program_output())
+
+        # Mix instruction and data shifts in one batch
+        responses = fixture.jtag_transfer_batch([
+            (INST_IDCODE, 32, 0xffffffff),
+            (INST_BYPASS, 32, 0x267521cf),
+            (INST_TRANSFER_DATA, 32, 0x4be49e7c),
+            (INST_SAME, 32, 0)
+        ])
+        if responses != [EXPECTED_IDCODE, mask_value(0x267521cf << 1, 32),
+                         values[-1], 0x4be49e7c]:
+            raise test_harness.TestException('unexpected batch responses ' +
+                                             str(responses))
+
+
 @test_harness.test(['verilator'])
 def jtag_inject(*unused):
     """
     Test instruction injection, with multiple threads
     """
-    hexfile = test_harness.build_program(['test_program.S'])
-    with JTAGTestFixture(hexfile) as fixture:
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
         # Halt
         fixture.jtag_transfer(INST_CONTROL, 7, 0x1)
 
@@ -354,8 +217,8 @@ def jtag_inject_rollback(*unused):
     Test reading status register. I put in an instruction that will miss the
     cache, so I know it will roll back.
     """
-    hexfile = test_harness.build_program(['test_program.S'])
-    with JTAGTestFixture(hexfile) as fixture:
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
         # Halt
         fixture.jtag_transfer(INST_CONTROL, 7, 0x1)
 
@@ -372,6 +235,67 @@ def jtag_inject_rollback(*unused):
         fixture.expect_data(STATUS_ROLLED_BACK)
 
 
+@test_harness.test(['verilator'])
+def jtag_debugger_registers(*unused):
+    """
+    Use the debugger library to write and read back scalar and vector
+    registers in two threads, and make sure they don't affect each other.
+    """
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
+        debugger = jtag_debugger.JTAGDebugger(fixture)
+        debugger.halt()
+        for thread in range(2):
+            debugger.select_thread(thread)
+            debugger.write_scalar_register(1, 0xa6532328)
+            debugger.write_scalar_register(5, 0x3b643e9a + thread)
+            debugger.write_vector_register(3, [0x1000 * thread + lane
+                                               for lane in range(16)])
+
+        for thread in range(2):
+            debugger.select_thread(thread)
+            value = debugger.read_scalar_register(5)
+            if value != 0x3b643e9a + thread:
+                raise test_harness.TestException(
+                    'thread {} s5 mismatch: got {:x}'.format(thread, value))
+
+            lanes = debugger.read_vector_register(3)
+            if lanes != [0x1000 * thread + lane for lane in range(16)]:
+                raise test_harness.TestException(
+                    'thread {} v3 mismatch: got {}'.format(thread, lanes))
+
+            # Vector accesses use s1 as a scratch register, which should
+            # be restored.
+            if debugger.read_scalar_register(1) != 0xa6532328:
+                raise test_harness.TestException('scratch register not restored')
+
+
+@test_harness.test(['verilator'])
+def jtag_debugger_memory(*unused):
+    """
+    Write memory through the debugger library and read it back. The range is
+    not aligned to a vector, so this uses both block and word accesses.
+    """
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
+        debugger = jtag_debugger.JTAGDebugger(fixture)
+        debugger.halt()
+        debugger.write_scalar_register(0, 0x12345678)
+        debugger.write_vector_register(0, list(range(16)))
+
+        data = os.urandom(0x200 + 8)
+        debugger.write_memory(0x100000 - 4, data)
+        read_data = debugger.read_memory(0x100000 - 4, len(data))
+        if read_data != data:
+            raise test_harness.TestException('memory mismatch:\nwrote {}\nread  {}'
+                                             .format(data.hex(), read_data.hex()))
+
+        # Scratch registers should be restored
+        if debugger.read_scalar_register(0) != 0x12345678 \
+                or debugger.read_vector_register(0) != list(range(16)):
+            raise test_harness.TestException('scratch registers not restored')
+
+
 # XXX currently disabled because of issue #128
 #@test_harness.test(['verilator'])
 def jtag_read_write_pc(*unused):
@@ -382,8 +306,8 @@ def jtag_read_write_pc(*unused):
     update the PC of the selected thread. This then resumes the thread
     to ensure it operates properly.
     """
-    hexfile = test_harness.build_program(['test_program.S'])
-    with JTAGTestFixture(hexfile) as fixture:
+    image_file = test_harness.build_program(['test_program.S'])
+    with JTAGTestFixture(image_file) as fixture:
         # Switch to thread 1, branch to new address
         fixture.jtag_transfer(INST_CONTROL, 7, 0x3)
         fixture.jtag_transfer(INST_TRANSFER_DATA, 32, 0x10e4)   # `jump_target`
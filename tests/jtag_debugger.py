@@ -0,0 +1,407 @@
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Host side debugger for the on chip debugger (hardware/core/on_chip_debugger.sv).
+This reads and writes registers and memory by injecting instructions into
+a halted thread over JTAG, and moving values through the JTAG_DATA control
+register (CR 18).
+
+It doesn't depend on the test harness. The transport can be anything with
+a jtag_transfer_batch method that takes a list of (instruction, data_length,
+data) tuples and returns the data shifted out for each one, in order (like
+JTAGTestFixture in tests/jtag-debug):
+
+    debugger = jtag_debugger.JTAGDebugger(fixture)
+    debugger.halt()
+    debugger.write_memory(0x100000, data)
+    print(debugger.read_scalar_register(5))
+    debugger.resume()
+
+Requests for each operation are sent as one batch, so the round trip to the
+target is paid once per register access or 64 byte block of memory, rather
+than once per JTAG transfer.
+
+Memory and vector register accesses use s0, s1, s2, and v0 as scratch
+registers. These are saved and restored, so the program can be resumed
+afterwards. Memory addresses are translated by the selected thread, like
+loads and stores the program itself performs.
+"""
+
+import contextlib
+
+from jtag_protocol import (CONTROL_LENGTH, DATA_LENGTH, INST_CONTROL, INST_INJECT_INST,
+                           INST_SAME, INST_STATUS, INST_TRANSFER_DATA, STATUS_LENGTH,
+                           STATUS_READY, STATUS_ROLLED_BACK)
+
+NUM_VECTOR_LANES = 16
+VECTOR_BYTES = NUM_VECTOR_LANES * 4
+
+CR_JTAG_DATA = 18
+
+# Number of times to poll the status of an injected memory instruction
+# before giving up.
+MAX_STATUS_POLLS = 100
+
+_ADDRESS_REG = 0
+_VALUE_REG = 1
+_MASK_REG = 2
+_SCRATCH_VECTOR_REG = 0
+
+# Instruction fields (see tools/emulator/instruction-set.h)
+_OP_SHL = 11
+_OP_MOVE = 15
+_OP_GETLANE = 26
+_FMT_RA_VS_M = 2
+_FMT_IMM_S = 0
+_FMT_IMM_V = 1
+_MEM_LONG = 4
+_MEM_CONTROL_REG = 6
+_MEM_BLOCK_VECTOR = 7
+
+
+class JTAGDebuggerError(Exception):
+    """Raised when the target doesn't respond as expected"""
+    pass
+
+
+def encode_memory_op(op, is_load, reg, ptr_reg, offset=0):
+    """Format M: load/store reg at ptr_reg + offset, or getcr/setcr"""
+    return (0x80000000 | (int(is_load) << 29) | (op << 25)
+            | ((offset & 0x7fff) << 10) | (reg << 5) | ptr_reg)
+
+
+def encode_immediate_arith(fmt, op, dest, src, imm):
+    """Format I: arithmetic with a 14 bit signed immediate operand"""
+    return (fmt << 29) | (op << 24) | ((imm & 0x3fff) << 10) | (dest << 5) | src
+
+
+def encode_register_arith(fmt, op, dest, src1, src2, mask_reg=0):
+    """Format R: arithmetic with register operands"""
+    return (0xc0000000 | (fmt << 26) | (op << 20) | (src2 << 15)
+            | (mask_reg << 10) | (dest << 5) | src1)
+
+
+def getcr(dest, control_reg):
+    return encode_memory_op(_MEM_CONTROL_REG, True, dest, control_reg)
+
+
+def setcr(src, control_reg):
+    return encode_memory_op(_MEM_CONTROL_REG, False, src, control_reg)
+
+
+def load_32(dest, ptr_reg, offset=0):
+    return encode_memory_op(_MEM_LONG, True, dest, ptr_reg, offset)
+
+
+def store_32(src, ptr_reg, offset=0):
+    return encode_memory_op(_MEM_LONG, False, src, ptr_reg, offset)
+
+
+def load_v(dest, ptr_reg, offset=0):
+    return encode_memory_op(_MEM_BLOCK_VECTOR, True, dest, ptr_reg, offset)
+
+
+def store_v(src, ptr_reg, offset=0):
+    return encode_memory_op(_MEM_BLOCK_VECTOR, False, src, ptr_reg, offset)
+
+
+def getlane(dest, vector_reg, lane):
+    return encode_immediate_arith(_FMT_IMM_V, _OP_GETLANE, dest, vector_reg, lane)
+
+
+def shl(dest, src, amount):
+    return encode_immediate_arith(_FMT_IMM_S, _OP_SHL, dest, src, amount)
+
+
+def move_mask(dest_vector, mask_reg, src):
+    """Copy scalar register src into the lanes of dest_vector set in mask_reg"""
+    return encode_register_arith(_FMT_RA_VS_M, _OP_MOVE, dest_vector, 0, src,
+                                 mask_reg)
+
+
+class JTAGDebugger(object):
+
+    """
+    Debugger for one core. Call halt before accessing registers or memory.
+    Registers and memory are accessed through the selected thread (see
+    select_thread).
+    """
+
+    def __init__(self, transport, core=0):
+        self.transport = transport
+        self.core = core
+        self.thread = 0
+        self.halted = False
+
+        # The JTAG instruction register keeps its value between transfers,
+        # so this only shifts a new one when it changes. None means unknown.
+        self._instruction = None
+
+    def halt(self):
+        """Stop all threads, so instructions can be injected"""
+        self.halted = True
+        self._update_control()
+
+    def resume(self):
+        """Let the program continue running"""
+        self.halted = False
+        self._update_control()
+
+    def select_thread(self, thread):
+        """Set which thread's registers are accessed"""
+        self.thread = thread
+        self._update_control()
+
+    def read_scalar_register(self, reg):
+        self._check_halted()
+        return self._transfer([self._inject(setcr(reg, CR_JTAG_DATA)),
+                               self._transfer_data(0)])[-1]
+
+    def write_scalar_register(self, reg, value):
+        self._check_halted()
+        self._transfer([self._transfer_data(value),
+                        self._inject(getcr(reg, CR_JTAG_DATA))])
+
+    def read_vector_register(self, reg):
+        """Returns a list with the value of each lane, starting with lane 0"""
+        self._check_halted()
+        with self._preserve_registers([_VALUE_REG]):
+            transfers = self._read_vector_transfers(reg)
+            return self._data_responses(transfers, self._transfer(transfers))
+
+    def write_vector_register(self, reg, values):
+        """Set each lane of vector register reg, starting with lane 0"""
+        if len(values) != NUM_VECTOR_LANES:
+            raise ValueError('vector register has {} lanes'.format(NUM_VECTOR_LANES))
+
+        self._check_halted()
+        with self._preserve_registers([_VALUE_REG, _MASK_REG]):
+            self._transfer(self._write_vector_transfers(reg, values))
+
+    def read_memory(self, address, length):
+        """
+        Read memory with injected loads. Aligned 64 byte blocks are loaded
+        with load_v and the rest a word at a time.
+
+        Args:
+            address: Start address, must be a multiple of 4.
+            length: Number of bytes, must be a multiple of 4.
+
+        Returns:
+            Contents of memory, as bytes.
+
+        Raises:
+            JTAGDebuggerError if a load never completes.
+        """
+
+        self._check_memory_range(address, length)
+        self._check_halted()
+        data = bytearray()
+        with self._preserve_registers([_ADDRESS_REG, _VALUE_REG, _MASK_REG], True):
+            # Read out the previous block/word in the same batch that loads
+            # the next one.
+            readout = []
+            for chunk_address, chunk_length in self._split_range(address, length):
+                if chunk_length == VECTOR_BYTES:
+                    instruction = load_v(_SCRATCH_VECTOR_REG, _ADDRESS_REG)
+                    next_readout = self._read_vector_transfers(_SCRATCH_VECTOR_REG)
+                else:
+                    instruction = load_32(_VALUE_REG, _ADDRESS_REG)
+                    next_readout = [self._inject(setcr(_VALUE_REG, CR_JTAG_DATA)),
+                                    self._transfer_data(0)]
+
+                responses = self._transfer(readout + [
+                    self._transfer_data(chunk_address),
+                    self._inject(getcr(_ADDRESS_REG, CR_JTAG_DATA))
+                ] + self._execute_transfers(instruction))
+                data += self._words_to_bytes(self._data_responses(readout, responses))
+                self._wait_complete(instruction, responses[-1])
+                readout = next_readout
+
+            data += self._words_to_bytes(self._data_responses(readout,
+                                                              self._transfer(readout)))
+
+        return bytes(data)
+
+    def write_memory(self, address, data):
+        """
+        Write data (bytes) to memory with injected stores. Aligned 64 byte
+        blocks are stored with store_v and the rest a word at a time. The
+        address and length must be multiples of 4.
+        """
+
+        self._check_memory_range(address, len(data))
+        self._check_halted()
+        with self._preserve_registers([_ADDRESS_REG, _VALUE_REG, _MASK_REG], True):
+            for chunk_address, chunk_length in self._split_range(address, len(data)):
+                offset = chunk_address - address
+                words = [int.from_bytes(data[word_offset:word_offset + 4], 'little')
+                         for word_offset in range(offset, offset + chunk_length, 4)]
+                if chunk_length == VECTOR_BYTES:
+                    transfers = self._write_vector_transfers(_SCRATCH_VECTOR_REG, words)
+                    instruction = store_v(_SCRATCH_VECTOR_REG, _ADDRESS_REG)
+                else:
+                    transfers = [self._transfer_data(words[0]),
+                                 self._inject(getcr(_VALUE_REG, CR_JTAG_DATA))]
+                    instruction = store_32(_VALUE_REG, _ADDRESS_REG)
+
+                responses = self._transfer(transfers + [
+                    self._transfer_data(chunk_address),
+                    self._inject(getcr(_ADDRESS_REG, CR_JTAG_DATA))
+                ] + self._execute_transfers(instruction))
+                self._wait_complete(instruction, responses[-1])
+
+    def _update_control(self):
+        self._transfer([(INST_CONTROL, CONTROL_LENGTH,
+                         (self.core << 3) | (self.thread << 1) | int(self.halted))])
+
+    def _check_halted(self):
+        if not self.halted:
+            raise JTAGDebuggerError('processor must be halted to inject instructions')
+
+    @staticmethod
+    def _check_memory_range(address, length):
+        if address % 4 != 0 or length % 4 != 0:
+            raise ValueError('address and length must be multiples of 4')
+
+    @staticmethod
+    def _split_range(address, length):
+        """Yield (address, length) of each aligned block or word"""
+        end = address + length
+        while address < end:
+            if address % VECTOR_BYTES == 0 and end - address >= VECTOR_BYTES:
+                chunk_length = VECTOR_BYTES
+            else:
+                chunk_length = 4
+
+            yield address, chunk_length
+            address += chunk_length
+
+    @staticmethod
+    def _words_to_bytes(words):
+        return b''.join(word.to_bytes(4, 'little') for word in words)
+
+    @staticmethod
+    def _transfer_data(value):
+        return (INST_TRANSFER_DATA, DATA_LENGTH, value)
+
+    @staticmethod
+    def _inject(instruction):
+        return (INST_INJECT_INST, DATA_LENGTH, instruction)
+
+    @staticmethod
+    def _execute_transfers(instruction):
+        """Inject a memory instruction, then read back whether it completed"""
+        return [(INST_INJECT_INST, DATA_LENGTH, instruction),
+                (INST_STATUS, STATUS_LENGTH, 0)]
+
+    def _wait_complete(self, instruction, status):
+        """
+        The on chip debugger doesn't restart an injected instruction that
+        is rolled back (for example, because of a cache miss), so issue
+        it again until it completes.
+        """
+        for _ in range(MAX_STATUS_POLLS):
+            if status == STATUS_READY:
+                return
+
+            if status == STATUS_ROLLED_BACK:
+                status = self._transfer(self._execute_transfers(instruction))[-1]
+            else:
+                status = self._transfer([(INST_STATUS, STATUS_LENGTH, 0)])[-1]
+
+        raise JTAGDebuggerError(
+            'injected instruction {:08x} did not complete'.format(instruction))
+
+    def _read_vector_transfers(self, reg):
+        transfers = []
+        for lane in range(NUM_VECTOR_LANES):
+            transfers += [
+                self._inject(getlane(_VALUE_REG, reg, lane)),
+                self._inject(setcr(_VALUE_REG, CR_JTAG_DATA)),
+                self._transfer_data(0)
+            ]
+
+        return transfers
+
+    @staticmethod
+    def _data_responses(transfers, responses):
+        """
+        Pick the values read from JTAG_DATA out of the responses to
+        transfers (which may be the first part of a longer batch)
+        """
+        return [response for (instruction, _, _), response in zip(transfers, responses)
+                if instruction == INST_TRANSFER_DATA]
+
+    def _write_vector_transfers(self, reg, values):
+        # Walk a single bit mask across the lanes, copying one value in
+        # each time.
+        transfers = [self._transfer_data(1),
+                     self._inject(getcr(_MASK_REG, CR_JTAG_DATA))]
+        for value in values:
+            transfers += [
+                self._transfer_data(value),
+                self._inject(getcr(_VALUE_REG, CR_JTAG_DATA)),
+                self._inject(move_mask(reg, _MASK_REG, _VALUE_REG)),
+                self._inject(shl(_MASK_REG, _MASK_REG, 1))
+            ]
+
+        return transfers
+
+    @contextlib.contextmanager
+    def _preserve_registers(self, scalar_regs, scratch_vector=False):
+        """Restore registers used as scratch by the enclosed operations"""
+        transfers = []
+        for reg in scalar_regs:
+            transfers += [self._inject(setcr(reg, CR_JTAG_DATA)),
+                          self._transfer_data(0)]
+
+        saved_scalars = self._data_responses(transfers, self._transfer(transfers))
+        if scratch_vector:
+            transfers = self._read_vector_transfers(_SCRATCH_VECTOR_REG)
+            saved_vector = self._data_responses(transfers, self._transfer(transfers))
+
+        try:
+            yield
+        finally:
+            # Restoring the vector register uses the scalar scratch
+            # registers, so do it first.
+            transfers = []
+            if scratch_vector:
+                transfers += self._write_vector_transfers(_SCRATCH_VECTOR_REG,
+                                                          saved_vector)
+
+            for reg, value in zip(scalar_regs, saved_scalars):
+                transfers += [self._transfer_data(value),
+                              self._inject(getcr(reg, CR_JTAG_DATA))]
+
+            self._transfer(transfers)
+
+    def _transfer(self, transfers):
+        """
+        Send a batch of transfers, leaving out instruction register shifts
+        that wouldn't change it. Returns the data shifted out of each one.
+        """
+        requests = []
+        for instruction, data_length, data in transfers:
+            if instruction == self._instruction:
+                requests.append((INST_SAME, data_length, data))
+            else:
+                requests.append((instruction, data_length, data))
+                self._instruction = instruction
+
+        return self.transport.jtag_transfer_batch(requests)
@@ -0,0 +1,45 @@
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Constants for the JTAG interface of the on chip debugger
+(hardware/core/on_chip_debugger.sv). These are shared by the transports
+that send JTAG transfers (like JTAGTestFixture in tests/jtag-debug) and
+jtag_debugger.py, which is built on top of them.
+"""
+
+# JTAG instructions
+INSTRUCTION_LENGTH = 4
+INST_IDCODE = 0
+INST_EXTEST = 1
+INST_INTEST = 2
+INST_CONTROL = 3
+INST_INJECT_INST = 4
+INST_TRANSFER_DATA = 5
+INST_STATUS = 6
+INST_BYPASS = 15
+
+# When passed, does not shift instruction register
+INST_SAME = -1
+
+# Values read from the STATUS register
+STATUS_READY = 0
+STATUS_ISSUED = 1
+STATUS_ROLLED_BACK = 2
+
+CONTROL_LENGTH = 7   # core (4 bits), thread (2 bits), halt (1 bit)
+STATUS_LENGTH = 2
+DATA_LENGTH = 32
@@ -23,7 +23,8 @@ import test_harness
 
 def run_kernel_test(source_file, target):
     test_harness.build_program([source_file], image_type='user')
-    result = test_harness.run_kernel(target=target, timeout=240)
+    result = test_harness.run_kernel(target=target, timeout=240,
+                                     check_source=source_file)
     test_harness.check_result(source_file, result)
 
 test_list = test_harness.find_files(('.c', '.cpp'))
@@ -43,7 +43,7 @@ def filesystem(_, target):
 
 def run_test(source_file, target):
     test_harness.build_program([source_file])
-    result = test_harness.run_program(target)
+    result = test_harness.run_program(target, check_source=source_file)
     test_harness.check_result(source_file, result)
 
 # hack: register all source files in this directory except for fs test,
@@ -23,6 +23,148 @@ import sys
 sys.path.insert(0, '..')
 import test_harness
 
+# Prefix characters of MI output records
+RESULT_RECORD = '^'
+EXEC_ASYNC_RECORD = '*'
+STATUS_ASYNC_RECORD = '+'
+NOTIFY_ASYNC_RECORD = '='
+CONSOLE_STREAM_RECORD = '~'
+TARGET_STREAM_RECORD = '@'
+LOG_STREAM_RECORD = '&'
+PROMPT_RECORD = '('
+
+MI_RECORD_RE = re.compile(r'(?P<token>[0-9]*)(?P<type>[\^*+=~@&])(?P<body>.*)')
+MI_NAME_RE = re.compile(r'[a-zA-Z0-9_\-]+')
+C_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '"': '"', '\\': '\\'}
+
+
+class MIRecord(object):
+
+    """
+    One line of output from lldb-mi, in the GDB machine interface format:
+    https://sourceware.org/gdb/onlinedocs/gdb/GDB_002fMI-Output-Syntax.html
+
+    type is one of the *_RECORD constants. For result and async records,
+    record_class is the part after the prefix (for example, 'done' or
+    'stopped') and results is a dict of the name=value pairs that follow it.
+    Values are strings, dicts for tuples, and lists. For stream records,
+    text is the decoded string. line is the original text. Lines that aren't
+    in MI format have type None.
+    """
+
+    def __init__(self, line):
+        self.line = line
+        self.token = None
+        self.record_class = None
+        self.results = {}
+        self.text = None
+        if line.startswith('(gdb)'):
+            self.type = PROMPT_RECORD
+            return
+
+        match = MI_RECORD_RE.match(line)
+        if match is None:
+            # Not MI output, for example, a message from the target
+            self.type = None
+            self.text = line
+            return
+
+        self.type = match.group('type')
+        if match.group('token'):
+            self.token = int(match.group('token'))
+
+        body = match.group('body')
+        if self.type in (CONSOLE_STREAM_RECORD, TARGET_STREAM_RECORD, LOG_STREAM_RECORD):
+            self.text, _ = _parse_c_string(body, 0)
+        else:
+            self.record_class, _, results = body.partition(',')
+            if results:
+                self.results, _ = _parse_results(results, 0, '')
+
+    def __repr__(self):
+        return 'MIRecord(' + repr(self.line) + ')'
+
+
+def _parse_c_string(text, pos):
+    """
+    Parse a quoted string starting at text[pos], which must be a quote.
+    Returns a tuple (decoded string, index after the closing quote).
+    """
+
+    chars = []
+    pos += 1
+    while True:
+        end = text.find('"', pos)
+        escape = text.find('\\', pos, end if end >= 0 else len(text))
+        if end < 0:
+            raise test_harness.TestException('unterminated string in ' + text)
+
+        if escape < 0:
+            chars.append(text[pos:end])
+            return ''.join(chars), end + 1
+
+        chars.append(text[pos:escape])
+        code = text[escape + 1]
+        if code in C_ESCAPES:
+            chars.append(C_ESCAPES[code])
+            pos = escape + 2
+        else:
+            # Octal escape, up to three digits
+            digits = re.match('[0-7]{1,3}', text[escape + 1:escape + 4])
+            if digits:
+                chars.append(chr(int(digits.group(), 8)))
+                pos = escape + 1 + len(digits.group())
+            else:
+                chars.append(code)
+                pos = escape + 2
+
+
+def _parse_value(text, pos):
+    """Returns a tuple (value, index after it)"""
+
+    if text[pos] == '"':
+        return _parse_c_string(text, pos)
+    elif text[pos] == '{':
+        return _parse_results(text, pos + 1, '}')
+    elif text[pos] == '[':
+        # A list of values or of name=value results. The names of results
+        # in a list are usually all the same ('frame'), so they are dropped.
+        values = []
+        pos += 1
+        while text[pos] != ']':
+            name_match = MI_NAME_RE.match(text, pos)
+            if name_match and text[name_match.end()] == '=':
+                pos = name_match.end() + 1
+
+            value, pos = _parse_value(text, pos)
+            values.append(value)
+            if text[pos] == ',':
+                pos += 1
+
+        return values, pos + 1
+
+    raise test_harness.TestException('bad value in lldb-mi output: ' + text[pos:])
+
+
+def _parse_results(text, pos, terminator):
+    """
+    Parse comma separated name=value pairs up to terminator (or the end of
+    the text if terminator is empty). Returns a tuple (dict, index after
+    the terminator).
+    """
+
+    results = {}
+    while pos < len(text) and text[pos] != terminator:
+        name_match = MI_NAME_RE.match(text, pos)
+        if name_match is None or text[name_match.end()] != '=':
+            raise test_harness.TestException('bad result in lldb-mi output: ' + text[pos:])
+
+        results[name_match.group()], pos = _parse_value(text, name_match.end() + 1)
+        if pos < len(text) and text[pos] == ',':
+            pos += 1
+
+    return results, pos + 1
+
 
 class EmulatorProcess(object):
 
@@ -33,39 +175,50 @@ class EmulatorProcess(object):
     construct so it will automatically be torn down when the test is done.
     """
 
-    def __init__(self, hexfile):
-        self.hexfile = hexfile
-        self.elf_file = os.path.splitext(hexfile)[0] + '.elf'
+    def __init__(self, image_file):
+        self.image_file = image_file
+        self.elf_file = os.path.splitext(image_file)[0] + '.elf'
         self.output = None
         self.emulator_proc = None
         self.lldb_proc = None
         self.outstr = None
         self.instr = None
+        self.port = None
 
     def __enter__(self):
-        emulator_args = [
-            test_harness.EMULATOR_PATH,
-            '-m',
-            'gdb',
-            '-v',
-            self.hexfile
-        ]
-
         if test_harness.DEBUG:
             self.output = None
         else:
             self.output = open(os.devnull, 'w')
 
-        self.emulator_proc = subprocess.Popen(emulator_args, stdout=self.output,
-                                              stderr=subprocess.STDOUT)
+        with test_harness.ReadySignal() as ready:
+            emulator_args = [
+                test_harness.EMULATOR_PATH,
+                '-m',
+                'gdb',
+                '-v',
+                '-g',
+                '0',    # Use any free port, so tests can run in parallel
+                '-R',
+                ready.path,
+                self.image_file
+            ]
+
+            self.emulator_proc = ready.popen(emulator_args, stdout=self.output,
+                                             stderr=subprocess.STDOUT)
+
+            # Make sure the emulator is listening before lldb tries to
+            # connect to it.
+            try:
+                self.port = int(ready.wait())
+            except:
+                test_harness.kill_gently(self.emulator_proc)
+                raise
 
         lldb_args = [
             test_harness.COMPILER_DIR + 'lldb-mi'
         ]
 
-        # XXX race condition: the emulator needs to be ready before
-        # lldb tries to connect to it.
-
         try:
             self.lldb_proc = subprocess.Popen(lldb_args, stdout=subprocess.PIPE,
                                               stdin=subprocess.PIPE)
@@ -89,31 +242,63 @@ class EmulatorProcess(object):
         self.outstr.flush()
         return self.wait_response()
 
-    def wait_response(self):
-        response = ''
-        while True:
-            response += self.instr.read(1).decode('utf-8')
-            if response.endswith('^done'):
-                break
+    def read_record(self):
+        """
+        Read the next line of output from lldb-mi.
+
+        Returns:
+            MIRecord
+
+        Raises:
+            TestException if lldb-mi exited.
+        """
 
+        # The output pipe is buffered, so this doesn't need a system call
+        # for each character.
+        line = self.instr.readline()
+        if not line:
+            raise test_harness.TestException('lldb-mi exited unexpectedly')
+
+        line = line.decode('utf-8').rstrip('\r\n')
         if test_harness.DEBUG:
-            print('LLDB recv: ' + response)
+            print('LLDB recv: ' + line)
 
-        return response
+        return MIRecord(line)
 
-    def wait_stop(self):
-        current_line = ''
+    def wait_response(self):
+        """
+        Read output until the result of the last command.
+
+        Returns:
+            The '^done' MIRecord. Its console attribute contains the text of
+            the console stream records that preceded it, which is where
+            lldb-mi prints the output of CLI commands.
+
+        Raises:
+            TestException if the command failed (^error).
+        """
+
+        console = []
         while True:
-            inchar = self.instr.read(1).decode('utf-8')
-            current_line += inchar
-            if inchar == '\n':
-                if test_harness.DEBUG:
-                    print('LLDB recv: ' + current_line[:-1])
+            record = self.read_record()
+            if record.type in (CONSOLE_STREAM_RECORD, TARGET_STREAM_RECORD):
+                console.append(record.text)
+            elif record.type == RESULT_RECORD:
+                if record.record_class == 'error':
+                    raise test_harness.TestException(
+                        'lldb-mi command failed: ' + record.results.get('msg', record.line))
+
+                if record.record_class == 'done':
+                    record.console = ''.join(console)
+                    return record
 
-                if current_line.startswith('*stopped'):
-                    break
+    def wait_stop(self):
+        """Read output until the target stops. Returns the '*stopped' MIRecord"""
 
-                current_line = ''
+        while True:
+            record = self.read_record()
+            if record.type == EXEC_ASYNC_RECORD and record.record_class == 'stopped':
+                return record
 
 FRAME_RE = re.compile(
     'frame #[0-9]+:( 0x[0-9a-f]+)? [a-zA-Z_\\.0-9]+`(?P<function>[a-zA-Z_0-9][a-zA-Z_0-9]+)')
@@ -122,13 +307,13 @@ AT_RE = re.compile(' at (?P<filename>[a-z_A-Z][a-z\\._A-Z]+):(?P<line>[0-9]+)')
 
 def parse_stack_crawl(response):
     """
-    Given text response from the debugger containing a stack crawl, this will
+    Given console output from the debugger containing a stack crawl, this will
     return a list of tuples where each entry represents the function name,
     filename, and line number of the call site.
     """
 
     stack_info = []
-    for line in response.split('\\n'):
+    for line in response.split('\n'):
         frame_match = FRAME_RE.search(line)
         if frame_match:
             func = frame_match.group('function')
@@ -146,16 +331,17 @@ def parse_stack_crawl(response):
 def lldb(*unused):
     """This mainly validates that LLDB is reading symbols correctly."""
 
-    hexfile = test_harness.build_program(
+    image_file = test_harness.build_program(
         ['test_program.c'], opt_level='-O0', cflags=['-g'])
-    with EmulatorProcess(hexfile) as conn:
+    with EmulatorProcess(image_file) as conn:
         conn.send_command('file "' + test_harness.WORK_DIR + '/program.elf"')
-        conn.send_command('gdb-remote 8000\n')
+        conn.send_command('gdb-remote ' + str(conn.port) + '\n')
         response = conn.send_command(
             'breakpoint set --file test_program.c --line 27')
-        if 'Breakpoint 1: where = program.elf`func2 + 100 at test_program.c:27' not in response:
+        expected = 'Breakpoint 1: where = program.elf`func2 + 100 at test_program.c:27'
+        if expected not in response.console:
             raise test_harness.TestException(
-                'breakpoint: did not find expected value ' + response)
+                'breakpoint: did not find expected value ' + response.console)
 
         conn.send_command('c')
         conn.wait_stop()
@@ -168,41 +354,41 @@ def lldb(*unused):
         ]
 
         response = conn.send_command('bt')
-        crawl = parse_stack_crawl(response)
+        crawl = parse_stack_crawl(response.console)
         if crawl != expected_stack:
             raise test_harness.TestException(
                 'stack crawl mismatch ' + str(crawl))
 
         response = conn.send_command('print value')
-        if '= 67' not in response:
+        if '= 67' not in response.console:
             raise test_harness.TestException(
-                'print value: Did not find expected value ' + response)
+                'print value: Did not find expected value ' + response.console)
 
         response = conn.send_command('print result')
-        if '= 128' not in response:
+        if '= 128' not in response.console:
             raise test_harness.TestException(
-                'print result: Did not find expected value ' + response)
+                'print result: Did not find expected value ' + response.console)
 
         # Up to previous frame
         conn.send_command('frame select --relative=1')
 
         response = conn.send_command('print a')
-        if '= 12' not in response:
+        if '= 12' not in response.console:
             raise test_harness.TestException(
-                'print a: Did not find expected value ' + response)
+                'print a: Did not find expected value ' + response.console)
 
         response = conn.send_command('print b')
-        if '= 67' not in response:
+        if '= 67' not in response.console:
             raise test_harness.TestException(
-                'print b: Did not find expected value ' + response)
+                'print b: Did not find expected value ' + response.console)
 
         conn.send_command('step')
         conn.wait_stop()
 
         response = conn.send_command('print result')
-        if '= 64' not in response:
+        if '= 64' not in response.console:
             raise test_harness.TestException(
-                'print b: Did not find expected value ' + response)
+                'print b: Did not find expected value ' + response.console)
 
 
 test_harness.execute_tests()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measures how fast the emulator's remote GDB stub (tools/emulator/remote-gdb.c)
+transfers memory, at several packet sizes, and the round trip latency of
+register reads, single step, and vCont. This prints a table and appends the
+results to tests/cache/gdb_benchmark.jsonl, so they can be compared over time:
+
+    ./benchmark.py
+    ./benchmark.py --transfer-size 0x1000000 --packet-sizes 256,4096,16384
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--transfer-size', type=lambda value: int(value, 0),
+                    default=0x400000,
+                    help='number of bytes to read and write for each packet size')
+parser.add_argument('--packet-sizes', default='256,1024,4096,16384',
+                    help='comma separated list of packet sizes to test')
+parser.add_argument('--iterations', type=int, default=2000,
+                    help='number of requests for each latency measurement')
+args = parser.parse_args()
+
+# test_harness parses the command line when it is imported, and these
+# options aren't valid for it.
+del sys.argv[1:]
+
+sys.path.insert(0, '..')
+import gdb_client
+import test_harness
+
+BENCHMARK_HISTORY_FILE = test_harness.CACHE_DIR + 'gdb_benchmark.jsonl'
+
+# A branch to itself, so continuing with a breakpoint at address 0 stops
+# right away.
+LOOP_INSTRUCTION = b'\x00\x00\x00\xf6'
+MEMORY_BASE = 0x100000
+
+
+def measure_transfers(client, packet_size, transfer_size):
+    """Returns (write MB/s, read MB/s)"""
+
+    data = os.urandom(transfer_size)
+    client.packet_size = packet_size
+    start_time = time.monotonic()
+    client.write_memory(MEMORY_BASE, data)
+    write_time = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    read_data = client.read_memory(MEMORY_BASE, transfer_size)
+    read_time = time.monotonic() - start_time
+    if read_data != data:
+        raise test_harness.TestException(
+            'memory mismatch with packet size ' + str(packet_size))
+
+    megabytes = transfer_size / 0x100000
+    return megabytes / write_time, megabytes / read_time
+
+
+def measure_latency(client, request, expected, iterations):
+    """Returns average round trip time for request, in microseconds"""
+
+    start_time = time.monotonic()
+    for _ in range(iterations):
+        response = client.request(request)
+        if response != expected:
+            raise test_harness.TestException(
+                'unexpected response to ' + request + ': ' + str(response))
+
+    return (time.monotonic() - start_time) * 1000000 / iterations
+
+
+def main():
+    if not os.path.exists(test_harness.WORK_DIR):
+        os.makedirs(test_harness.WORK_DIR)
+
+    image_file = test_harness.WORK_DIR + 'gdb_benchmark.bin'
+    with open(image_file, 'wb') as outfile:
+        outfile.write(LOOP_INSTRUCTION)
+
+    with test_harness.ReadySignal() as ready:
+        process = ready.popen([test_harness.EMULATOR_PATH, '-m', 'gdb',
+                               '-g', '0', '-R', ready.path, image_file],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.STDOUT)
+        try:
+            port = int(ready.wait())
+        except:
+            test_harness.kill_gently(process)
+            raise
+
+    results = {
+        'timestamp': int(time.time()),
+        'transfer_size': args.transfer_size,
+        'transfers': {},
+        'latency_us': {}
+    }
+
+    try:
+        with gdb_client.GDBClient.connect('localhost', port, timeout=60) as client:
+            client.start_no_ack_mode()
+            max_packet_size = client.packet_size
+            print('{:>12} {:>12} {:>12}'.format('packet size', 'write MB/s', 'read MB/s'))
+            for packet_size in [int(size, 0) for size in args.packet_sizes.split(',')]:
+                if packet_size > max_packet_size:
+                    print('{:>12} skipped, target maximum is {}'.format(
+                        packet_size, max_packet_size))
+                    continue
+
+                write_rate, read_rate = measure_transfers(client, packet_size,
+                                                          args.transfer_size)
+                results['transfers'][packet_size] = {
+                    'write_mb_per_sec': write_rate,
+                    'read_mb_per_sec': read_rate
+                }
+                print('{:>12} {:>12.2f} {:>12.2f}'.format(packet_size, write_rate,
+                                                        read_rate))
+
+            client.packet_size = max_packet_size
+            if client.request('Z0,0') != b'OK':
+                raise test_harness.TestException('failed to set breakpoint')
+
+            print()
+            for name, request, expected in [
+                    ('register read', 'p40', b'00000000'),
+                    ('single step', 's', b'S05'),
+                    ('vCont step', 'vCont;s:1', b'S05'),
+                    ('vCont continue', 'vCont;c', b'S05')]:
+                latency = measure_latency(client, request, expected, args.iterations)
+                results['latency_us'][name] = latency
+                print('{:<16} {:>10.1f} us'.format(name, latency))
+    finally:
+        test_harness.kill_gently(process)
+
+    if not os.path.exists(test_harness.CACHE_DIR):
+        os.makedirs(test_harness.CACHE_DIR)
+
+    with open(BENCHMARK_HISTORY_FILE, 'a') as outfile:
+        outfile.write(json.dumps(results) + '\n')
+
+if __name__ == '__main__':
+    main()
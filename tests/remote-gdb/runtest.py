@@ -20,12 +20,12 @@ Validates remote GDB debugger interface in emulator
 """
 
 import os
-import socket
+import random
 import subprocess
 import sys
-import time
 
 sys.path.insert(0, '..')
+import gdb_client
 import test_harness
 
 
@@ -37,73 +37,19 @@ class DebugConnection(object):
     to automatically close the socket when the test is done.
     """
 
-    def __init__(self):
-        self.sock = None
+    def __init__(self, port):
+        self.port = port
+        self.client = None
 
     def __enter__(self):
-        # Retry loop
-        for _ in range(10):
-            try:
-                time.sleep(0.3)
-                self.sock = socket.socket()
-                self.sock.connect(('localhost', 8000))
-                self.sock.settimeout(5)
-                break
-            except socket.error:
-                pass
-
+        # EmulatorProcess waits until the emulator is listening, so this
+        # doesn't need to retry.
+        self.client = gdb_client.GDBClient.connect('localhost', self.port,
+                                                   debug=test_harness.DEBUG)
         return self
 
     def __exit__(self, *unused):
-        self.sock.close()
-
-    def _send_packet(self, body):
-        """
-        Send request 'body' to emulator. This will encapsulate the request
-        in a packet and add the checksum.
-        """
-
-        if test_harness.DEBUG:
-            print('SEND: ' + body)
-
-        self.sock.send(str.encode('$' + body + '#'))
-
-        # Checksum
-        self.sock.send(str.encode('\x00\x00'))
-
-    def _receive_packet(self):
-        """
-        Wait for a full packet to be received from the peer and return
-        just the body.
-        """
-
-        while True:
-            leader = self.sock.recv(1)
-            if leader == '':
-                raise test_harness.TestException('unexpected socket close')
-
-            if leader == b'$':
-                break
-
-            if leader != b'+':
-                raise test_harness.TestException(
-                    'unexpected character ' + str(leader))
-
-        body = b''
-        while True:
-            char = self.sock.recv(1)
-            if char == b'#':
-                break
-
-            body += char
-
-        # Checksum
-        self.sock.recv(2)
-
-        if test_harness.DEBUG:
-            print('RECV: ' + body.decode())
-
-        return body
+        self.client.close()
 
     def expect(self, command, value):
         """
@@ -111,8 +57,11 @@ class DebugConnection(object):
         If the response doesn't match 'value', this will throw TestException.
         """
 
-        self._send_packet(command)
-        response = self._receive_packet()
+        try:
+            response = self.client.request(command)
+        except gdb_client.GDBClientError as exc:
+            raise test_harness.TestException(str(exc))
+
         if response != str.encode(value):
             raise test_harness.TestException(
                 'unexpected response. Wanted ' + value + ' got ' + str(response))
@@ -126,29 +75,41 @@ class EmulatorProcess(object):
     can be used in the 'with' construct.
     """
 
-    def __init__(self, hexfile, num_cores=1):
-        self.hexfile = hexfile
+    def __init__(self, image_file, num_cores=1):
+        self.image_file = image_file
         self.num_cores = num_cores
         self.process = None
         self.output = None
+        self.port = None
 
     def __enter__(self):
-        emulator_args = [
-            test_harness.EMULATOR_PATH,
-            '-m',
-            'gdb',
-            '-p',
-            str(self.num_cores),
-            self.hexfile
-        ]
-
         if test_harness.DEBUG:
             self.output = None
         else:
             self.output = open(os.devnull, 'w')
 
-        self.process = subprocess.Popen(emulator_args, stdout=self.output,
-                                        stderr=subprocess.STDOUT)
+        with test_harness.ReadySignal() as ready:
+            emulator_args = [
+                test_harness.EMULATOR_PATH,
+                '-m',
+                'gdb',
+                '-p',
+                str(self.num_cores),
+                '-g',
+                '0',    # Use any free port, so tests can run in parallel
+                '-R',
+                ready.path,
+                self.image_file
+            ]
+
+            self.process = ready.popen(emulator_args, stdout=self.output,
+                                       stderr=subprocess.STDOUT)
+            try:
+                self.port = int(ready.wait())
+            except:
+                self.__exit__()
+                raise
+
         return self
 
     def __exit__(self, *unused):
@@ -164,8 +125,8 @@ def gdb_breakpoint(*unused):
     This sets two breakpoints
     """
 
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Set breakpoint
         conn.expect('Z0,0000000c', 'OK')
 
@@ -197,8 +158,8 @@ def gdb_breakpoint(*unused):
 
 @test_harness.test(['emulator'])
 def gdb_remove_breakpoint(*unused):
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Set breakpoint
         conn.expect('Z0,0000000c', 'OK')
 
@@ -220,8 +181,8 @@ def gdb_remove_breakpoint(*unused):
 
 @test_harness.test(['emulator'])
 def gdb_breakpoint_errors(*unused):
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Set invalid breakpoint (memory out of range)
         conn.expect('Z0,20000000', '')
 
@@ -238,8 +199,8 @@ def gdb_breakpoint_errors(*unused):
 
 @test_harness.test(['emulator'])
 def gdb_single_step(*unused):
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Read PC register
         conn.expect('g40', '00000000')
 
@@ -268,8 +229,8 @@ def gdb_single_step_breakpoint(*unused):
     Ensure that if you single step through a breakpoint, it doesn't
     trigger and get stuck
     """
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Set breakpoint at second instruction (address 0x8)
         conn.expect('Z0,00000004', 'OK')
 
@@ -289,10 +250,10 @@ def gdb_single_step_breakpoint(*unused):
 
 @test_harness.test(['emulator'])
 def gdb_read_write_memory(*unused):
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Read program code at address 0. This should match values
-        # in count.hex
+        # in count.S
         conn.expect('m0,10', '0004000f0008000f000c000f0010000f')
 
         # (address, data)
@@ -327,10 +288,42 @@ def gdb_read_write_memory(*unused):
         conn.expect('m10000000,4', 'ffffffff')
 
 
+@test_harness.test(['emulator'])
+def gdb_binary_memory(*unused):
+    """
+    Write memory with binary X packets and read it back, using larger
+    transfers than fit in one packet, with and without acknowledgements.
+    """
+
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
+        client = conn.client
+
+        # Include all of the characters that need to be escaped
+        data = bytes(range(256)) + bytes(random.randint(0, 255) for _ in range(0x8000))
+        client.write_memory(0x100000, data)
+        if client.read_memory(0x100000, len(data)) != data:
+            raise test_harness.TestException('memory contents do not match (ack mode)')
+
+        if not client.start_no_ack_mode():
+            raise test_harness.TestException('QStartNoAckMode not supported')
+
+        if client.packet_size <= gdb_client.DEFAULT_PACKET_SIZE:
+            raise test_harness.TestException('emulator did not report packet size')
+
+        data = bytes(reversed(data))
+        client.write_memory(0x200003, data)
+        if client.read_memory(0x200003, len(data)) != data:
+            raise test_harness.TestException('memory contents do not match (no ack mode)')
+
+        # Make sure the connection still works for normal requests
+        conn.expect('qC', 'QC01')
+
+
 @test_harness.test(['emulator'])
 def gdb_read_write_register(*unused):
-    hexfile = test_harness.build_program(['register_values.S'])
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['register_values.S'])
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Run code to load registers
         conn.expect('C', 'S05')
 
@@ -338,7 +331,8 @@ def gdb_read_write_register(*unused):
         # order...)
         conn.expect('g1', '7d7f3e85')
         conn.expect('g20', 'f13403ef9d08309993f7819954ae4b3f7aeaa28f538fecbd95'
-                    '36f59c6d7251269525ee70d26e8d34f48912639c86ae5dba426c83aa8455e1e2dbba4b41a4f321')
+                    '36f59c6d7251269525ee70d26e8d34f48912639c86ae5dba426c83aa'
+                    '8455e1e2dbba4b41a4f321')
 
         tests = [
             (0, 'd3839b18'),
@@ -370,8 +364,8 @@ def gdb_read_write_register(*unused):
 
 @test_harness.test(['emulator'])
 def gdb_register_info(*unused):
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Scalar registers
         for idx in range(28):
             regid = str(idx + 1)
@@ -403,8 +397,9 @@ def gdb_register_info(*unused):
 
 @test_harness.test(['emulator'])
 def gdb_select_thread(*unused):
-    hexfile = test_harness.build_program(['multithreaded.S'], image_type='raw')
-    with EmulatorProcess(hexfile, num_cores=2), DebugConnection() as conn:
+    image_file = test_harness.build_program(['multithreaded.S'], image_type='raw')
+    with EmulatorProcess(image_file, num_cores=2) as emulator, \
+            DebugConnection(emulator.port) as conn:
         # Read thread ID
         conn.expect('qC', 'QC01')
 
@@ -464,19 +459,20 @@ def gdb_select_thread(*unused):
 @test_harness.test(['emulator'])
 def gdb_thread_info(*unused):
     # Run with one core, four threads
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         conn.expect('qfThreadInfo', 'm1,2,3,4')
 
     # Run with two cores, eight threads
-    with EmulatorProcess(hexfile, num_cores=2), DebugConnection() as conn:
+    with EmulatorProcess(image_file, num_cores=2) as emulator, \
+            DebugConnection(emulator.port) as conn:
         conn.expect('qfThreadInfo', 'm1,2,3,4,5,6,7,8')
 
 
 @test_harness.test(['emulator'])
 def gdb_invalid_command(*unused):
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # As far as I know, this is not a valid commanconn...
         # An error response returns nothing in the body
         conn.expect('@', '')
@@ -485,8 +481,8 @@ def gdb_invalid_command(*unused):
 @test_harness.test(['emulator'])
 def gdb_big_command(*unused):
     """ Check for buffer overflows by sending a very large command"""
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Big, invalid command. this should return an error (empty response)
         conn.expect('x' * 0x10000, '')
 
@@ -498,8 +494,8 @@ def gdb_big_command(*unused):
 def gdb_queries(*unused):
     """Miscellaneous query commands not covered in other tests"""
 
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         conn.expect('qLaunchSuccess', 'OK')
         conn.expect('qHostInfo', 'triple:nyuzi;endian:little;ptrsize:4')
         conn.expect('qProcessInfo', 'pid:1')
@@ -513,8 +509,8 @@ def gdb_queries(*unused):
 
 @test_harness.test(['emulator'])
 def gdb_vcont(*unused):
-    hexfile = test_harness.build_program(['count.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['count.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         # Set breakpoint
         conn.expect('Z0,00000010', 'OK')
 
@@ -529,8 +525,8 @@ def gdb_vcont(*unused):
 
 @test_harness.test(['emulator'])
 def gdb_crash(*unused):
-    hexfile = test_harness.build_program(['crash.S'], image_type='raw')
-    with EmulatorProcess(hexfile), DebugConnection() as conn:
+    image_file = test_harness.build_program(['crash.S'], image_type='raw')
+    with EmulatorProcess(image_file) as emulator, DebugConnection(emulator.port) as conn:
         conn.expect('c', 'S05')
         conn.expect('g40', '10000000')
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Run the tests from many runtest.py scripts as a single test run. This loads
+the tests registered by each script, then schedules all of them together, so
+with -j, slow suites like cosimulation start at the beginning instead of
+after everything else in their directory.
+
+This accepts the same options as runtest.py. Test names may be qualified with
+the directory (core/isa/add.S) or be a directory to run just that suite:
+
+    ./runall.py -j 8
+    ./runall.py -j 8 core/isa render/teapot
+"""
+
+import fnmatch
+import os
+import runpy
+import sys
+
+import test_harness
+
+# Same suites as the 'tests' target in CMakeLists.txt. The second field, if
+# present, restricts which targets tests in that directory run on, like the
+# --target and file name arguments there. It is a list of (file name
+# pattern, targets), and each test uses the first pattern that matches it.
+SUITES = [
+    ('unit',),
+    ('remote-gdb',),
+    ('jtag-debug',),
+    ('core/isa',),
+    ('core/cache_control',),
+    ('core/mmu',),
+    ('core/trap',),
+    ('stress/atomic',),
+    ('shared_memory',),
+    ('device/sdmmc',),
+    ('device/ps2',),
+    ('device/uart',),
+    ('libc',),
+    ('compiler-rt',),
+    ('cosimulation',),
+    ('render/clip',),
+    ('render/fill',),
+    ('render/teapot',),
+    ('render/triangle',),
+    ('render/blend',),
+    ('render/depthbuffer',),
+    ('render/mipmap',),
+    ('render/texture',),
+    ('kernel', [('*', ['emulator'])]),
+    ('whole-program', [('*noverilator.*', ['emulator']), ('*', ['verilator'])])
+]
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_suite(dirname, target_patterns=None):
+    """Run a suite's runtest.py script to register its tests"""
+
+    first_test = len(test_harness.registered_tests)
+    saved_path = sys.path[:]
+    suite_dir = os.path.join(TESTS_DIR, dirname)
+    os.chdir(suite_dir)
+
+    # Like running the script directly, so it can import modules in its
+    # directory.
+    sys.path.insert(0, suite_dir)
+    try:
+        runpy.run_path('runtest.py', run_name='__main__')
+    finally:
+        sys.path[:] = saved_path
+        os.chdir(TESTS_DIR)
+
+    if target_patterns:
+        for index in range(first_test, len(test_harness.registered_tests)):
+            func, name, test_targets, suite_dir = test_harness.registered_tests[index]
+            targets = next((targets for pattern, targets in target_patterns
+                            if fnmatch.fnmatch(name, pattern)), [])
+            test_harness.registered_tests[index] = (
+                func, name, [target for target in test_targets if target in targets],
+                suite_dir)
+
+
+def main():
+    test_harness.collect_only = True
+    for suite in SUITES:
+        load_suite(*suite)
+
+    test_harness.collect_only = False
+    test_harness.execute_tests()
+
+if __name__ == '__main__':
+    main()
@@ -73,17 +73,18 @@ def shared_memory(*unused):
 
     # Start the emulator
     memory_file = tempfile.NamedTemporaryFile()
-    args = [test_harness.EMULATOR_PATH, '-s',
-            memory_file.name, test_harness.HEX_FILE]
-    process = subprocess.Popen(args, stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT)
+    ready = test_harness.ReadySignal()
+    args = [test_harness.EMULATOR_PATH, '-s', memory_file.name,
+            '-R', ready.path, test_harness.BIN_FILE]
+    process = ready.popen(args, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
 
     try:
-        # Hack: Need to wait for the emulator to create the shared memory
-        # file and initialize it. There's currently no way for the emulator
-        # to signal that this has completed, so just sleep a bit and hope
-        # it's done.
-        time.sleep(1.0)
+        # Wait for the emulator to create the shared memory file and
+        # initialize it.
+        with ready:
+            ready.wait()
+
         memory = mmap.mmap(memory_file.fileno(), 0)
         testvalues = [random.randint(0, 0xffffffff) for __ in range(10)]
         for value in testvalues:
@@ -20,14 +20,26 @@ in subdirectories under this one.
 """
 
 import argparse
+import asyncio
 import binascii
+import codecs
+import functools
 import hashlib
+import json
+import mmap
+import multiprocessing
 import os
 import re
+import select
 import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 import traceback
 
 COMPILER_DIR = '/usr/local/llvm-nyuzi/bin/'
@@ -35,10 +47,15 @@ PROJECT_TOP = os.path.normpath(
     os.path.dirname(os.path.abspath(__file__)) + '/../')
 WORK_DIR = PROJECT_TOP + '/tests/work/'
 ELF_FILE = WORK_DIR + 'program.elf'
-HEX_FILE = WORK_DIR + 'program.hex'
+BIN_FILE = WORK_DIR + 'program.bin'
+CACHE_DIR = PROJECT_TOP + '/tests/cache/'
+BUILD_CACHE_DIR = CACHE_DIR + 'build/'
+BUILD_CACHE_MAX_SIZE = 0x20000000  # 512MB
 ALL_TARGETS = ['verilator', 'emulator']
 DEFAULT_TARGETS = ['verilator', 'emulator']
 DEBUG = False
+STREAM_CHECK = False
+RANDSEED = None
 LIB_INCLUDE_BASE = PROJECT_TOP + '/software/libs/'
 
 if os.path.isdir(PROJECT_TOP + '/build'):
@@ -52,6 +69,10 @@ else:
     LIB_DIR = PROJECT_TOP + '/software/libs/'
     KERNEL_DIR = PROJECT_TOP + '/software/kernel'
 
+# Address the kernel is linked at (IMAGE_BASE_ADDRESS in
+# software/kernel/CMakeLists.txt)
+KERNEL_BASE_ADDRESS = 0xc0000000
+
 VSIM_PATH = BIN_DIR + 'nyuzi_vsim'
 EMULATOR_PATH = BIN_DIR + 'nyuzi_emulator'
 
@@ -68,17 +89,202 @@ parser.add_argument('--debug', action='store_true',
                     help='enable verbose output to debug test failures')
 parser.add_argument('--list', action='store_true',
                     help='list availble tests')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of tests to run in parallel')
+parser.add_argument('--no-build-cache', action='store_true',
+                    help='always recompile test programs')
+parser.add_argument('--emulator-server', action='store_true',
+                    help='run emulator tests in one persistent emulator process')
+parser.add_argument('--stream-check', action='store_true',
+                    help='stop the simulator as soon as the CHECK patterns '
+                    'in the test source determine the result')
+parser.add_argument('--randseed', type=int,
+                    help='seed for the random values verilator assigns to '
+                    'uninitialized signals, to reproduce a failure')
+parser.add_argument('--report-slow', action='store_true',
+                    help='list tests whose last run was slower than usual, '
+                    'instead of running tests')
 parser.add_argument('names', nargs=argparse.REMAINDER,
                     help='names of specific tests to run')
 args = parser.parse_args()
 
 
+# Memoizes _hash_file results, keyed on (path, mtime, size), so large
+# files like libc.a are only read once per process.
+_file_hashes = {}
+
+
+def _hash_file(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(0x10000), b''):
+                sha.update(block)
+
+        _file_hashes[key] = sha.hexdigest()
+
+    return _file_hashes[key]
+
+
+def _build_cache_key(source_files, compiler_args, extra_files):
+    """
+    Compute a hash of everything that affects the output of build_program:
+    the compiler command line, the contents of every file it references
+    (sources, libraries, plus extra_files), headers that sit next to the
+    sources or anywhere under an -I directory, and the identity of the tools
+    themselves.
+    """
+
+    sha = hashlib.sha1()
+    sha.update(repr(compiler_args).encode())
+
+    dependencies = [arg for arg in compiler_args if os.path.isfile(arg)]
+    dependencies += extra_files
+    header_dirs = set(os.path.dirname(os.path.abspath(source))
+                      for source in source_files)
+    header_dirs.add(PROJECT_TOP + '/tests')
+    for dirname in sorted(header_dirs):
+        dependencies += [os.path.join(dirname, fname) for fname in sorted(os.listdir(dirname))
+                         if fname.endswith(('.h', '.hpp', '.inc'))]
+
+    # Headers in include directories can be included from subdirectories
+    # (for example, sys/ in libc), so search them recursively.
+    include_dirs = [arg[2:] for arg in compiler_args if arg.startswith('-I')]
+    for include_dir in include_dirs:
+        for dirname, subdirs, fnames in os.walk(include_dir):
+            subdirs.sort()
+            dependencies += [os.path.join(dirname, fname) for fname in sorted(fnames)
+                             if fname.endswith(('.h', '.hpp', '.inc'))]
+
+    for path in dependencies:
+        sha.update(path.encode())
+        sha.update(_hash_file(path).encode())
+
+    stat = os.stat(COMPILER_DIR + 'clang')
+    sha.update('clang {} {}'.format(stat.st_mtime_ns, stat.st_size).encode())
+
+    # This file converts the ELF file into a memory image
+    sha.update(_hash_file(os.path.abspath(__file__)).encode())
+
+    return sha.hexdigest()
+
+
+def _build_cache_lookup(key, output_files):
+    """
+    If a previous build with the same key is in the cache, copy its outputs
+    to output_files and return True. Otherwise return False.
+    """
+
+    entry_dir = BUILD_CACHE_DIR + key + '/'
+    try:
+        for path in output_files:
+            shutil.copyfile(entry_dir + os.path.basename(path), path)
+
+        # Touch the entry so it is treated as recently used for eviction.
+        os.utime(entry_dir)
+    except OSError:
+        return False
+
+    if DEBUG:
+        print('build cache hit ' + key)
+
+    return True
+
+
+def _build_cache_store(key, output_files):
+    """
+    Copy the outputs of a build into the cache, then evict least recently
+    used entries until the cache is smaller than BUILD_CACHE_MAX_SIZE.
+    """
+
+    # Populate a temporary directory and rename it into place so other
+    # processes never see a partially written entry.
+    os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+    temp_dir = BUILD_CACHE_DIR + key + '.' + str(os.getpid()) + '.tmp/'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    for path in output_files:
+        shutil.copyfile(path, temp_dir + os.path.basename(path))
+
+    try:
+        os.rename(temp_dir, BUILD_CACHE_DIR + key)
+    except OSError:
+        # Another process stored the same entry first.
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return
+
+    entries = []
+    total_size = 0
+    for name in os.listdir(BUILD_CACHE_DIR):
+        entry_dir = BUILD_CACHE_DIR + name
+        if name.endswith('.tmp'):
+            continue
+
+        try:
+            size = sum(os.path.getsize(os.path.join(entry_dir, fname))
+                       for fname in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        except OSError:
+            continue  # Evicted by another process
+
+        total_size += size
+
+    entries.sort()
+    while total_size > BUILD_CACHE_MAX_SIZE and entries:
+        _, size, entry_dir = entries.pop(0)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+
+# Time spent in each phase of the currently running test, in seconds. The
+# key is the phase name ('compile', 'sim', or 'check').
+_phase_times = {}
+_active_phase = None
+
+
+def _timed_phase(phase):
+    """
+    Decorator that adds the time spent in the function to _phase_times.
+    If the function is called from another timed function (for example,
+    run_kernel calls run_program), the time is only counted once, in the
+    phase of the outer function.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*func_args, **func_kwargs):
+            global _active_phase
+            if _active_phase:
+                return func(*func_args, **func_kwargs)
+
+            _active_phase = phase
+            start_time = time.monotonic()
+            try:
+                return func(*func_args, **func_kwargs)
+            finally:
+                _phase_times[phase] = _phase_times.get(phase, 0) + \
+                    time.monotonic() - start_time
+                _active_phase = None
+
+        return wrapper
+
+    return decorator
+
+
+@_timed_phase('compile')
 def build_program(source_files, image_type='bare-metal', opt_level='-O3', cflags=None):
     """Compile/assemble one or more files.
 
     If there are .c files in the list, this will link in crt0, libc,
-    and libos. It converts the binary to a hex file that can be loaded
-    into memory.
+    and libos. Unless image_type is 'user', it converts the ELF file to a
+    raw memory image (BIN_FILE), which the emulator and verilator model load
+    directly.
+
+    Results are cached in BUILD_CACHE_DIR, keyed on a hash of the inputs,
+    so building the same program again (for example, for another target)
+    just copies the previous output. Pass --no-build-cache to disable this.
 
     Args:
             source_files: List of files, which can be C/C++ or assembly
@@ -91,14 +297,14 @@ def build_program(source_files, image_type='bare-metal', opt_level='-O3', cflags
             cflags: Additional command line flags to pass to C compiler.
 
     Returns:
-            Name of hex file created
+            Name of the image file created (ELF_FILE for 'user' images,
+            BIN_FILE otherwise)
 
     Raises:
             TestException if compilation failed, will contain compiler output
     """
     assert isinstance(source_files, list)
     compiler_args = [COMPILER_DIR + 'clang',
-                     '-o', ELF_FILE,
                      '-w',
                      opt_level]
 
@@ -121,21 +327,35 @@ def build_program(source_files, image_type='bare-metal', opt_level='-O3', cflags
         else:
             compiler_args += [LIB_DIR + 'libos/bare-metal/libos-bare.a']
 
-    try:
-        subprocess.check_output(compiler_args, stderr=subprocess.STDOUT)
-        if image_type == 'raw':
-            dump_hex(input_file=ELF_FILE, output_file=HEX_FILE)
-            return HEX_FILE
+    # The linker writes raw images directly, without an ELF file
+    if image_type == 'user':
+        output_files = [ELF_FILE]
+    elif image_type == 'raw':
+        output_files = [BIN_FILE]
+    else:
+        output_files = [ELF_FILE, BIN_FILE]
 
-        if image_type == 'bare-metal':
-            subprocess.check_output([COMPILER_DIR + 'elf2hex', '-o', HEX_FILE, ELF_FILE],
-                                    stderr=subprocess.STDOUT)
-            return HEX_FILE
+    cache_key = None
+    if not args.no_build_cache:
+        linker_scripts = ['../one-segment.ld'] if image_type == 'raw' else []
+        cache_key = _build_cache_key(source_files, compiler_args, linker_scripts)
+        if _build_cache_lookup(cache_key, output_files):
+            return output_files[-1]
 
-        return ELF_FILE
+    try:
+        subprocess.check_output(compiler_args + ['-o', output_files[0]],
+                                stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as exc:
         raise TestException('Compilation failed:\n' + exc.output.decode())
 
+    if image_type == 'bare-metal':
+        elf_to_binary(input_file=ELF_FILE, output_file=BIN_FILE)
+
+    if cache_key:
+        _build_cache_store(cache_key, output_files)
+
+    return output_files[-1]
+
 def kill_gently(process):
     """
     Give process a chance to terminate normally, then kill it
@@ -150,60 +370,384 @@ def kill_gently(process):
         # Process may be hung
         process.kill()
 
-class TimedProcessRunner(threading.Thread):
+class ReadySignal(object):
 
     """
-    Wrapper calls communicate on a process, but throws exception if it
-    takes too long
+    A pipe that a program writes a line to when it is ready, for example,
+    when it has started listening for connections (see the emulator's -R
+    option and verilator's +readyfile=). The program opens it as the file
+    'path'. If the program exits before it is ready, wait() fails right
+    away instead of waiting for the timeout. This supports __enter__ and
+    __exit__ methods to close the pipe:
+
+        with test_harness.ReadySignal() as ready:
+            process = ready.popen([test_harness.EMULATOR_PATH, '-R',
+                                   ready.path, image_file])
+            ready.wait()
     """
 
     def __init__(self):
-        threading.Thread.__init__(self)
-        self.finished = threading.Event()
-        self.daemon = True  # Kill watchdog if we exit
-        self.process = None
-        self.timeout = 0
+        self.read_fd, self.write_fd = os.pipe()
+        self.path = '/dev/fd/' + str(self.write_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+    def popen(self, args, **popen_args):
+        """Call subprocess.Popen, passing the pipe to the new process"""
+
+        process = subprocess.Popen(args, pass_fds=(self.write_fd,), **popen_args)
+
+        # Only the program should have the write end open, so reads return
+        # end of file when it exits.
+        os.close(self.write_fd)
+        self.write_fd = None
+        return process
+
+    def wait(self, timeout=60):
+        """
+        Wait until the program signals that it is ready.
+
+        Returns:
+                The line the program wrote, without the newline.
+
+        Raises:
+                TestException if the program exits first or does not become
+                ready in 'timeout' seconds.
+        """
+
+        deadline = time.monotonic() + timeout
+        message = b''
+        while not message.endswith(b'\n'):
+            remaining = deadline - time.monotonic()
+            readable, _, _ = select.select([self.read_fd], [], [], max(remaining, 0))
+            if not readable:
+                raise TestException('timed out waiting for program to be ready')
+
+            data = os.read(self.read_fd, 256)
+            if not data:
+                raise TestException('program exited before it was ready')
+
+            message += data
+
+        return message.decode().strip()
+
+    def close(self):
+        for fd in (self.read_fd, self.write_fd):
+            if fd is not None:
+                os.close(fd)
+
+        self.read_fd = None
+        self.write_fd = None
+
+
+async def kill_gently_async(process):
+    """Same as kill_gently, for an asyncio subprocess"""
+
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), 2)
+    except asyncio.TimeoutError:
+        # Process may be hung
+        process.kill()
+        await process.wait()
+
+
+async def run_process(args, timeout, input=None, output_callback=None):
+    """
+    Coroutine that runs the program specified by args on the current event
+    loop. Many of these can run concurrently on one loop (see run_processes),
+    without a thread for each process.
+
+    Args:
+            args: Command line of the program.
+            timeout: If the program does not complete in this many seconds,
+               kill it and throw a TestException.
+            input: If not None, bytes to write to the program's standard
+               input, which is closed afterward.
+            output_callback: If not None, called with each block of output
+               (bytes, standard output and error combined) as it arrives.
+               If it returns True, the program is stopped with
+               kill_gently_async.
+
+    Returns:
+            A tuple (returncode, output, stopped_early), where output is
+            everything the program wrote, as bytes, and stopped_early is
+            True if output_callback stopped the program.
+
+    Raises:
+            TestException if the program did not complete in time.
+    """
+
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+
+    async def write_input():
+        try:
+            process.stdin.write(input)
+            await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # Program exited without reading everything
+
+    async def read_output():
+        while True:
+            data = await process.stdout.read(0x10000)
+            if not data:
+                await process.wait()
+                return False
+
+            chunks.append(data)
+            if output_callback and output_callback(data):
+                await kill_gently_async(process)
+                return True
+
+    chunks = []
+    input_task = None
+    if input is not None:
+        input_task = asyncio.ensure_future(write_input())
+
+    try:
+        stopped_early = await asyncio.wait_for(read_output(), timeout)
+    except asyncio.TimeoutError:
+        await kill_gently_async(process)
+        raise TestException('Test timed out')
+    finally:
+        if input_task:
+            input_task.cancel()
+
+        if process.returncode is None:
+            # Exception or cancellation, don't leave the program running.
+            process.kill()
+            await process.wait()
+
+    return process.returncode, b''.join(chunks), stopped_early
+
+
+def run_processes(commands, timeout, max_concurrent=None):
+    """
+    Run many programs concurrently on one event loop.
+
+    Args:
+            commands: List of command lines.
+            timeout: Timeout for each program, in seconds.
+            max_concurrent: If not None, run at most this many programs
+               at once.
+
+    Returns:
+            List with an entry for each command, which is either the
+            result of run_process or the TestException it raised.
+    """
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrent or len(commands) or 1)
+
+        async def run_one(args):
+            async with semaphore:
+                return await run_process(args, timeout)
+
+        return await asyncio.gather(*[run_one(args) for args in commands],
+                                    return_exceptions=True)
+
+    return asyncio.run(run_all())
+
+
+class TimedProcessRunner(object):
+
+    """
+    Wrapper calls communicate on a process, but throws exception if it
+    takes too long. This is for tests that need to start the process
+    themselves. Otherwise, run_test_with_timeout or run_process are
+    simpler.
+    """
 
     def communicate(self, process, timeout, input=None):
         """Call process.communicate(), but throw exception if it has not completed
         before 'timeout' seconds have elapsed"""
 
-        self.timeout = timeout
-        self.process = process
-        self.start()  # Start watchdog
-        result = self.process.communicate(input=input)
-        if self.finished.is_set():
+        try:
+            result = process.communicate(input=input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_gently(process)
+            process.communicate()   # Close pipes
             raise TestException('Test timed out')
-        else:
-            self.finished.set()  # Stop watchdog
 
-        if self.process.poll():
+        if process.poll():
             # Non-zero return code. Probably target program crash.
             raise TestException(
                 'Process returned error: ' + result[0].decode())
 
         return result
 
-    # Watchdog thread kills process if it runs too long
-    def run(self):
-        if not self.finished.wait(self.timeout):
-            # Timed out
-            self.finished.set()
-            kill_gently(self.process)
 
-
-def run_test_with_timeout(args, timeout):
+def run_test_with_timeout(args, timeout, input=None):
     """
     Run the program specified by args. If it does not complete
-    in 'timeout' seconds, throw a TestException.
+    in 'timeout' seconds, throw a TestException. If input is not None,
+    it is written to the program's standard input.
     """
 
-    process = subprocess.Popen(args, stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT)
-    output, _ = TimedProcessRunner().communicate(process, timeout)
+    returncode, output, _ = asyncio.run(run_process(args, timeout, input))
+    if returncode:
+        # Non-zero return code. Probably target program crash.
+        raise TestException('Process returned error: ' + output.decode())
+
     return output.decode()
 
 
+def _run_test_until_checked(args, timeout, matcher):
+    """
+    Run the program specified by args, passing its output to matcher
+    (a CheckMatcher) as it arrives. If the output determines the result
+    of the check before the program exits, kill the program instead of
+    waiting for it to finish.
+
+    Returns:
+            A tuple (output, stopped_early), where stopped_early is True if
+            the program was killed because the result was already known.
+
+    Raises:
+            TestException if the program does not complete in 'timeout'
+            seconds or exits with an error.
+    """
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def check_output(data):
+        matcher.feed(decoder.decode(data))
+        return matcher.done
+
+    returncode, _, stopped_early = asyncio.run(
+        run_process(args, timeout, output_callback=check_output))
+    if not stopped_early:
+        matcher.feed(decoder.decode(b'', final=True))
+        if returncode:
+            raise TestException('Process returned error: ' + matcher.output)
+
+    return matcher.output, stopped_early
+
+
+# If --emulator-server was passed, this is the emulator process that is
+# running in server mode (-m server), and the path of the socket it is
+# listening on.
+_emulator_server = None
+_emulator_server_socket = None
+
+
+def _start_emulator_server():
+    """
+    Start an emulator in server mode. run_program will send requests
+    to it instead of starting a new emulator process for each test.
+    """
+
+    global _emulator_server, _emulator_server_socket
+
+    # UNIX domain socket paths have a short maximum length, so don't put
+    # this in WORK_DIR.
+    _emulator_server_socket = tempfile.mkdtemp(prefix='nyuzi_emulator') + '/socket'
+    with ReadySignal() as ready:
+        _emulator_server = ready.popen([EMULATOR_PATH, '-m', 'server',
+                                        '-R', ready.path,
+                                        _emulator_server_socket],
+                                       start_new_session=True)
+        try:
+            ready.wait()
+        except TestException:
+            _stop_emulator_server()
+            raise TestException('Emulator server did not start')
+
+
+def _stop_emulator_server():
+    """
+    Kill the emulator server and any programs it is running (which are in
+    the same process group).
+    """
+
+    global _emulator_server, _emulator_server_socket
+
+    try:
+        os.killpg(_emulator_server.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+    _emulator_server.wait()
+    shutil.rmtree(os.path.dirname(_emulator_server_socket), ignore_errors=True)
+    _emulator_server = None
+    _emulator_server_socket = None
+
+
+def _run_emulator_server_request(request, timeout, matcher=None):
+    """
+    Send a request to the emulator server to run a program (see
+    tools/emulator/server.c for the format). The server kills the program
+    after 'timeout' seconds.
+
+    If matcher (a CheckMatcher) is passed, it is fed the output as it
+    arrives. When the output determines the result of the check, this
+    closes the connection, which makes the server kill the program.
+
+    Returns:
+            A tuple (output, stopped_early), where output is the output of
+            the program and stopped_early is True if the program was killed
+            because the result was already known.
+
+    Raises:
+            TestException if the program timed out or returned an error.
+    """
+
+    request += ['timeout ' + str(timeout)]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # The server enforces the timeout, this just prevents hanging forever
+        # if the server is wedged.
+        sock.settimeout(timeout + 10)
+        sock.connect(_emulator_server_socket)
+
+        sock.sendall(('\n'.join(request) + '\n\n').encode())
+        chunks = []
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            data = sock.recv(0x10000)
+            if not data:
+                break
+
+            chunks.append(data)
+            if matcher:
+                # Once the trailer (a zero byte and the exit code) arrives,
+                # the program has finished, so there's no reason to stop it.
+                if b'\0' in data:
+                    matcher = None
+                else:
+                    matcher.feed(decoder.decode(data))
+                    if matcher.done:
+                        return matcher.output, True
+    except socket.timeout:
+        raise TestException('Test timed out')
+    except OSError as exc:
+        raise TestException('Error communicating with emulator server: ' + str(exc))
+    finally:
+        sock.close()
+
+    # The output is followed by a zero byte and the exit code
+    output, separator, exit_code = b''.join(chunks).rpartition(b'\0')
+    if not separator:
+        raise TestException('Emulator server closed connection unexpectedly')
+
+    exit_code = int(exit_code)
+    if exit_code == 128 + signal.SIGALRM:
+        raise TestException('Test timed out')
+    elif exit_code != 0:
+        raise TestException('Process returned error: ' + output.decode())
+
+    return output.decode(), False
+
+
 def reset_fpga():
     args = ['quartus_stp', '-t', PROJECT_TOP + '/tests/reset_altera.tcl']
 
@@ -214,6 +758,22 @@ def reset_fpga():
             'Failed to reset dev board:\n' + exc.output.decode())
 
 
+def verilator_seed_args(randseed=None):
+    """
+    Verilator arguments to set the seed for randomizing uninitialized
+    signals. Uses the --randseed command line option if randseed is None.
+    If neither is set, verilator picks a seed (and prints it).
+    """
+    if randseed is None:
+        randseed = RANDSEED
+
+    if randseed is None:
+        return []
+
+    return ['+randseed=' + str(randseed)]
+
+
+@_timed_phase('sim')
 def run_program(
         target='emulator',
         block_device=None,
@@ -223,10 +783,11 @@ def run_program(
         timeout=60,
         flush_l2=False,
         trace=False,
-        executable=None):
+        executable=None,
+        check_source=None):
     """Run test program.
 
-    This uses the hex file produced by build_program.
+    This uses the image file produced by build_program.
 
     Args:
             target: Which target will run the program. Can be 'verilator'
@@ -238,6 +799,9 @@ def run_program(
             dump_base: if dump_file is specified, base physical memory address to start
                writing mempry from.
             dump_length: number of bytes of memory to write to dump_file
+            check_source: Source file with CHECK patterns the caller will pass
+               to check_result. With --stream-check, the program is stopped
+               as soon as its output determines the result of that check.
 
     Returns:
             Output from program, anything written to virtual serial device,
@@ -248,9 +812,23 @@ def run_program(
               execute for some other reason.
     """
     if not executable:
-        executable = HEX_FILE
+        executable = BIN_FILE
+
+    matcher = None
+    if check_source and STREAM_CHECK:
+        matcher = CheckMatcher(check_source)
+
+    if target == 'emulator' and _emulator_server_socket:
+        request = ['image ' + os.path.abspath(executable), 'random']
+        if block_device:
+            request += ['block ' + os.path.abspath(block_device)]
 
-    if target == 'emulator':
+        if dump_file:
+            request += ['dump ' + os.path.abspath(dump_file) + ',' +
+                        hex(dump_base) + ',' + hex(dump_length)]
+
+        output, _ = _run_emulator_server_request(request, timeout, matcher)
+    elif target == 'emulator':
         args = [EMULATOR_PATH]
         args += ['-a']  # Enable thread scheduling randomization by default
         if block_device:
@@ -261,7 +839,10 @@ def run_program(
                      hex(dump_base) + ',' + hex(dump_length)]
 
         args += [executable]
-        output = run_test_with_timeout(args, timeout)
+        if matcher:
+            output, _ = _run_test_until_checked(args, timeout, matcher)
+        else:
+            output = run_test_with_timeout(args, timeout)
     elif target == 'verilator':
         args = [VSIM_PATH]
         if block_device:
@@ -278,14 +859,17 @@ def run_program(
         if trace:
             args += ['+trace']
 
+        args += verilator_seed_args()
         args += ['+bin=' + executable]
-        output = run_test_with_timeout(args, timeout)
-        if '***HALTED***' not in output:
+        stopped_early = False
+        if matcher:
+            output, stopped_early = _run_test_until_checked(args, timeout, matcher)
+        else:
+            output = run_test_with_timeout(args, timeout)
+
+        if not stopped_early and '***HALTED***' not in output:
             raise TestException(output + '\nProgram did not halt normally')
     elif target == 'fpga':
-        if block_device:
-            args += [block_device]
-
         if dump_file:
             raise TestException('dump file is not supported on FPGA')
 
@@ -296,12 +880,21 @@ def run_program(
             raise TestException(
                 'Need to set SERIAL_PORT to device path in environment')
 
+        # serial_boot only reads hex files
+        if not executable.endswith('.hex'):
+            hex_file = WORK_DIR + 'program.hex'
+            dump_hex(input_file=executable, output_file=hex_file)
+            executable = hex_file
+
         args = [
             BIN_DIR + 'serial_boot',
             os.environ['SERIAL_PORT'],
             executable
         ]
 
+        if block_device:
+            args += [block_device]
+
         reset_fpga()
 
         output = run_test_with_timeout(args, timeout)
@@ -314,18 +907,22 @@ def run_program(
     return output
 
 
+@_timed_phase('sim')
 def run_kernel(
         target='emulator',
-        timeout=60):
+        timeout=60,
+        check_source=None):
     """Run test program as a user space program under the kernel.
 
     This uses the elf file produced by build_program. The kernel reads
     the file 'program.elf' from the filesystem. This will build a filesystem
-    with that image automatically.
+    with that image automatically, and a raw memory image of the kernel
+    from its ELF file.
 
     Args:
             target: Which target to execute on. Can be 'verilator'
                or 'emulator'.
+            check_source: Source file with CHECK patterns (see run_program).
 
     Returns:
             Output from program, anything written to virtual serial device
@@ -338,9 +935,14 @@ def run_kernel(
     subprocess.check_output([BIN_DIR + 'mkfs', block_file, ELF_FILE],
                             stderr=subprocess.STDOUT)
 
+    # The kernel is linked at KERNEL_BASE_ADDRESS, but loaded at 0.
+    kernel_image = WORK_DIR + 'kernel.bin'
+    elf_to_binary(input_file=KERNEL_DIR + '/kernel', output_file=kernel_image,
+                  base_address=KERNEL_BASE_ADDRESS)
+
     output = run_program(target=target, block_device=block_file,
-                         timeout=timeout, executable=KERNEL_DIR +
-                         '/kernel.hex')
+                         timeout=timeout, executable=kernel_image,
+                         check_source=check_source)
 
     if DEBUG:
         print('Program Output:\n' + output)
@@ -348,13 +950,70 @@ def run_kernel(
     return output
 
 
-def assert_files_equal(file1, file2, error_msg='file mismatch'):
+# Size of the blocks assert_files_equal compares at once. Each comparison is
+# a single memcmp, so large blocks are much faster than comparing smaller
+# pieces in Python.
+COMPARE_BLOCK_SIZE = 0x10000
+CACHE_LINE_LENGTH = 64
+
+
+def _find_first_difference(buf1, buf2, start, end):
+    """
+    Return the offset of the first byte in the range [start, end) that
+    differs between buf1 and buf2, or None if the range is the same.
+    This compares whole blocks, then bisects the first block that doesn't
+    match.
+    """
+
+    for block_start in range(start, end, COMPARE_BLOCK_SIZE):
+        low = block_start
+        high = min(block_start + COMPARE_BLOCK_SIZE, end)
+        if buf1[low:high] == buf2[low:high]:
+            continue
+
+        while high - low > 1:
+            mid = (low + high) // 2
+            if buf1[low:mid] != buf2[low:mid]:
+                high = mid
+            else:
+                low = mid
+
+        return low
+
+    return None
+
+
+def _format_difference(buf1, buf2, offset):
+    """
+    Return a string showing the 16 byte aligned row containing offset
+    in both buffers, with the bytes that differ marked.
+    """
+
+    row_start = offset & ~15
+    row_end = min(row_start + 16, len(buf1))
+    row1 = buf1[row_start:row_end]
+    row2 = buf2[row_start:row_end]
+    text = '{:08x} {}\n'.format(row_start, binascii.hexlify(row1).decode())
+    text += '{:08x} {}\n'.format(row_start, binascii.hexlify(row2).decode())
+    text += '         ' + ''.join('^^' if val1 != val2 else '  '
+                                  for val1, val2 in zip(row1, row2))
+    return text
+
+
+@_timed_phase('check')
+def assert_files_equal(file1, file2, error_msg='file mismatch', report_all=False):
     """Read two files and throw a TestException if they are not the same
 
+    The files are memory mapped and compared in large blocks, so this is
+    fast even for multi-megabyte memory dumps.
+
     Args:
             file1: relative path to first file
             file2: relative path to second file
             error_msg: If there is a file mismatch, prepend this to error output
+            report_all: If True, the exception text also lists every
+              64 byte cache line that differs, to show how widespread
+              the mismatch is.
 
     Returns:
             Nothing
@@ -364,59 +1023,58 @@ def assert_files_equal(file1, file2, error_msg='file mismatch'):
             details about where the mismatch occurred.
     """
 
-    bufsize = 0x1000
-    block_offset = 0
     with open(file1, 'rb') as fp1, open(file2, 'rb') as fp2:
-        while True:
-            block1 = bytearray(fp1.read(bufsize))
-            block2 = bytearray(fp2.read(bufsize))
-            if len(block1) < len(block2):
-                raise TestException(error_msg + ': file1 shorter than file2')
-            elif len(block1) > len(block2):
-                raise TestException(error_msg + ': file1 longer than file2')
-
-            if block1 != block2:
-                for offset, (val1, val2) in enumerate(zip(block1, block2)):
-                    if val1 != val2:
-                        # Show the difference
-                        exception_text = error_msg + ':\n'
-                        rounded_offset = offset & ~15
-                        exception_text += '{:08x} '.format(block_offset +
-                                                           rounded_offset)
-                        for lineoffs in range(16):
-                            exception_text += '{:02x}'.format(
-                                block1[rounded_offset + lineoffs])
-
-                        exception_text += '\n{:08x} '.format(
-                            block_offset + rounded_offset)
-                        for lineoffs in range(16):
-                            exception_text += '{:02x}'.format(
-                                block2[rounded_offset + lineoffs])
-
-                        exception_text += '\n         '
-                        for lineoffs in range(16):
-                            if block1[rounded_offset + lineoffs] \
-                                    != block2[rounded_offset + lineoffs]:
-                                exception_text += '^^'
-                            else:
-                                exception_text += '  '
-
-                        raise TestException(exception_text)
-
-            if not block1:
+        length1 = os.fstat(fp1.fileno()).st_size
+        length2 = os.fstat(fp2.fileno()).st_size
+        if length1 < length2:
+            raise TestException(error_msg + ': file1 shorter than file2')
+        elif length1 > length2:
+            raise TestException(error_msg + ': file1 longer than file2')
+        elif length1 == 0:
+            return  # Can't mmap empty files
+
+        with mmap.mmap(fp1.fileno(), 0, access=mmap.ACCESS_READ) as buf1, \
+                mmap.mmap(fp2.fileno(), 0, access=mmap.ACCESS_READ) as buf2:
+            first_difference = _find_first_difference(buf1, buf2, 0, length1)
+            if first_difference is None:
                 return
 
-            block_offset += len(block1)
+            exception_text = error_msg + ':\n'
+            if report_all:
+                bad_lines = []
+                offset = first_difference & ~(CACHE_LINE_LENGTH - 1)
+                while offset is not None:
+                    line_end = min(offset + CACHE_LINE_LENGTH, length1)
+                    diff_count = sum(1 for val1, val2 in zip(
+                        buf1[offset:line_end], buf2[offset:line_end]) if val1 != val2)
+                    bad_lines.append('{:08x} ({} bytes differ)'.format(offset, diff_count))
+                    offset = _find_first_difference(buf1, buf2, line_end, length1)
+                    if offset is not None:
+                        offset &= ~(CACHE_LINE_LENGTH - 1)
+
+                total_lines = (length1 + CACHE_LINE_LENGTH - 1) // CACHE_LINE_LENGTH
+                exception_text += '{} of {} cache lines differ:\n'.format(
+                    len(bad_lines), total_lines)
+                exception_text += '\n'.join(bad_lines) + '\nfirst difference:\n'
+
+            exception_text += _format_difference(buf1, buf2, first_difference)
+            raise TestException(exception_text)
 
 
 registered_tests = []
 
+# When this is set, execute_tests() returns without doing anything. runall.py
+# sets it so it can load the tests from many runtest.py scripts, then run
+# them all together.
+collect_only = False
 
 def register_tests(func, names, targets=None):
     """Add a list of tests to be run when execute_tests is called.
 
     This function can be called multiple times, it will append passed
-    tests to the existing list.
+    tests to the existing list. The current directory is recorded with
+    each test, and the test function is called with that as the current
+    directory.
 
     Args:
             func: A function that will be called for each of the elements
@@ -434,7 +1092,8 @@ def register_tests(func, names, targets=None):
     if not targets:
         targets = ALL_TARGETS[:]
 
-    registered_tests += [(func, name, targets) for name in names]
+    suite_dir = os.getcwd()
+    registered_tests += [(func, name, targets, suite_dir) for name in names]
 
 
 def test(param=None):
@@ -478,6 +1137,256 @@ COLOR_GREEN = '[\x1b[32m'
 COLOR_NONE = '\x1b[0m]'
 OUTPUT_ALIGN = 50
 
+TEST_HISTORY_FILE = CACHE_DIR + 'test_history.jsonl'
+TEST_HISTORY_MAX_SIZE = 0x400000  # 4MB
+
+# --report-slow compares the most recent run of each test against the median
+# of this many runs before it.
+SLOW_TEST_WINDOW = 10
+SLOW_TEST_THRESHOLD = 1.3
+TEST_PHASES = ['compile', 'sim', 'check']
+
+
+def _qualified_name(param, suite_dir):
+    """Name of a test that is unique across all suites, e.g. core/isa/add.S"""
+
+    return os.path.relpath(suite_dir, PROJECT_TOP + '/tests') + '/' + param
+
+
+def _load_test_history():
+    """
+    Read previous results from TEST_HISTORY_FILE.
+
+    Returns:
+            Dictionary, where the key is (qualified test name, target) and
+            the value is a list of records for that test, oldest first.
+            Each record is a dictionary with the keys 'passed', 'duration'
+            (in seconds), 'phases' (a dictionary of phase name to seconds),
+            and 'time' (when the test was run).
+    """
+
+    history = {}
+    try:
+        with open(TEST_HISTORY_FILE, 'r') as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                    key = (record['test'], record['target'])
+                except (ValueError, KeyError):
+                    continue  # Ignore truncated or malformed lines
+
+                history.setdefault(key, []).append(record)
+    except FileNotFoundError:
+        pass
+
+    return history
+
+
+def _save_test_results(results):
+    """
+    Append results to TEST_HISTORY_FILE. If the file has grown larger than
+    TEST_HISTORY_MAX_SIZE, older records are discarded, keeping enough for
+    --report-slow.
+
+    Args:
+            results: list of (qualified test name, target, passed, duration,
+                     phase times)
+    """
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    timestamp = int(time.time())
+    with open(TEST_HISTORY_FILE, 'a') as outfile:
+        for name, target, passed, duration, phases in results:
+            outfile.write(json.dumps({
+                'test': name,
+                'target': target,
+                'passed': passed,
+                'duration': round(duration, 3),
+                'phases': {phase: round(elapsed, 3) for phase, elapsed in phases.items()},
+                'time': timestamp
+            }) + '\n')
+
+    if os.path.getsize(TEST_HISTORY_FILE) > TEST_HISTORY_MAX_SIZE:
+        history = _load_test_history()
+        temp_file = TEST_HISTORY_FILE + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_file, 'w') as outfile:
+            for (name, target), records in history.items():
+                for record in records[-(SLOW_TEST_WINDOW + 1):]:
+                    outfile.write(json.dumps(record) + '\n')
+
+        os.replace(temp_file, TEST_HISTORY_FILE)
+
+
+def _report_slow_tests(tests, targets_to_run, display_name):
+    """
+    Print tests whose most recent passing run took more than
+    SLOW_TEST_THRESHOLD times the median of the SLOW_TEST_WINDOW passing runs
+    before it. The time of each phase is also compared, so it's possible to
+    see if the slowdown was in compiling, simulating, or checking results.
+    """
+
+    def median(values):
+        values = sorted(values)
+        middle = len(values) // 2
+        if len(values) % 2:
+            return values[middle]
+
+        return (values[middle - 1] + values[middle]) / 2
+
+    history = _load_test_history()
+    slow_tests = []
+    for test in tests:
+        for target in test[2]:
+            if target not in targets_to_run:
+                continue
+
+            records = [record for record in history.get(
+                (_qualified_name(test[1], test[3]), target), []) if record['passed']]
+            if len(records) < 2:
+                continue
+
+            latest = records[-1]
+            previous = records[-(SLOW_TEST_WINDOW + 1):-1]
+            baseline = median([record['duration'] for record in previous])
+            if latest['duration'] <= baseline * SLOW_TEST_THRESHOLD:
+                continue
+
+            phase_changes = []
+            for phase in TEST_PHASES:
+                phase_baseline = median([record.get('phases', {}).get(phase, 0)
+                                         for record in previous])
+                phase_latest = latest.get('phases', {}).get(phase, 0)
+                phase_changes.append('{} {:.2f}s->{:.2f}s'.format(
+                    phase, phase_baseline, phase_latest))
+
+            slow_tests.append((latest['duration'] / max(baseline, 0.001),
+                               _format_label(display_name(test), target),
+                               baseline, latest['duration'], phase_changes))
+
+    slow_tests.sort(reverse=True)
+    for ratio, label, baseline, duration, phase_changes in slow_tests:
+        print('{}{:.2f}s -> {:.2f}s (+{:.0f}%)  {}'.format(
+            label, baseline, duration, (ratio - 1) * 100, ', '.join(phase_changes)))
+
+    print('{} slow tests'.format(len(slow_tests)))
+
+
+def set_work_dir(path):
+    """
+    Point WORK_DIR and the default program paths at a new directory. Scripts
+    that run several tests concurrently call this in each process.
+    """
+
+    global WORK_DIR, ELF_FILE, BIN_FILE
+    WORK_DIR = path
+    ELF_FILE = WORK_DIR + 'program.elf'
+    BIN_FILE = WORK_DIR + 'program.bin'
+
+
+def _run_test(func, param, target, suite_dir):
+    """Run a single test in a clean working directory.
+
+    Returns:
+            (error, duration, phases). error is None if the test passed,
+            otherwise a string describing the failure. duration is in
+            seconds. phases is a dictionary of the time spent in each phase
+            (see _timed_phase).
+    """
+
+    # Clean out working directory and re-create
+    shutil.rmtree(path=WORK_DIR, ignore_errors=True)
+    os.makedirs(WORK_DIR)
+
+    os.chdir(suite_dir)
+    _phase_times.clear()
+    start_time = time.monotonic()
+    try:
+        func(param, target)
+        error = None
+    except TestException as exc:
+        error = exc.args[0]
+    except Exception:  # pylint: disable=W0703
+        error = 'Test threw exception:\n' + traceback.format_exc()
+
+    return error, time.monotonic() - start_time, dict(_phase_times)
+
+
+def _init_worker():
+    """
+    Called when each process in the pool starts. Gives it a private
+    working directory so concurrently running tests don't clobber each
+    other's files.
+    """
+
+    set_work_dir(WORK_DIR + 'worker' + str(os.getpid()) + '/')
+
+
+def _run_test_in_worker(job):
+    """Entry point for pool processes. job is (test index, target)"""
+
+    index, target = job
+    func, param, _, suite_dir = _worker_tests[index]
+    return (index, target) + _run_test(func, param, target, suite_dir)
+
+
+# Tests are passed to pool processes by index into this list rather than
+# being pickled, because many of them are closures. The processes are forked
+# and inherit it.
+_worker_tests = []
+
+
+def _format_label(name, target):
+    label = name + ' (' + target + ')'
+    return label + (' ' * (OUTPUT_ALIGN - len(label)))
+
+
+def _run_tests_parallel(jobs, num_jobs, report_result):
+    """Run tests in a pool of num_jobs processes
+
+    Jobs are started in the order given. Results are passed to
+    report_result as each one completes.
+
+    Args:
+            jobs: list of (index into _worker_tests, target)
+            num_jobs: Number of processes in the pool
+            report_result: function called with (index, target, error, duration,
+                           phases)
+    """
+
+    pool = multiprocessing.get_context('fork').Pool(num_jobs, _init_worker)
+    try:
+        for result in pool.imap_unordered(_run_test_in_worker, jobs):
+            report_result(*result)
+
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.exit(1)
+
+    pool.join()
+
+
+def _select_tests(names):
+    """
+    Return the registered tests that match names. Each name may be the name
+    of a test, its qualified name (which includes the suite directory, like
+    core/isa/add.S), or a suite directory, which selects all tests in it.
+    """
+
+    selected = []
+    for requested in names:
+        requested = requested.rstrip('/')
+        matches = [test for test in registered_tests
+                   if requested in (test[1], _qualified_name(test[1], test[3]))
+                   or requested == _qualified_name('', test[3]).rstrip('/')]
+        if not matches:
+            print('Unknown test ' + requested)
+            sys.exit(1)
+
+        selected += [test for test in matches if test not in selected]
+
+    return selected
+
 
 def execute_tests():
     """
@@ -485,6 +1394,13 @@ def execute_tests():
     Run all tests that have been registered with the register_tests functions
     and report results. If this fails, it will call sys.exit with a non-zero status.
 
+    If the -j option was passed, tests are run concurrently in a pool of
+    processes, each with its own working directory (WORK_DIR is updated
+    in each process to point to it). Tests must not depend on WORK_DIR
+    being fixed at import time. They are started longest first, using the
+    durations recorded in TEST_HISTORY_FILE by earlier runs, so the total
+    time is not dominated by a slow test that started last.
+
     Args:
             None
 
@@ -495,15 +1411,28 @@ def execute_tests():
             Nothing
     """
 
-    global DEBUG
+    global DEBUG, STREAM_CHECK, RANDSEED, _worker_tests
+
+    if collect_only:
+        return
+
+    multiple_suites = len(set(test[3] for test in registered_tests)) > 1
+
+    def display_name(test):
+        if multiple_suites:
+            return _qualified_name(test[1], test[3])
+
+        return test[1]
 
     if args.list:
-        for _, param, targets in registered_tests:
-            print(param + ': ' + ', '.join(targets))
+        for test in registered_tests:
+            print(display_name(test) + ': ' + ', '.join(test[2]))
 
         return
 
     DEBUG = args.debug
+    STREAM_CHECK = args.stream_check
+    RANDSEED = args.randseed
     if args.target:
         targets_to_run = args.target
     else:
@@ -511,47 +1440,74 @@ def execute_tests():
 
     # Filter based on names and targets
     if args.names:
-        tests_to_run = []
-        for requested in args.names:
-            for func, param, targets in registered_tests:
-                if param == requested:
-                    tests_to_run += [(func, param, targets)]
-                    break
-            else:
-                print('Unknown test ' + requested)
-                sys.exit(1)
+        tests_to_run = _select_tests(args.names)
     else:
         tests_to_run = registered_tests
 
-    test_run_count = 0
-    test_pass_count = 0
+    if args.report_slow:
+        _report_slow_tests(tests_to_run, targets_to_run, display_name)
+        return
+
+    jobs = [(index, target) for index, (_, _, targets, _) in enumerate(tests_to_run)
+            for target in targets if target in targets_to_run]
     failing_tests = []
-    for func, param, targets in tests_to_run:
-        for target in targets:
-            if target not in targets_to_run:
-                continue
+    results = []
 
-            label = param + ' (' + target + ')'
-            print(label + (' ' * (OUTPUT_ALIGN - len(label))), end='')
-            try:
-                # Clean out working directory and re-create
-                shutil.rmtree(path=WORK_DIR, ignore_errors=True)
-                os.makedirs(WORK_DIR)
-
-                test_run_count += 1
-                sys.stdout.flush()
-                func(param, target)
-                print(COLOR_GREEN + 'PASS' + COLOR_NONE)
-                test_pass_count += 1
-            except KeyboardInterrupt:
-                sys.exit(1)
-            except TestException as exc:
-                print(COLOR_RED + 'FAIL' + COLOR_NONE)
-                failing_tests += [(param, exc.args[0])]
-            except Exception as exc:  # pylint: disable=W0703
-                print(COLOR_RED + 'FAIL' + COLOR_NONE)
-                failing_tests += [(param, 'Test threw exception:\n' +
-                                   traceback.format_exc())]
+    def report_result(index, target, error, duration, phases):
+        test = tests_to_run[index]
+        if error is None:
+            print(COLOR_GREEN + 'PASS' + COLOR_NONE)
+        else:
+            print(COLOR_RED + 'FAIL' + COLOR_NONE)
+            failing_tests.append((display_name(test), error))
+
+        sys.stdout.flush()
+        results.append((_qualified_name(test[1], test[3]), target,
+                        error is None, duration, phases))
+
+    def run_serial_job(index, target):
+        func, param, _, suite_dir = tests_to_run[index]
+        print(_format_label(display_name(tests_to_run[index]), target), end='')
+        sys.stdout.flush()
+        try:
+            report_result(index, target, *_run_test(func, param, target, suite_dir))
+        except KeyboardInterrupt:
+            sys.exit(1)
+
+    if args.emulator_server and 'emulator' in targets_to_run:
+        try:
+            _start_emulator_server()
+        except TestException as exc:
+            print(exc.args[0])
+            sys.exit(1)
+
+    try:
+        if args.jobs > 1:
+            # Tests that haven't run before sort first, since their
+            # duration is unknown.
+            history = _load_test_history()
+
+            def expected_duration(job):
+                test = tests_to_run[job[0]]
+                records = history.get((_qualified_name(test[1], test[3]), job[1]))
+                return records[-1]['duration'] if records else float('inf')
+
+            parallel_jobs = sorted(jobs, key=expected_duration, reverse=True)
+
+            def report_parallel_result(index, target, *result):
+                print(_format_label(display_name(tests_to_run[index]), target), end='')
+                report_result(index, target, *result)
+
+            _worker_tests = tests_to_run
+            _run_tests_parallel(parallel_jobs, args.jobs, report_parallel_result)
+        else:
+            for index, target in jobs:
+                run_serial_job(index, target)
+    finally:
+        # Record results even if the run was interrupted
+        _save_test_results(results)
+        if _emulator_server:
+            _stop_emulator_server()
 
     if failing_tests:
         print('Failing tests:')
@@ -559,8 +1515,7 @@ def execute_tests():
             print(name)
             print(output)
 
-    print('{}/{} tests failed'.format(test_run_count - test_pass_count,
-                                      test_run_count))
+    print('{}/{} tests failed'.format(len(failing_tests), len(jobs)))
     if failing_tests != []:
         sys.exit(1)
 
@@ -568,7 +1523,140 @@ CHECK_PREFIX = 'CHECK: '
 CHECKN_PREFIX = 'CHECKN: '
 
 
-def check_result(source_file, program_output):
+def _parse_check_patterns(source_file):
+    """
+    Read the CHECK and CHECKN patterns from a source file.
+
+    Returns:
+            List of tuples (negate, regexp, line_num, pattern), in the order
+            they appear in the file. negate is True for CHECKN patterns.
+    """
+
+    patterns = []
+    with open(source_file, 'r') as infile:
+        for line_num, line in enumerate(infile, 1):
+            chkoffs = line.find(CHECK_PREFIX)
+            if chkoffs != -1:
+                expected = line[chkoffs + len(CHECK_PREFIX):].strip()
+                patterns.append((False, re.compile(expected), line_num, expected))
+            else:
+                chkoffs = line.find(CHECKN_PREFIX)
+                if chkoffs != -1:
+                    nexpected = line[chkoffs + len(CHECKN_PREFIX):].strip()
+                    patterns.append((True, re.compile(nexpected), line_num,
+                                     nexpected))
+
+    return patterns
+
+
+class CheckPatternCache(object):
+    """
+    Parsed and compiled CHECK patterns, keyed on the source file's path and
+    modification time, so each source file is only read once no matter how
+    many targets a test runs on. The pattern lists are immutable, so one
+    cache can be shared by check_result, CheckMatcher, and threads.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, source_file):
+        """
+        Return the patterns for source_file, in the format returned by
+        _parse_check_patterns. Rereads the file if it has changed.
+        """
+
+        path = os.path.abspath(source_file)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+
+        if entry and entry[0] == key:
+            return entry[1]
+
+        patterns = tuple(_parse_check_patterns(path))
+        with self._lock:
+            self._entries[path] = (key, patterns)
+
+        return patterns
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+check_pattern_cache = CheckPatternCache()
+
+
+class CheckMatcher(object):
+    """
+    Matches the CHECK and CHECKN patterns in a source file against program
+    output as it arrives, to determine whether the result of check_result
+    is already known before the program finishes. This only decides when
+    to stop the program. The caller still calls check_result on the output
+    to get the result.
+
+    The result is known when all CHECK patterns have been found and there
+    are no CHECKN patterns (which could still match later output), or when
+    a CHECKN pattern matches.
+    """
+
+    def __init__(self, source_file, pattern_cache=check_pattern_cache):
+        self.patterns = pattern_cache.get(source_file)
+        self.has_checkn = any(negate for negate, _, _, _ in self.patterns)
+        self.output = ''
+        self.done = False
+        self._next_pattern = 0
+        self._output_offset = 0
+
+        # CHECKN patterns that have been reached, with the offset in the
+        # output to search from.
+        self._active_checkn = []
+
+        # Patterns don't span lines, so a pattern that didn't match before
+        # can only match now if it starts on the line that was last
+        # incomplete. This avoids rescanning all output on each call.
+        self._rescan_offset = 0
+
+    def feed(self, text):
+        """Append text to the output and update done"""
+
+        self.output += text
+        output_len = len(self.output)
+        for regexp, offset in self._active_checkn:
+            if regexp.search(self.output, max(offset, self._rescan_offset)):
+                self.done = True
+
+        while not self.done and self._next_pattern < len(self.patterns):
+            negate, regexp, _, _ = self.patterns[self._next_pattern]
+            if negate:
+                if regexp.search(self.output, self._output_offset):
+                    self.done = True
+
+                self._active_checkn.append((regexp, self._output_offset))
+            else:
+                got = regexp.search(self.output, max(self._output_offset,
+                                                     self._rescan_offset))
+
+                # A match at the end of the output might be different once
+                # more output arrives, so wait until it is followed by
+                # something else.
+                if not got or got.end() == output_len:
+                    break
+
+                self._output_offset = got.end()
+
+            self._next_pattern += 1
+
+        if self._next_pattern == len(self.patterns) and not self.has_checkn:
+            self.done = True
+
+        self._rescan_offset = self.output.rfind('\n', 0, output_len) + 1
+
+
+@_timed_phase('check')
+def check_result(source_file, program_output, pattern_cache=check_pattern_cache):
     """Check output of a program based on embedded comments in source code.
 
     For each pattern in a source file that begins with 'CHECK: ', search
@@ -579,6 +1667,8 @@ def check_result(source_file, program_output):
 
     Args:
             source_file: relative path to a source file that contains patterns
+            program_output: output of the program, as a string
+            pattern_cache: CheckPatternCache to read the patterns from
 
     Returns:
             Nothing
@@ -587,50 +1677,37 @@ def check_result(source_file, program_output):
             TestException if a string is not found.
     """
 
-    output_offset = 0
-    line_num = 1
-    found_check_lines = False
-    with open(source_file, 'r') as infile:
-        for line in infile:
-            chkoffs = line.find(CHECK_PREFIX)
-            if chkoffs != -1:
-                found_check_lines = True
-                expected = line[chkoffs + len(CHECK_PREFIX):].strip()
-                if DEBUG:
-                    print('searching for pattern "' + expected + '", line '
-                          + str(line_num))
-
-                regexp = re.compile(expected)
-                got = regexp.search(program_output, output_offset)
-                if got:
-                    output_offset = got.end()
-                else:
-                    error = 'FAIL: line ' + \
-                        str(line_num) + ' expected string ' + \
-                        expected + ' was not found\n'
-                    error += 'searching here:' + program_output[output_offset:]
-                    raise TestException(error)
-            else:
-                chkoffs = line.find(CHECKN_PREFIX)
-                if chkoffs != -1:
-                    found_check_lines = True
-                    nexpected = line[chkoffs + len(CHECKN_PREFIX):].strip()
-                    print('ensuring absence of pattern "' + nexpected +
-                          '", line ' + str(line_num))
-
-                    regexp = re.compile(nexpected)
-                    got = regexp.search(program_output, output_offset)
-                    if got:
-                        error = 'FAIL: line ' + \
-                            str(line_num) + ' string ' + \
-                            nexpected + ' should not be here:\n'
-                        error += program_output
-                        raise TestException(error)
+    patterns = pattern_cache.get(source_file)
+    if not patterns:
+        raise TestException('FAIL: no lines with CHECK: were found')
 
-            line_num += 1
+    output_offset = 0
+    for negate, regexp, line_num, expected in patterns:
+        if negate:
+            print('ensuring absence of pattern "' + expected +
+                  '", line ' + str(line_num))
+
+            got = regexp.search(program_output, output_offset)
+            if got:
+                error = 'FAIL: line ' + \
+                    str(line_num) + ' string ' + \
+                    expected + ' should not be here:\n'
+                error += program_output
+                raise TestException(error)
+        else:
+            if DEBUG:
+                print('searching for pattern "' + expected + '", line '
+                      + str(line_num))
 
-    if not found_check_lines:
-        raise TestException('FAIL: no lines with CHECK: were found')
+            got = regexp.search(program_output, output_offset)
+            if got:
+                output_offset = got.end()
+            else:
+                error = 'FAIL: line ' + \
+                    str(line_num) + ' expected string ' + \
+                    expected + ' was not found\n'
+                error += 'searching here:' + program_output[output_offset:]
+                raise TestException(error)
 
     return True
 
@@ -651,6 +1728,43 @@ def dump_hex(output_file, input_file):
             ofile.write(b'\n')
 
 
+def elf_to_binary(output_file, input_file, base_address=0):
+    """
+    Reads a 32-bit little endian ELF file and writes a raw memory image,
+    which starts at address 0 and contains each loadable segment at its
+    physical address, minus base_address (for images linked at a higher
+    address, like the kernel). Gaps between segments and the part of each
+    segment not in the file (.bss) are filled with zeroes.
+    """
+
+    with open(input_file, 'rb') as ifile:
+        contents = ifile.read()
+
+    if contents[:4] != b'\x7fELF' or contents[4] != 1 or contents[5] != 1:
+        raise TestException(input_file + ' is not a 32-bit little endian ELF file')
+
+    phoff, = struct.unpack_from('<I', contents, 28)
+    phentsize, phnum = struct.unpack_from('<HH', contents, 42)
+    image = bytearray()
+    for segment in range(phnum):
+        p_type, p_offset, _, p_paddr, p_filesz, p_memsz = struct.unpack_from(
+            '<IIIIII', contents, phoff + segment * phentsize)
+        if p_type != 1 or p_memsz == 0:  # PT_LOAD
+            continue
+
+        p_paddr -= base_address
+        end = p_paddr + p_memsz
+        if len(image) < end:
+            image.extend(bytes(end - len(image)))
+
+        image[p_paddr:p_paddr + p_filesz] = contents[p_offset:p_offset + p_filesz]
+
+    # The verilator model loads one 32-bit word at a time
+    image.extend(bytes(-len(image) % 4))
+    with open(output_file, 'wb') as ofile:
+        ofile.write(image)
+
+
 def endian_swap(value):
     """"Given a 32-bit integer value, swap it to the opposite endianness"""
 
@@ -666,7 +1780,7 @@ def _run_generic_test(name, target):
     """
 
     build_program([name])
-    result = run_program(target)
+    result = run_program(target, check_source=name)
     check_result(name, result)
 
 
@@ -27,7 +27,6 @@ import sys
 sys.path.insert(0, '..')
 import test_harness
 
-DRIVER_PATH = test_harness.WORK_DIR + '/driver.cpp'
 DRIVER_SRC = '''
 #include <iostream>
 #include <stdlib.h>
@@ -102,6 +101,7 @@ int main(int argc, char **argv, char **env)
 def run_unit_test(filename, _):
     filestem, _ = os.path.splitext(filename)
     modulename = os.path.basename(filestem)
+    driver_path = test_harness.WORK_DIR + '/driver.cpp'
 
     # The verilator command is actually a perl script. Executing it
     # like this with shell=True is necessary for it to work correctly
@@ -109,7 +109,7 @@ def run_unit_test(filename, _):
     verilator_args = [
         'verilator --unroll-count 512 --assert -I' + test_harness.PROJECT_TOP +
         '/hardware/core -DSIMULATION=1 -Mdir ' + test_harness.WORK_DIR +
-        ' -cc ' + filename + ' --exe ' + DRIVER_PATH
+        ' -cc ' + filename + ' --exe ' + driver_path
     ]
 
     if test_harness.DEBUG:
@@ -121,7 +121,7 @@ def run_unit_test(filename, _):
         raise test_harness.TestException(
             'Verilation failed:\n' + exc.output.decode())
 
-    with open(DRIVER_PATH, 'w') as output_file:
+    with open(driver_path, 'w') as output_file:
         output_file.write(DRIVER_SRC.replace('$MODULE$', modulename))
 
     make_args = [
@@ -30,7 +30,7 @@ def run_compiler_test(source_file, target):
         test_harness.check_result(source_file, result.decode())
     else:
         test_harness.build_program([source_file])
-        result = test_harness.run_program(target)
+        result = test_harness.run_program(target, check_source=source_file)
         test_harness.check_result(source_file, result)
 
 test_list = [fname for fname in test_harness.find_files(
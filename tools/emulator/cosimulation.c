@@ -16,16 +16,19 @@
 
 #include <stdbool.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
 #include "processor.h"
 #include "cosimulation.h"
+#include "instruction-set.h"
 #include "inttypes.h"
 #include "util.h"
 
 //
 // Cosimulation works as follows:
 // 1. The main loop (run_cosimulation) reads and parses the next instruction
-//    side effect from the Verilator model (piped to this process via stdin).
+//    side effect from the Verilator model (piped to this process via stdin,
+//    either as text or in a binary format that is faster to read).
 //    It stores the value in the expected_xXX global variables.
 // 2. It then calls run_until_next_event, which calls into the emulator core to
 //    single step until...
@@ -35,15 +38,99 @@
 //    by step 1. If there is a mismatch, they flag an error, otherwise...
 // 4. Loop back to step 1
 //
+// Events are numbered in the order they are read. If a checkpoint interval is
+// set, this periodically prints hashes of the architectural state (see
+// print_checkpoint). The binary trace can also be saved, then replayed with
+// verbose output starting at the last checkpoint before the event where the
+// run diverged.
+//
+
+// Binary trace format (verilator +tracefile option, see
+// hardware/testbench/trace_file.cpp). The file begins with TRACE_MAGIC and
+// TRACE_VERSION (32 bits each), followed by records. Each record starts with
+// this header, which is followed by a payload that depends on the type:
+//
+// TRACE_SWRITEBACK  uint32_t value
+// TRACE_VWRITEBACK  uint32_t mask, uint32_t values[NUM_VECTOR_LANES]
+// TRACE_STORE       uint32_t address, uint64_t byte_mask,
+//                   uint32_t values[NUM_VECTOR_LANES]
+// TRACE_INTERRUPT   (none)
+// TRACE_HALT        (none)
+//
+// All fields are little endian. Vector values are in the same order, and
+// for stores have the same byte order, as in the text format after parsing.
+//
+#define TRACE_MAGIC 0x5254594e	// 'NYTR'
+#define TRACE_VERSION 1
+
+struct trace_record_header
+{
+    uint8_t type;
+    uint8_t thread;
+    uint8_t reg;
+    uint8_t reserved;
+    uint32_t pc;
+};
+
+enum trace_record_type
+{
+    TRACE_SWRITEBACK = 1,
+    TRACE_VWRITEBACK = 2,
+    TRACE_STORE = 3,
+    TRACE_INTERRUPT = 4,
+    TRACE_HALT = 5
+};
 
 static void print_cosim_expected(void);
 
+// These return 1 if the verilog model halted, 0 if the trace ended before
+// it did, and -1 if there was a mismatch.
+static int read_text_trace(struct processor*);
+static int read_binary_trace(struct processor*);
+
+// Returns true if the event that was read matched
+static bool check_next_event(struct processor*);
+
+static bool printing_events(void);
+static void print_checkpoint(const struct processor*);
+
 // Returns true if the event matched, false if it did not.
 static bool run_until_next_event(struct processor*, uint32_t thread_id);
 
 // Returns true if the masked values match, false otherwise
 static bool masked_vectors_equal(uint32_t mask, const uint32_t *values1, const uint32_t *values2);
 
+enum fp_result_type
+{
+    FP_RESULT_NONE,
+    FP_RESULT_FLOAT,
+    FP_RESULT_INTEGER   // ftoi
+};
+
+enum fp_difference
+{
+    FP_DIFF_EXACT,
+    FP_DIFF_ROUNDED,    // Within options->fp_ulp_tolerance
+    FP_DIFF_NAN,        // Both are NaN, but the bits differ
+    FP_DIFF_UNDEFINED,  // ftoi of NaN or a value that is out of range
+    FP_DIFF_MISMATCH
+};
+
+// Returns FP_RESULT_NONE if options->compare_fp isn't set
+static enum fp_result_type get_fp_result_type(const struct processor*, uint32_t pc);
+
+// Compare the results of a register writeback with expected_values,
+// allowing the differences described in cosimulation.h if the instruction
+// has a floating point result.
+static bool results_match(const struct processor*, uint32_t pc, uint32_t mask,
+                          const uint32_t *values);
+
+// Called after a writeback with a floating point result matched. Records
+// the differences in fp_stats and replaces values with the hardware's.
+static void accept_fp_results(const struct processor*, uint32_t pc, uint32_t mask,
+                              uint32_t *values);
+static void print_fp_stats(void);
+
 static enum
 {
     EVENT_NONE,
@@ -59,8 +146,75 @@ static uint32_t expected_pc;
 static uint32_t expected_thread;
 static bool cosim_mismatch;
 static bool cosim_event_triggered;
+static const struct cosim_options *options;
+static uint64_t event_count;
+static FILE *saved_trace_file;
+
+// Number of floating point results with each type of difference, and of
+// those that were rounded, the number by ULPs of difference. The last
+// bucket also has all larger differences.
+#define FP_ULP_BUCKETS 16
+static uint64_t fp_difference_counts[FP_DIFF_MISMATCH + 1];
+static uint64_t fp_ulp_counts[FP_ULP_BUCKETS];
+static uint32_t fp_max_ulps;
+
+static uint32_t num_threads;
+
+int run_cosimulation(struct processor *proc, const struct cosim_options *opts)
+{
+    int result;
+
+    options = opts;
+    num_threads = get_total_threads(proc);
+    if (options->save_trace_file)
+    {
+        saved_trace_file = fopen(options->save_trace_file, "wb");
+        if (saved_trace_file == NULL)
+        {
+            perror("run_cosimulation: couldn't open trace file");
+            return -1;
+        }
+    }
+
+    enable_cosimulation(proc);
+    if (options->binary_trace)
+        result = read_binary_trace(proc);
+    else
+        result = read_text_trace(proc);
+
+    if (saved_trace_file)
+        fclose(saved_trace_file);
+
+    if (options->compare_fp)
+        print_fp_stats();
+
+    if (result < 0)
+        return -1;
+
+    if (result == 0)
+    {
+        printf("program did not finish normally\n");
+        return -1;
+    }
+
+    // Ensure emulator is also halted. If it executes any more instructions
+    // cosim_mismatch will be flagged.
+    cosim_event_triggered = false;
+    expected_event = EVENT_NONE;
+    while (!is_proc_halted(proc))
+    {
+        execute_instructions(proc, 1);
+        if (cosim_mismatch)
+        {
+            printf("Diverged at event %" PRIu64 "\n", event_count);
+            return -1;
+        }
+    }
+
+    return 0;
+}
 
-int run_cosimulation(struct processor *proc, bool verbose)
+static int read_text_trace(struct processor *proc)
 {
     char line[1024];
     uint32_t thread_id;
@@ -71,16 +225,12 @@ int run_cosimulation(struct processor *proc, bool verbose)
     char value_str[256];
     uint32_t reg;
     uint32_t scalar_value;
-    bool verilog_model_halted = false;
     size_t len;
 
-    enable_cosimulation(proc);
-    if (verbose)
-        enable_tracing(proc);
-
+    line[0] = '\0';
     while (fgets(line, sizeof(line), stdin))
     {
-        if (verbose)
+        if (printing_events())
             printf("%s", line);
 
         len = strlen(line);
@@ -102,7 +252,7 @@ int run_cosimulation(struct processor *proc, bool verbose)
             expected_address = address;
             expected_mask = write_mask;
             memcpy(expected_values, vector_values, sizeof(uint32_t) * NUM_VECTOR_LANES);
-            if (!run_until_next_event(proc, thread_id))
+            if (!check_next_event(proc))
                 return -1;
         }
         else if (sscanf(line, "vwriteback %x %x %x %" PRIx64 " %s", &pc, &thread_id, &reg, &write_mask, value_str) == 5)
@@ -120,7 +270,7 @@ int run_cosimulation(struct processor *proc, bool verbose)
             expected_register = reg;
             expected_mask = write_mask;
             memcpy(expected_values, vector_values, sizeof(uint32_t) * NUM_VECTOR_LANES);
-            if (!run_until_next_event(proc, thread_id))
+            if (!check_next_event(proc))
                 return -1;
         }
         else if (sscanf(line, "swriteback %x %x %x %x", &pc, &thread_id, &reg, &scalar_value) == 4)
@@ -131,61 +281,237 @@ int run_cosimulation(struct processor *proc, bool verbose)
             expected_thread = thread_id;
             expected_register = reg;
             expected_values[0] = scalar_value;
-            if (!run_until_next_event(proc, thread_id))
+            if (!check_next_event(proc))
                 return -1;
         }
         else if (strcmp(line, "***HALTED***") == 0)
-        {
-            verilog_model_halted = true;
-            break;
-        }
+            return 1;
         else if (sscanf(line, "interrupt %u %x", &thread_id, &pc) == 2)
             cosim_interrupt(proc, thread_id, pc);
-        else if (!verbose)
+        else if (!printing_events())
             printf("%s\n", line);	// Echo unrecognized lines to stdout (verbose already does this for all lines)
     }
 
-    if (!verilog_model_halted)
+    printf("%s\n", line);	// Print error (if any)
+    return 0;
+}
+
+static bool read_trace_data(void *data, size_t length)
+{
+    if (fread(data, 1, length, stdin) != length)
+        return false;
+
+    if (saved_trace_file)
+        fwrite(data, 1, length, saved_trace_file);
+
+    return true;
+}
+
+static int read_binary_trace(struct processor *proc)
+{
+    uint32_t file_header[2];
+    struct trace_record_header header;
+    uint32_t value;
+    int lane;
+
+    if (!read_trace_data(file_header, sizeof(file_header)))
+        return 0;
+
+    if (file_header[0] != TRACE_MAGIC || file_header[1] != TRACE_VERSION)
     {
-        printf("program did not finish normally\n");
-        printf("%s\n", line);	// Print error (if any)
+        printf("Unrecognized binary trace format\n");
         return -1;
     }
 
-    // Ensure emulator is also halted. If it executes any more instructions
-    // cosim_mismatch will be flagged.
-    cosim_event_triggered = false;
-    expected_event = EVENT_NONE;
-    while (!is_proc_halted(proc))
+    while (read_trace_data(&header, sizeof(header)))
     {
-        execute_instructions(proc, 1);
-        if (cosim_mismatch)
+        switch (header.type)
+        {
+            case TRACE_SWRITEBACK:
+                if (!read_trace_data(&value, sizeof(value)))
+                    return 0;
+
+                expected_event = EVENT_SCALAR_WRITEBACK;
+                expected_values[0] = value;
+                break;
+
+            case TRACE_VWRITEBACK:
+                if (!read_trace_data(&value, sizeof(value))
+                        || !read_trace_data(expected_values, sizeof(expected_values)))
+                    return 0;
+
+                expected_event = EVENT_VECTOR_WRITEBACK;
+                expected_mask = value;
+                break;
+
+            case TRACE_STORE:
+                if (!read_trace_data(&expected_address, sizeof(expected_address))
+                        || !read_trace_data(&expected_mask, sizeof(expected_mask))
+                        || !read_trace_data(expected_values, sizeof(expected_values)))
+                    return 0;
+
+                expected_event = EVENT_MEM_STORE;
+                break;
+
+            case TRACE_INTERRUPT:
+                if (printing_events())
+                    printf("interrupt %u %08x\n", header.thread, header.pc);
+
+                cosim_interrupt(proc, header.thread, header.pc);
+                continue;
+
+            case TRACE_HALT:
+                if (printing_events())
+                    printf("***HALTED***\n");
+
+                return 1;
+
+            default:
+                printf("Bad binary trace record type %u\n", header.type);
+                return -1;
+        }
+
+        expected_pc = header.pc;
+        expected_thread = header.thread;
+        expected_register = header.reg;
+        if (printing_events())
+        {
+            // Print the record in the same form as the text trace
+            switch (expected_event)
+            {
+                case EVENT_SCALAR_WRITEBACK:
+                    printf("swriteback %08x %x %02x %08x\n", expected_pc, expected_thread,
+                           expected_register, expected_values[0]);
+                    break;
+
+                case EVENT_VECTOR_WRITEBACK:
+                    printf("vwriteback %08x %x %02x %016" PRIx64 " ", expected_pc,
+                           expected_thread, expected_register, expected_mask);
+                    for (lane = 0; lane < NUM_VECTOR_LANES; lane++)
+                        printf("%08x", expected_values[lane]);
+
+                    printf("\n");
+                    break;
+
+                default:
+                    printf("store %08x %x %08x %016" PRIx64 " ", expected_pc, expected_thread,
+                           expected_address, expected_mask);
+                    for (lane = 0; lane < NUM_VECTOR_LANES; lane++)
+                        printf("%08x", endian_swap32(expected_values[lane]));
+
+                    printf("\n");
+                    break;
+            }
+        }
+
+        if (!check_next_event(proc))
             return -1;
     }
 
     return 0;
 }
 
-void cosim_check_set_scalar_reg(struct processor *proc, uint32_t pc, uint32_t reg, uint32_t value)
+static bool check_next_event(struct processor *proc)
+{
+    if (printing_events())
+        enable_tracing(proc);
+
+    if (!run_until_next_event(proc, expected_thread))
+    {
+        printf("Diverged at event %" PRIu64 "\n", event_count);
+        return false;
+    }
+
+    event_count++;
+    if (options->checkpoint_interval != 0 && event_count % options->checkpoint_interval == 0)
+        print_checkpoint(proc);
+
+    return true;
+}
+
+static bool printing_events(void)
+{
+    return options->verbose && event_count >= options->verbose_start_event;
+}
+
+// FNV-1a, one 32-bit word at a time
+static uint64_t hash_words(uint64_t hash, const uint32_t *words, size_t count)
+{
+    size_t i;
+
+    for (i = 0; i < count; i++)
+        hash = (hash ^ words[i]) * 0x100000001b3ull;
+
+    return hash;
+}
+
+#define HASH_INITIAL_VALUE 0xcbf29ce484222325ull
+#define MEMORY_HASH_BLOCK_SIZE 0x1000
+
+//
+// A checkpoint line has the number of events that have matched so far,
+// followed by hashes of the register files of all threads and of memory in
+// the emulator. Checkpoints are only printed while events match, so these
+// don't show where a run diverged ("Diverged at event" does). They allow
+// checking that a replay of a saved trace is running the same program.
+//
+static void print_checkpoint(const struct processor *proc)
+{
+    uint64_t register_hash = HASH_INITIAL_VALUE;
+    uint64_t memory_hash = HASH_INITIAL_VALUE;
+    uint32_t address;
+    uint32_t values[NUM_VECTOR_LANES];
+    uint32_t thread;
+    uint32_t reg;
+
+    for (thread = 0; thread < num_threads; thread++)
+    {
+        for (reg = 0; reg < NUM_REGISTERS; reg++)
+        {
+            values[0] = dbg_get_scalar_reg(proc, thread, reg);
+            register_hash = hash_words(register_hash, values, 1);
+        }
+
+        for (reg = 0; reg < NUM_REGISTERS; reg++)
+        {
+            dbg_get_vector_reg(proc, thread, reg, values);
+            register_hash = hash_words(register_hash, values, NUM_VECTOR_LANES);
+        }
+    }
+
+    for (address = 0; address < get_memory_size(proc); address += MEMORY_HASH_BLOCK_SIZE)
+    {
+        memory_hash = hash_words(memory_hash, get_memory_region_ptr(proc, address,
+                                 MEMORY_HASH_BLOCK_SIZE), MEMORY_HASH_BLOCK_SIZE / sizeof(uint32_t));
+    }
+
+    printf("checkpoint %" PRIu64 " %016" PRIx64 " %016" PRIx64 "\n",
+           event_count, register_hash, memory_hash);
+}
+
+void cosim_check_set_scalar_reg(struct processor *proc, uint32_t pc, uint32_t reg, uint32_t *value)
 {
     cosim_event_triggered = true;
     if (expected_event != EVENT_SCALAR_WRITEBACK
             || expected_pc != pc
             || expected_register != reg
-            || expected_values[0] != value)
+            || !results_match(proc, pc, 1, value))
     {
         cosim_mismatch = true;
         print_registers(proc, expected_thread);
         printf("COSIM MISMATCH, thread %u\n", expected_thread);
-        printf("Reference: %08x s%u <= %08x\n", pc, reg, value);
+        printf("Reference: %08x s%u <= %08x\n", pc, reg, *value);
         printf("Hardware:  ");
         print_cosim_expected();
         return;
     }
+
+    if (get_fp_result_type(proc, pc) != FP_RESULT_NONE)
+        accept_fp_results(proc, pc, 1, value);
 }
 
 void cosim_check_set_vector_reg(struct processor *proc, uint32_t pc, uint32_t reg, uint32_t mask,
-                                const uint32_t *values)
+                                uint32_t *values)
 {
     int lane;
 
@@ -193,7 +519,7 @@ void cosim_check_set_vector_reg(struct processor *proc, uint32_t pc, uint32_t re
     if (expected_event != EVENT_VECTOR_WRITEBACK
             || expected_pc != pc
             || expected_register != reg
-            || !masked_vectors_equal(mask, expected_values, values)
+            || !results_match(proc, pc, mask, values)
             || expected_mask != (mask & 0xffff))
     {
         cosim_mismatch = true;
@@ -208,6 +534,9 @@ void cosim_check_set_vector_reg(struct processor *proc, uint32_t pc, uint32_t re
         print_cosim_expected();
         return;
     }
+
+    if (get_fp_result_type(proc, pc) != FP_RESULT_NONE)
+        accept_fp_results(proc, pc, mask, values);
 }
 
 void cosim_check_vector_store(struct processor *proc, uint32_t pc, uint32_t address, uint32_t mask,
@@ -344,3 +673,182 @@ static bool masked_vectors_equal(uint32_t mask, const uint32_t *values1, const u
 
     return true;
 }
+
+static enum fp_result_type get_fp_result_type(const struct processor *proc, uint32_t pc)
+{
+    uint32_t instruction;
+
+    if (!options->compare_fp)
+        return FP_RESULT_NONE;
+
+    // Only register arithmetic instructions have floating point forms
+    instruction = *(const uint32_t*) get_memory_region_ptr(proc, pc, 4);
+    if ((instruction & 0xe0000000) != 0xc0000000)
+        return FP_RESULT_NONE;
+
+    switch (extract_unsigned_bits(instruction, 20, 6))
+    {
+        case OP_ADD_F:
+        case OP_SUB_F:
+        case OP_MUL_F:
+        case OP_ITOF:
+            return FP_RESULT_FLOAT;
+
+        case OP_FTOI:
+            return FP_RESULT_INTEGER;
+
+        default:
+            return FP_RESULT_NONE;
+    }
+}
+
+// Read the source operand of the ftoi instruction at pc for each lane. The
+// emulator hasn't written the result yet, so this is valid even if the
+// destination is the same register.
+static void get_ftoi_sources(const struct processor *proc, uint32_t pc, uint32_t *sources)
+{
+    uint32_t instruction = *(const uint32_t*) get_memory_region_ptr(proc, pc, 4);
+    uint32_t fmt = extract_unsigned_bits(instruction, 26, 3);
+    uint32_t op2reg = extract_unsigned_bits(instruction, 15, 5);
+    int lane;
+
+    if (fmt == FMT_RA_VV || fmt == FMT_RA_VV_M)
+        dbg_get_vector_reg(proc, expected_thread, op2reg, sources);
+    else
+    {
+        for (lane = 0; lane < NUM_VECTOR_LANES; lane++)
+            sources[lane] = dbg_get_scalar_reg(proc, expected_thread, op2reg);
+    }
+}
+
+static bool is_nan(uint32_t value)
+{
+    return (value & 0x7f800000) == 0x7f800000 && (value & 0x007fffff) != 0;
+}
+
+static uint32_t ulp_distance(uint32_t value1, uint32_t value2)
+{
+    int64_t ordered1;
+    int64_t ordered2;
+    int64_t distance;
+
+    // Convert from sign/magnitude to integers in the same order as the
+    // floating point values, so adjacent values differ by one.
+    ordered1 = (value1 & 0x80000000) ? -(int64_t)(value1 & 0x7fffffff) : value1;
+    ordered2 = (value2 & 0x80000000) ? -(int64_t)(value2 & 0x7fffffff) : value2;
+    distance = ordered1 > ordered2 ? ordered1 - ordered2 : ordered2 - ordered1;
+    return distance > UINT32_MAX ? UINT32_MAX : (uint32_t) distance;
+}
+
+static enum fp_difference compare_fp_result(enum fp_result_type type, uint32_t hardware_value,
+        uint32_t emulator_value, uint32_t source, uint32_t *out_ulps)
+{
+    float source_value;
+    int64_t difference;
+
+    *out_ulps = 0;
+    if (hardware_value == emulator_value)
+        return FP_DIFF_EXACT;
+
+    if (type == FP_RESULT_INTEGER)
+    {
+        // This comparison is false for NaN
+        source_value = value_as_float(source);
+        if (!(source_value >= -2147483648.0f && source_value < 2147483648.0f))
+            return FP_DIFF_UNDEFINED;
+
+        difference = (int64_t)(int32_t) hardware_value - (int32_t) emulator_value;
+        *out_ulps = (uint32_t)(difference < 0 ? -difference : difference);
+    }
+    else
+    {
+        if (is_nan(hardware_value) && is_nan(emulator_value))
+            return FP_DIFF_NAN;
+
+        if (is_nan(hardware_value) || is_nan(emulator_value))
+            return FP_DIFF_MISMATCH;
+
+        *out_ulps = ulp_distance(hardware_value, emulator_value);
+    }
+
+    return *out_ulps <= options->fp_ulp_tolerance ? FP_DIFF_ROUNDED : FP_DIFF_MISMATCH;
+}
+
+static bool results_match(const struct processor *proc, uint32_t pc, uint32_t mask,
+                          const uint32_t *values)
+{
+    enum fp_result_type type = get_fp_result_type(proc, pc);
+    uint32_t sources[NUM_VECTOR_LANES] = { 0 };
+    uint32_t ulps;
+    int lane;
+
+    if (type == FP_RESULT_NONE)
+        return masked_vectors_equal(mask, expected_values, values);
+
+    if (type == FP_RESULT_INTEGER)
+        get_ftoi_sources(proc, pc, sources);
+
+    for (lane = 0; lane < NUM_VECTOR_LANES; lane++)
+    {
+        if ((mask & (1 << lane)) && compare_fp_result(type, expected_values[lane], values[lane],
+                sources[lane], &ulps) == FP_DIFF_MISMATCH)
+            return false;
+    }
+
+    return true;
+}
+
+static void accept_fp_results(const struct processor *proc, uint32_t pc, uint32_t mask,
+                              uint32_t *values)
+{
+    enum fp_result_type type = get_fp_result_type(proc, pc);
+    uint32_t sources[NUM_VECTOR_LANES] = { 0 };
+    enum fp_difference difference;
+    uint32_t ulps;
+    int lane;
+
+    if (type == FP_RESULT_INTEGER)
+        get_ftoi_sources(proc, pc, sources);
+
+    for (lane = 0; lane < NUM_VECTOR_LANES; lane++)
+    {
+        if ((mask & (1 << lane)) == 0)
+            continue;
+
+        difference = compare_fp_result(type, expected_values[lane], values[lane],
+                                       sources[lane], &ulps);
+        fp_difference_counts[difference]++;
+        if (difference == FP_DIFF_ROUNDED)
+        {
+            fp_ulp_counts[ulps < FP_ULP_BUCKETS ? ulps : FP_ULP_BUCKETS - 1]++;
+            if (ulps > fp_max_ulps)
+                fp_max_ulps = ulps;
+        }
+
+        values[lane] = expected_values[lane];
+    }
+}
+
+//
+// Prints a line with the number of floating point results that matched
+// exactly, were rounded differently (within the tolerance), were different
+// NaNs, and were undefined, and the largest difference in ULPs. This is
+// followed by a line for the number of rounded results with each difference.
+//
+static void print_fp_stats(void)
+{
+    int ulps;
+
+    printf("fp results exact %" PRIu64 " rounded %" PRIu64 " nan %" PRIu64 " undefined %"
+           PRIu64 " max ulps %u\n", fp_difference_counts[FP_DIFF_EXACT],
+           fp_difference_counts[FP_DIFF_ROUNDED], fp_difference_counts[FP_DIFF_NAN],
+           fp_difference_counts[FP_DIFF_UNDEFINED], fp_max_ulps);
+    for (ulps = 0; ulps < FP_ULP_BUCKETS; ulps++)
+    {
+        if (fp_ulp_counts[ulps] != 0)
+        {
+            printf("fp ulps %d%s %" PRIu64 "\n", ulps, ulps == FP_ULP_BUCKETS - 1 ? "+" : "",
+                   fp_ulp_counts[ulps]);
+        }
+    }
+}
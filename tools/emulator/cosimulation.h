@@ -19,19 +19,51 @@
 
 #include "processor.h"
 
+struct cosim_options
+{
+    bool verbose;
+
+    // Events are in the binary format written by the verilator +tracefile
+    // option instead of the text format printed by +trace.
+    bool binary_trace;
+
+    // If verbose is set, only print events (and the emulator trace) starting
+    // with this one. Events are numbered from zero.
+    uint64_t verbose_start_event;
+
+    // If this is not zero, print a checkpoint after each time this many
+    // events have matched (see print_checkpoint).
+    uint32_t checkpoint_interval;
+
+    // If this is not NULL, copy the binary trace read from standard in to
+    // this file, so it can be replayed without running verilator again.
+    const char *save_trace_file;
+
+    // If set, results of floating point instructions (add_f, sub_f, mul_f,
+    // and itof) match if they are within fp_ulp_tolerance units in the last
+    // place of the emulator's result. ftoi results match if they differ by
+    // up to fp_ulp_tolerance, or if the source is NaN or out of range (which
+    // is undefined). When a result differs, the emulator uses the
+    // hardware's value, so the difference doesn't carry into later results.
+    // Statistics of the differences are printed at the end.
+    bool compare_fp;
+    uint32_t fp_ulp_tolerance;
+};
+
 // Execute code in cosimulation until the processor halts.
 // This reads events from standard in and calls into the core emulator loop to
 // step each emulator thread in lockstep, ensuring the side effects match.
 // Returns -1 if there is a mismatch between the hardware implementation and
 // emulator, 0 if they matched.
-int run_cosimulation(struct processor*, bool verbose);
+int run_cosimulation(struct processor*, const struct cosim_options*);
 
 // These functions are called by the emulator loop as a side effect of executing
 // emulated instrucitons. The emulator compares these actions to the hardware actions
-// read from stdin.
-void cosim_check_set_scalar_reg(struct processor*, uint32_t pc, uint32_t reg, uint32_t value);
+// read from stdin. The register writeback checks may replace the value(s) with
+// the hardware's (see compare_fp).
+void cosim_check_set_scalar_reg(struct processor*, uint32_t pc, uint32_t reg, uint32_t *value);
 void cosim_check_set_vector_reg(struct processor*, uint32_t pc, uint32_t reg, uint32_t mask,
-                                const uint32_t *value);
+                                uint32_t *values);
 void cosim_check_vector_store(struct processor*, uint32_t pc, uint32_t address, uint32_t mask,
                               const uint32_t *values);
 void cosim_check_scalar_store(struct processor*, uint32_t pc, uint32_t address, uint32_t size,
@@ -34,6 +34,7 @@
 #include "instruction-set.h"
 #include "remote-gdb.h"
 #include "sdmmc.h"
+#include "server.h"
 #include "util.h"
 
 extern void poll_inputs(struct processor*);
@@ -44,13 +45,20 @@ static struct termios original_tconfig;
 
 static void usage(void)
 {
-    fprintf(stderr, "usage: emulator [options] <hex image file>\n");
+    fprintf(stderr, "usage: emulator [options] <image file>\n");
+    fprintf(stderr, "       emulator [options] -m server <socket path>\n");
     fprintf(stderr, "options:\n");
     fprintf(stderr, "  -v Verbose, will print register transfer traces to stdout\n");
     fprintf(stderr, "  -m Mode, one of:\n");
     fprintf(stderr, "     normal  Run to completion (default)\n");
     fprintf(stderr, "     cosim   Cosimulation validation mode\n");
-    fprintf(stderr, "     gdb     Start GDB listener on port 8000\n");
+    fprintf(stderr, "     gdb     Start GDB listener on port 8000 (see -g)\n");
+    fprintf(stderr, "     server  Run programs sent over a UNIX domain socket\n");
+    fprintf(stderr, "  -B Cosimulation events on stdin are in binary format (verilator +tracefile)\n");
+    fprintf(stderr, "  -k <events> In cosim mode, print a checkpoint after this many events\n");
+    fprintf(stderr, "  -T <file> In cosim mode, save the binary events read from stdin to this file\n");
+    fprintf(stderr, "  -w <event> In cosim mode with -v, only print starting at this event\n");
+    fprintf(stderr, "  -u <ulps> In cosim mode, allow floating point results to differ by this many ULPs\n");
     fprintf(stderr, "  -f <width>x<height> Display frame buffer output in window\n");
     fprintf(stderr, "  -d <filename>,<start>,<length>  Dump memory\n");
     fprintf(stderr, "  -b <filename> Load file into a virtual block device\n");
@@ -61,7 +69,10 @@ static void usage(void)
     fprintf(stderr, "  -s <file> Memory map file as shared memory\n");
     fprintf(stderr, "  -i <file> Named pipe to receive interrupts. Pipe must already be created.\n");
     fprintf(stderr, "  -o <file> Named pipe to send interrupts. Pipe must already be created\n");
-    fprintf(stderr, "  -a Enable random thread scheduling (slower)");
+    fprintf(stderr, "  -a Enable random thread scheduling (slower)\n");
+    fprintf(stderr, "  -g <port> Port for GDB listener. If 0, pick any free port\n");
+    fprintf(stderr, "  -R <file> Write a line to this file when ready (for gdb and server\n");
+    fprintf(stderr, "     modes, after starting to listen for connections)");
 }
 
 static uint32_t parse_num_arg(const char *argval)
@@ -160,6 +171,7 @@ int main(int argc, char *argv[])
     char *mem_dump_filename = NULL;
     size_t mem_dump_filename_len = 0;
     bool verbose = false;
+    struct cosim_options cosim_options;
     uint32_t fb_width = 640;
     uint32_t fb_height = 480;
     bool block_device_open = false;
@@ -172,15 +184,19 @@ int main(int argc, char *argv[])
     struct stat st;
     bool random_thread_sched = false;
     struct termios new_tconfig;
+    const char *ready_file = NULL;
+    uint32_t gdb_port = 8000;
 
     enum
     {
         MODE_NORMAL,
         MODE_COSIMULATION,
-        MODE_GDB_REMOTE_DEBUG
+        MODE_GDB_REMOTE_DEBUG,
+        MODE_SERVER
     } mode = MODE_NORMAL;
 
-    while ((option = getopt(argc, argv, "f:d:vm:b:t:p:c:r:s:i:o:a")) != -1)
+    memset(&cosim_options, 0, sizeof(cosim_options));
+    while ((option = getopt(argc, argv, "f:d:vm:b:Bk:T:w:u:t:p:c:r:s:i:o:ag:R:")) != -1)
     {
         switch (option)
         {
@@ -212,6 +228,8 @@ int main(int argc, char *argv[])
                     mode = MODE_COSIMULATION;
                 else if (strcmp(optarg, "gdb") == 0)
                     mode = MODE_GDB_REMOTE_DEBUG;
+                else if (strcmp(optarg, "server") == 0)
+                    mode = MODE_SERVER;
                 else
                 {
                     fprintf(stderr, "Unkown execution mode %s\n", optarg);
@@ -256,6 +274,27 @@ int main(int argc, char *argv[])
                 block_device_open = true;
                 break;
 
+            case 'B':
+                cosim_options.binary_trace = true;
+                break;
+
+            case 'k':
+                cosim_options.checkpoint_interval = parse_num_arg(optarg);
+                break;
+
+            case 'T':
+                cosim_options.save_trace_file = optarg;
+                break;
+
+            case 'w':
+                cosim_options.verbose_start_event = strtoull(optarg, NULL, 10);
+                break;
+
+            case 'u':
+                cosim_options.compare_fp = true;
+                cosim_options.fp_ulp_tolerance = parse_num_arg(optarg);
+                break;
+
             case 'c':
                 memory_size = parse_num_arg(optarg);
                 break;
@@ -333,6 +372,20 @@ int main(int argc, char *argv[])
                 random_thread_sched = true;
                 break;
 
+            case 'g':
+                gdb_port = parse_num_arg(optarg);
+                if (gdb_port > 0xffff)
+                {
+                    fprintf(stderr, "Invalid GDB port %u\n", gdb_port);
+                    return 1;
+                }
+
+                break;
+
+            case 'R':
+                ready_file = optarg;
+                break;
+
             case '?':
                 usage();
                 return 1;
@@ -341,7 +394,11 @@ int main(int argc, char *argv[])
 
     if (optind == argc)
     {
-        fprintf(stderr, "No image filename specified\n");
+        if (mode == MODE_SERVER)
+            fprintf(stderr, "No socket path specified\n");
+        else
+            fprintf(stderr, "No image filename specified\n");
+
         usage();
         return 1;
     }
@@ -355,7 +412,19 @@ int main(int argc, char *argv[])
     if (proc == NULL)
         return 1;
 
-    if (load_hex_file(proc, argv[optind]) < 0)
+    if (mode == MODE_SERVER)
+    {
+        // Each request is run in a forked copy of this process, which loads
+        // the image itself, so the processor is only initialized once.
+        init_device(proc);
+        if (random_thread_sched)
+            enable_random_thread_sched(proc);
+
+        run_server(proc, argv[optind], ready_file);
+        return 1;
+    }
+
+    if (load_image_file(proc, argv[optind]) < 0)
     {
         fprintf(stderr, "Error reading image %s\n", argv[optind]);
         return 1;
@@ -406,6 +475,11 @@ int main(int argc, char *argv[])
             perror("tcsetattr");
     }
 
+    // Remote GDB mode signals it is ready after it starts listening for
+    // connections.
+    if (mode != MODE_GDB_REMOTE_DEBUG && write_ready_file(ready_file, "ready") < 0)
+        return 1;
+
     switch (mode)
     {
         case MODE_NORMAL:
@@ -432,15 +506,19 @@ int main(int argc, char *argv[])
 
         case MODE_COSIMULATION:
             dbg_set_stop_on_fault(proc, false);
-            if (run_cosimulation(proc, verbose) < 0)
+            cosim_options.verbose = verbose;
+            if (run_cosimulation(proc, &cosim_options) < 0)
                 return 1;	// Failed
 
             break;
 
         case MODE_GDB_REMOTE_DEBUG:
             dbg_set_stop_on_fault(proc, true);
-            remote_gdb_main_loop(proc, enable_fb_window);
+            remote_gdb_main_loop(proc, enable_fb_window, (uint16_t) gdb_port, ready_file);
             break;
+
+        case MODE_SERVER:
+            break;  // Handled above
     }
 
     if (enable_memory_dump)
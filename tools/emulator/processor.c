@@ -44,6 +44,12 @@
 
 #define INVALID_ADDR 0xfffffffful
 
+// ELF header fields, used by load_elf_file
+#define ELF_MAGIC "\x7f" "ELF"
+#define ELFCLASS32 1
+#define ELFDATA2LSB 1
+#define PT_LOAD 1
+
 // When a breakpoint is set, this instruction replaces the one at the
 // breakpoint address. It is invalid, because it uses a reserved format
 // type. The interpreter only performs a breakpoint lookup when it sees
@@ -286,7 +292,7 @@ void enable_random_thread_sched(struct processor *proc)
     proc->random_thread_sched = true;
 }
 
-int load_hex_file(struct processor *proc, const char *filename)
+static int load_hex_file(struct processor *proc, const char *filename)
 {
     FILE *file;
     char line[16];
@@ -315,6 +321,148 @@ int load_hex_file(struct processor *proc, const char *filename)
     return 0;
 }
 
+// Copy the contents of a file into memory, starting at address 0.
+static int load_raw_file(struct processor *proc, const char *filename)
+{
+    FILE *file;
+    size_t got;
+
+    file = fopen(filename, "rb");
+    if (file == NULL)
+    {
+        perror("load_raw_file: error opening image file");
+        return -1;
+    }
+
+    got = fread(proc->memory, 1, proc->memory_size, file);
+    if (got == proc->memory_size && fgetc(file) != EOF)
+    {
+        fclose(file);
+        fprintf(stderr, "load_raw_file: image file too big to fit in memory\n");
+        return -1;
+    }
+
+    if (ferror(file))
+    {
+        fclose(file);
+        perror("load_raw_file: error reading image file");
+        return -1;
+    }
+
+    fclose(file);
+
+    return 0;
+}
+
+static uint32_t read_le32(const uint8_t *ptr)
+{
+    return (uint32_t) ptr[0] | ((uint32_t) ptr[1] << 8)
+           | ((uint32_t) ptr[2] << 16) | ((uint32_t) ptr[3] << 24);
+}
+
+// Load each PT_LOAD segment of a 32-bit little endian ELF file at its
+// physical address. The part of a segment that isn't in the file (.bss)
+// is cleared.
+static int load_elf_file(struct processor *proc, const char *filename)
+{
+    FILE *file;
+    uint8_t header[52];
+    uint8_t segment_header[32];
+    uint32_t phoff;
+    uint32_t phentsize;
+    uint32_t phnum;
+    uint32_t segment;
+    uint32_t offset;
+    uint32_t paddr;
+    uint32_t filesz;
+    uint32_t memsz;
+
+    file = fopen(filename, "rb");
+    if (file == NULL)
+    {
+        perror("load_elf_file: error opening image file");
+        return -1;
+    }
+
+    if (fread(header, sizeof(header), 1, file) != 1
+            || header[4] != ELFCLASS32 || header[5] != ELFDATA2LSB)
+    {
+        fclose(file);
+        fprintf(stderr, "load_elf_file: not a 32-bit little endian ELF file\n");
+        return -1;
+    }
+
+    phoff = read_le32(header + 28);
+    phentsize = read_le32(header + 40) >> 16;
+    phnum = read_le32(header + 44) & 0xffff;
+    for (segment = 0; segment < phnum; segment++)
+    {
+        if (fseek(file, (long) (phoff + segment * phentsize), SEEK_SET) < 0
+                || fread(segment_header, sizeof(segment_header), 1, file) != 1)
+        {
+            fclose(file);
+            fprintf(stderr, "load_elf_file: error reading program header\n");
+            return -1;
+        }
+
+        if (read_le32(segment_header) != PT_LOAD)
+            continue;
+
+        offset = read_le32(segment_header + 4);
+        paddr = read_le32(segment_header + 12);
+        filesz = read_le32(segment_header + 16);
+        memsz = read_le32(segment_header + 20);
+        if (filesz > memsz || memsz > proc->memory_size
+                || paddr > proc->memory_size - memsz)
+        {
+            fclose(file);
+            fprintf(stderr, "load_elf_file: segment does not fit in memory\n");
+            return -1;
+        }
+
+        if (fseek(file, (long) offset, SEEK_SET) < 0
+                || fread((uint8_t*) proc->memory + paddr, 1, filesz, file) != filesz)
+        {
+            fclose(file);
+            fprintf(stderr, "load_elf_file: error reading segment\n");
+            return -1;
+        }
+
+        memset((uint8_t*) proc->memory + paddr + filesz, 0, memsz - filesz);
+    }
+
+    fclose(file);
+
+    return 0;
+}
+
+int load_image_file(struct processor *proc, const char *filename)
+{
+    FILE *file;
+    char magic[4];
+    size_t len;
+    bool is_elf;
+
+    file = fopen(filename, "rb");
+    if (file == NULL)
+    {
+        perror("load_image_file: error opening image file");
+        return -1;
+    }
+
+    is_elf = fread(magic, sizeof(magic), 1, file) == 1
+             && memcmp(magic, ELF_MAGIC, sizeof(magic)) == 0;
+    fclose(file);
+
+    len = strlen(filename);
+    if (is_elf)
+        return load_elf_file(proc, filename);
+    else if (len > 4 && strcmp(filename + len - 4, ".hex") == 0)
+        return load_hex_file(proc, filename);
+    else
+        return load_raw_file(proc, filename);
+}
+
 void write_memory_to_file(const struct processor *proc, const char *filename,
                           uint32_t base_address, uint32_t length)
 {
@@ -348,6 +496,11 @@ const void *get_memory_region_ptr(const struct processor *proc, uint32_t address
     return ((const uint8_t*) proc->memory) + address;
 }
 
+uint32_t get_memory_size(const struct processor *proc)
+{
+    return proc->memory_size;
+}
+
 void print_registers(const struct processor *proc, uint32_t thread_id)
 {
     print_thread_registers(get_const_thread(proc, thread_id));
@@ -660,7 +813,7 @@ static void set_scalar_reg(struct thread *thread, uint32_t reg, uint32_t value)
     if (thread->core->proc->enable_cosim)
     {
         cosim_check_set_scalar_reg(thread->core->proc, thread->pc - 4,
-                                   reg, value);
+                                   reg, &value);
     }
 
     thread->scalar_reg[reg] = value;
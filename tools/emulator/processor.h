@@ -40,13 +40,18 @@ void enable_tracing(struct processor*);
 // coverage by exposing more potential race conditions.
 void enable_random_thread_sched(struct processor*);
 
-// Open a file formatted in the Verilog $readmemh format into memory starting
-// address 0.
-int load_hex_file(struct processor*, const char *filename);
+// Load a program into memory. The format is determined by the contents and
+// name of the file:
+// - An ELF file. Loadable segments are copied to their physical addresses.
+// - A file with a .hex extension, in the Verilog $readmemh format, loaded
+//   starting at address 0.
+// - Anything else is a raw binary image, loaded starting at address 0.
+int load_image_file(struct processor*, const char *filename);
 void write_memory_to_file(const struct processor*, const char *filename,
                           uint32_t base_address, uint32_t length);
 const void *get_memory_region_ptr(const struct processor*, uint32_t address,
                                   uint32_t length);
+uint32_t get_memory_size(const struct processor*);
 void print_registers(const struct processor*, uint32_t thread_id);
 void enable_cosimulation(struct processor*);
 void raise_interrupt(struct processor*, uint32_t int_bitmap);
@@ -18,6 +18,7 @@
 #include <assert.h>
 #include <errno.h>
 #include <netinet/in.h>
+#include <netinet/tcp.h>
 #include <stdarg.h>
 #include <stdio.h>
 #include <string.h>
@@ -34,23 +35,43 @@
 
 #define TRAP_SIGNAL 5 // SIGTRAP
 
+// Largest packet body that can be received or sent. This is reported to the
+// debugger in the qSupported response.
+#define MAX_PACKET_SIZE 0x4000
+
 extern void poll_inputs(struct processor*);
 static void __attribute__ ((format (printf, 1, 2))) send_formatted_response(const char *format, ...);
 
 static int client_socket = -1;
 static int *last_signals;
 static const char *GENERIC_REGS[] = { "fp", "sp", "ra" };
+static const char HEX_DIGITS[] = "0123456789abcdef";
+
+// Data received from the debugger that hasn't been processed yet. Reading
+// into a buffer instead of a byte at a time avoids a system call for each
+// byte of a request.
+static uint8_t read_buffer[0x10000];
+static int read_buffer_offset;
+static int read_buffer_length;
 
 static int read_byte(void)
 {
-    uint8_t ch;
-    if (read(client_socket, &ch, 1) < 1)
+    ssize_t got;
+
+    if (read_buffer_offset == read_buffer_length)
     {
-        perror("read_byte: error reading from debug socket");
-        return -1;
+        got = read(client_socket, read_buffer, sizeof(read_buffer));
+        if (got < 1)
+        {
+            perror("read_byte: error reading from debug socket");
+            return -1;
+        }
+
+        read_buffer_offset = 0;
+        read_buffer_length = (int) got;
     }
 
-    return (int) ch;
+    return read_buffer[read_buffer_offset++];
 }
 
 static int read_packet(char *request, int max_length)
@@ -98,28 +119,26 @@ static int read_packet(char *request, int max_length)
 static void send_response_packet(const char *response)
 {
     uint8_t checksum;
-    char checksum_chars[16];
-    int i;
+    char packet[MAX_PACKET_SIZE + 5];
+    size_t i;
     size_t response_length = strlen(response);
+    size_t packet_length = response_length + 4;
 
 #if LOG_COMMANDS
     printf("GDB send: %s\n", response);
 #endif
 
-    if (write(client_socket, "$", 1) < 1
-            || write(client_socket, response, response_length) < (ssize_t) response_length
-            || write(client_socket, "#", 1) < 1)
-    {
-        perror("send_response_packet: Error writing to debugger socket");
-        exit(1);
-    }
-
+    assert(response_length <= MAX_PACKET_SIZE);
     checksum = 0;
-    for (i = 0; response[i]; i++)
-        checksum += response[i];
-
-    sprintf(checksum_chars, "%02x", checksum);
-    if (write(client_socket, checksum_chars, 2) < 2)
+    for (i = 0; i < response_length; i++)
+        checksum += (uint8_t) response[i];
+
+    // Send the whole packet with one write, so it isn't split into several
+    // TCP segments.
+    packet[0] = '$';
+    memcpy(packet + 1, response, response_length);
+    sprintf(packet + 1 + response_length, "#%02x", checksum);
+    if (write(client_socket, packet, packet_length) < (ssize_t) packet_length)
     {
         perror("send_response_packet: Error writing to debugger socket");
         exit(1);
@@ -151,7 +170,8 @@ static void run_until_interrupt(struct processor *proc, bool enable_fb_window)
         }
 
         // Break on error or if data is ready
-        if (can_read_file_descriptor(client_socket))
+        if (read_buffer_offset < read_buffer_length
+                || can_read_file_descriptor(client_socket))
             break;
     }
 }
@@ -176,17 +196,19 @@ static uint8_t decode_hex_byte(const char *ptr)
     return (uint8_t) retval;
 }
 
-void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window)
+void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window,
+                          uint16_t port, const char *ready_file)
 {
     int listen_socket;
     struct sockaddr_in address;
     socklen_t address_length;
+    char port_str[8];
     int got;
-    char request[256];
+    char request[MAX_PACKET_SIZE + 1];
     uint32_t i;
     bool no_ack_mode = false;
     int optval;
-    char response[1024];
+    char response[MAX_PACKET_SIZE + 1];
     uint32_t current_thread = 0;
 
     last_signals = calloc(sizeof(int), get_total_threads(proc));
@@ -208,7 +230,7 @@ void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window)
     }
 
     address.sin_family = AF_INET;
-    address.sin_port = htons(8000);
+    address.sin_port = htons(port);
     address.sin_addr.s_addr = htonl(INADDR_ANY);
     if (bind(listen_socket, (struct sockaddr*) &address, sizeof(address)) < 0)
     {
@@ -222,6 +244,18 @@ void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window)
         return;
     }
 
+    // Find which port was assigned if port is 0
+    address_length = sizeof(address);
+    if (getsockname(listen_socket, (struct sockaddr*) &address, &address_length) < 0)
+    {
+        perror("remote_gdb_main_loop: error setting up debug socket (getsockname)");
+        return;
+    }
+
+    sprintf(port_str, "%u", ntohs(address.sin_port));
+    if (write_ready_file(ready_file, port_str) < 0)
+        return;
+
     while (true)
     {
         // Wait for a new client socket
@@ -234,12 +268,24 @@ void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window)
                 break;
         }
 
+        // Responses are small and the debugger waits for each one, so
+        // don't delay sending them (Nagle's algorithm).
+        optval = 1;
+        if (setsockopt(client_socket, IPPROTO_TCP, TCP_NODELAY, &optval,
+                       sizeof(optval)) < 0)
+        {
+            perror("remote_gdb_main_loop: error setting up debug socket (setsockopt)");
+        }
+
+        read_buffer_offset = 0;
+        read_buffer_length = 0;
+
         no_ack_mode = false;
 
         // Process commands
         while (true)
         {
-            got = read_packet(request, sizeof(request));
+            got = read_packet(request, sizeof(request) - 1);
             if (got < 0)
                 break;
 
@@ -308,16 +354,21 @@ void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window)
                     length = (uint32_t) strtoul(len_ptr + 1, &data_ptr, 16);
                     if (request[0] == 'm')
                     {
-                        // XXX May need dynamic allocation. At very least, buffer is too small.
-                        if (length > sizeof(response) / 2)
+                        if (length > (sizeof(response) - 1) / 2)
                         {
-                            printf("memory read of %u requested\n", length);
-                            assert(0);
+                            send_response_packet("E01");
+                            break;
                         }
 
                         // Read memory
                         for (offset = 0; offset < length; offset++)
-                            sprintf(response + offset * 2, "%02x", dbg_read_memory_byte(proc, start + offset));
+                        {
+                            uint8_t value = dbg_read_memory_byte(proc, start + offset);
+                            response[offset * 2] = HEX_DIGITS[value >> 4];
+                            response[offset * 2 + 1] = HEX_DIGITS[value & 15];
+                        }
+
+                        response[length * 2] = '\0';
 
                         send_response_packet(response);
                     }
@@ -334,6 +385,43 @@ void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window)
                     break;
                 }
 
+                // Write memory, binary data
+                case 'X':
+                {
+                    char *len_ptr;
+                    char *data_ptr;
+                    char *data_end = request + got;
+                    uint32_t start;
+                    uint32_t length;
+                    uint32_t offset;
+                    uint8_t value;
+
+                    start = (uint32_t) strtoul(request + 1, &len_ptr, 16);
+                    length = (uint32_t) strtoul(len_ptr + 1, &data_ptr, 16);
+                    data_ptr += 1;	// Skip colon
+                    for (offset = 0; offset < length && data_ptr < data_end; offset++)
+                    {
+                        // '}' is an escape, which means the next byte is
+                        // XORed with 0x20
+                        if (*data_ptr == '}' && data_ptr + 1 < data_end)
+                        {
+                            value = (uint8_t) data_ptr[1] ^ 0x20;
+                            data_ptr += 2;
+                        }
+                        else
+                            value = (uint8_t) *data_ptr++;
+
+                        dbg_write_memory_byte(proc, start + offset, value);
+                    }
+
+                    if (offset < length)
+                        send_response_packet("E01");	// Packet was truncated
+                    else
+                        send_response_packet("OK");
+
+                    break;
+                }
+
                 // Read register
                 case 'p':
                 case 'g':
@@ -373,7 +461,9 @@ void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window)
                     break;
                 }
 
-                // Write register
+                // Write register. P is the standard form (P<reg>=<value>),
+                // G<reg>,<value> is supported for compatibility.
+                case 'P':
                 case 'G':
                 {
                     char *data_ptr;
@@ -457,6 +547,11 @@ void remote_gdb_main_loop(struct processor *proc, bool enable_fb_window)
                     }
                     else if (strcmp(request + 1, "C") == 0)
                         send_formatted_response("QC%02x", current_thread + 1);
+                    else if (memcmp(request + 1, "Supported", 9) == 0)
+                    {
+                        send_formatted_response("PacketSize=%x;QStartNoAckMode+",
+                                                MAX_PACKET_SIZE);
+                    }
                     else
                         send_response_packet("");	// Not supported
 
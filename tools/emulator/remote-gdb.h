@@ -17,6 +17,9 @@
 #ifndef REMOTE_GDB_H
 #define REMOTE_GDB_H
 
-void remote_gdb_main_loop(struct processor*, bool enable_fb_window);
+// If port is 0, the OS picks a free port. The port number is written to
+// ready_file (if it isn't NULL) once the emulator is listening.
+void remote_gdb_main_loop(struct processor*, bool enable_fb_window,
+                          uint16_t port, const char *ready_file);
 
 #endif
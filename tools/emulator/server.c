@@ -0,0 +1,380 @@
+//
+// Copyright 2018 Jeff Bush
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+//
+
+//
+// Server mode runs many programs without starting a new emulator process
+// for each one. The processor is initialized once, then the server waits
+// for connections on a UNIX domain socket. Each request is handled by a
+// forked copy of the server, so it begins with the pristine initial
+// processor state (and the OS shares the unmodified memory pages).
+//
+// The client sends a request, which is a series of newline terminated
+// lines of the form '<key> <value>', followed by an empty line:
+//
+//   image <filename>         Program to load (required), in any format
+//                            load_image_file supports
+//   block <filename>         Load file into virtual block device
+//   dump <filename>,<start>,<length>  Dump memory after program finishes
+//   timeout <seconds>        Kill program if it runs longer than this
+//   random                   Enable random thread scheduling (no value)
+//
+// The server writes the program's output (anything written to the virtual
+// serial port, as well as error messages) to the socket. When the program
+// finishes, it writes a zero byte, followed by the exit code as a decimal
+// number and a newline, then closes the connection. If the program was
+// killed by a signal (for example, because it timed out), the exit code is
+// 128 plus the signal number.
+//
+
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/socket.h>
+#include <sys/types.h>
+#include <sys/un.h>
+#include <sys/wait.h>
+#include <unistd.h>
+#include "processor.h"
+#include "sdmmc.h"
+#include "server.h"
+#include "util.h"
+
+#define MAX_REQUEST_LINE 1024
+
+// The SIGCHLD handler writes to this so the connection handler can wait for
+// either the program to exit or the client to disconnect.
+static int child_exit_pipe[2];
+
+struct request
+{
+    char image_file[MAX_REQUEST_LINE];
+    char block_file[MAX_REQUEST_LINE];
+    char dump_file[MAX_REQUEST_LINE];
+    uint32_t dump_base;
+    uint32_t dump_length;
+    uint32_t timeout;
+    bool random_thread_sched;
+};
+
+static uint32_t parse_num(const char *str)
+{
+    if (str[0] == '0' && str[1] == 'x')
+        return (uint32_t) strtoul(str + 2, NULL, 16);
+    else
+        return (uint32_t) strtoul(str, NULL, 10);
+}
+
+static int read_request(FILE *stream, struct request *request)
+{
+    char line[MAX_REQUEST_LINE];
+    char *value;
+    char *separator;
+    size_t len;
+
+    memset(request, 0, sizeof(*request));
+    while (fgets(line, sizeof(line), stream) != NULL)
+    {
+        len = strlen(line);
+        if (len > 0 && line[len - 1] == '\n')
+            line[--len] = '\0';
+
+        if (len == 0)
+        {
+            if (request->image_file[0] == '\0')
+            {
+                fprintf(stderr, "read_request: no image file specified\n");
+                return -1;
+            }
+
+            return 0;
+        }
+
+        value = strchr(line, ' ');
+        if (value)
+            *value++ = '\0';
+        else
+            value = line + len;
+
+        if (strcmp(line, "image") == 0)
+            strcpy(request->image_file, value);
+        else if (strcmp(line, "block") == 0)
+            strcpy(request->block_file, value);
+        else if (strcmp(line, "dump") == 0)
+        {
+            // filename,start,length
+            separator = strchr(value, ',');
+            if (separator == NULL || strchr(separator + 1, ',') == NULL)
+            {
+                fprintf(stderr, "read_request: bad format for memory dump\n");
+                return -1;
+            }
+
+            *separator = '\0';
+            strcpy(request->dump_file, value);
+            request->dump_base = parse_num(separator + 1);
+            request->dump_length = parse_num(strchr(separator + 1, ',') + 1);
+        }
+        else if (strcmp(line, "timeout") == 0)
+            request->timeout = parse_num(value);
+        else if (strcmp(line, "random") == 0)
+            request->random_thread_sched = true;
+        else
+        {
+            fprintf(stderr, "read_request: unknown request key %s\n", line);
+            return -1;
+        }
+    }
+
+    fprintf(stderr, "read_request: connection closed before end of request\n");
+    return -1;
+}
+
+// This runs in its own process, with standard out and error redirected to
+// the client socket.
+static int run_request(struct processor *proc, const struct request *request)
+{
+    if (request->block_file[0] != '\0')
+    {
+        if (open_sdmmc_device(request->block_file) < 0)
+            return 1;
+    }
+
+    if (load_image_file(proc, request->image_file) < 0)
+    {
+        fprintf(stderr, "Error reading image %s\n", request->image_file);
+        return 1;
+    }
+
+    if (request->random_thread_sched)
+        enable_random_thread_sched(proc);
+
+    if (request->timeout)
+        alarm(request->timeout);
+
+    dbg_set_stop_on_fault(proc, false);
+    while (execute_instructions(proc, 1000000))
+        ;
+
+    if (request->dump_file[0] != '\0')
+    {
+        write_memory_to_file(proc, request->dump_file, request->dump_base,
+                             request->dump_length);
+    }
+
+    dump_instruction_stats(proc);
+    if (request->block_file[0] != '\0')
+        close_sdmmc_device();
+
+    if (is_stopped_on_fault(proc))
+        return 1;
+
+    return 0;
+}
+
+static void handle_child_exit(int num)
+{
+    (void) num;
+
+    if (write(child_exit_pipe[1], "", 1) < 0)
+        ;   // Can't report errors from a signal handler
+}
+
+// Wait for the program to exit. If the client disconnects first (for
+// example, because it timed out), kill the program.
+static int wait_program(pid_t pid, int client_socket)
+{
+    struct pollfd fds[2];
+    char buf[64];
+    int status;
+
+    fds[0].fd = child_exit_pipe[0];
+    fds[0].events = POLLIN;
+    fds[1].fd = client_socket;
+    fds[1].events = POLLIN;
+    while (true)
+    {
+        if (poll(fds, 2, -1) < 0)
+        {
+            if (errno == EINTR)
+                continue;
+
+            perror("wait_program: poll failed");
+            exit(1);
+        }
+
+        if (fds[0].revents)
+            break;
+
+        if (fds[1].revents && read(client_socket, buf, sizeof(buf)) <= 0)
+        {
+            kill(pid, SIGKILL);
+            fds[1].events = 0;  // Only wait for exit now
+        }
+    }
+
+    if (waitpid(pid, &status, 0) < 0)
+    {
+        perror("wait_program: waitpid failed");
+        exit(1);
+    }
+
+    if (WIFSIGNALED(status))
+        return 128 + WTERMSIG(status);
+    else
+        return WEXITSTATUS(status);
+}
+
+static void handle_connection(struct processor *proc, int client_socket)
+{
+    FILE *stream;
+    struct request request;
+    pid_t pid;
+    int exit_code;
+    int null_fd;
+    char trailer[16];
+    int trailer_len;
+
+    stream = fdopen(client_socket, "r");
+    if (stream == NULL)
+    {
+        perror("handle_connection: fdopen failed");
+        exit(1);
+    }
+
+    if (read_request(stream, &request) < 0)
+        exit(1);
+
+    if (pipe(child_exit_pipe) < 0)
+    {
+        perror("handle_connection: pipe failed");
+        exit(1);
+    }
+
+    signal(SIGCHLD, handle_child_exit);
+    pid = fork();
+    if (pid < 0)
+    {
+        perror("handle_connection: fork failed");
+        exit(1);
+    }
+
+    if (pid == 0)
+    {
+        // Child process, run program.
+        null_fd = open("/dev/null", O_RDONLY);
+        if (null_fd < 0 || dup2(null_fd, STDIN_FILENO) < 0
+                || dup2(client_socket, STDOUT_FILENO) < 0
+                || dup2(client_socket, STDERR_FILENO) < 0)
+        {
+            perror("handle_connection: failed to redirect output");
+            exit(1);
+        }
+
+        signal(SIGCHLD, SIG_DFL);
+        close(child_exit_pipe[0]);
+        close(child_exit_pipe[1]);
+
+        // Otherwise every program would see the same sequence of random
+        // numbers.
+        seed_random(current_time_us() ^ (uint64_t) getpid());
+        exit_code = run_request(proc, &request);
+        fflush(stdout);
+        fflush(stderr);
+        exit(exit_code);
+    }
+
+    exit_code = wait_program(pid, client_socket);
+    trailer[0] = '\0';
+    trailer_len = 1 + sprintf(trailer + 1, "%d\n", exit_code);
+    if (write(client_socket, trailer, (size_t) trailer_len) != trailer_len)
+    {
+        perror("handle_connection: error writing to socket");
+        exit(1);
+    }
+
+    fclose(stream);
+    exit(0);
+}
+
+int run_server(struct processor *proc, const char *socket_path, const char *ready_file)
+{
+    int listen_socket;
+    int client_socket;
+    struct sockaddr_un address;
+    pid_t pid;
+
+    if (strlen(socket_path) >= sizeof(address.sun_path))
+    {
+        fprintf(stderr, "run_server: socket path is too long\n");
+        return -1;
+    }
+
+    listen_socket = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (listen_socket < 0)
+    {
+        perror("run_server: error setting up socket (socket)");
+        return -1;
+    }
+
+    memset(&address, 0, sizeof(address));
+    address.sun_family = AF_UNIX;
+    strcpy(address.sun_path, socket_path);
+    unlink(socket_path);
+    if (bind(listen_socket, (struct sockaddr*) &address, sizeof(address)) < 0)
+    {
+        perror("run_server: error setting up socket (bind)");
+        return -1;
+    }
+
+    if (listen(listen_socket, 16) < 0)
+    {
+        perror("run_server: error setting up socket (listen)");
+        return -1;
+    }
+
+    if (write_ready_file(ready_file, socket_path) < 0)
+        return -1;
+
+    // Connection handlers are reaped automatically. A client whose
+    // connection is closed early shouldn't kill the server.
+    signal(SIGCHLD, SIG_IGN);
+    signal(SIGPIPE, SIG_IGN);
+
+    while (true)
+    {
+        client_socket = accept(listen_socket, NULL, NULL);
+        if (client_socket < 0)
+            continue;
+
+        pid = fork();
+        if (pid < 0)
+            perror("run_server: fork failed");
+        else if (pid == 0)
+        {
+            // Restore the default handler, so the program is killed if it
+            // writes after the client disconnects.
+            signal(SIGPIPE, SIG_DFL);
+            close(listen_socket);
+            handle_connection(proc, client_socket);
+        }
+
+        close(client_socket);
+    }
+}
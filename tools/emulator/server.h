@@ -0,0 +1,24 @@
+//
+// Copyright 2018 Jeff Bush
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+//
+
+#ifndef SERVER_H
+#define SERVER_H
+
+// Listen for requests to run programs on a UNIX domain socket at the
+// given path. Only returns if there is an error setting up the socket.
+int run_server(struct processor*, const char *socket_path, const char *ready_file);
+
+#endif
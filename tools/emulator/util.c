@@ -91,3 +91,27 @@ uint64_t current_time_us(void)
     return (uint64_t) tv.tv_sec * 1000000 + (uint64_t) tv.tv_usec;
 }
 
+int write_ready_file(const char *ready_file, const char *message)
+{
+    FILE *file;
+
+    if (ready_file == NULL)
+        return 0;
+
+    file = fopen(ready_file, "w");
+    if (file == NULL)
+    {
+        perror("write_ready_file: error opening ready file");
+        return -1;
+    }
+
+    fprintf(file, "%s\n", message);
+    if (fclose(file) != 0)
+    {
+        perror("write_ready_file: error writing ready file");
+        return -1;
+    }
+
+    return 0;
+}
+
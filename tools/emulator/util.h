@@ -128,5 +128,10 @@ uint64_t next_random(void);
 
 uint64_t current_time_us(void);
 
+// Write a line to ready_file to signal to another program (usually the test
+// harness) that the emulator is ready, for example, that it is listening for
+// connections. Does nothing if ready_file is NULL.
+int write_ready_file(const char *ready_file, const char *message);
+
 #endif
 